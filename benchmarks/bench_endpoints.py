@@ -0,0 +1,263 @@
+"""
+Endpoint benchmark suite.
+
+Seeds a deterministic synthetic catalog (see api/seed.py) into a fresh SQLite
+file or a local Postgres database, runs the key API endpoints through the Flask
+test client (sequentially and with a concurrent load driver) and writes
+p50/p95/p99 latency, throughput, SQL statement counts and peak RSS as JSON so
+results can be compared across commits:
+
+    $ pipenv run bench --pois-per-city 50 --output bench_output.json
+    $ python benchmarks/bench_endpoints.py --db-url postgresql://localhost/bench
+
+The target database is dropped and recreated, never point it at real data.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the API endpoints.')
+    parser.add_argument('--db-url', help='Database URL (default: a temporary SQLite file).')
+    parser.add_argument('--countries', type=int, default=5)
+    parser.add_argument('--cities-per-country', type=int, default=10)
+    parser.add_argument('--pois-per-city', type=int, default=20)
+    parser.add_argument('--tags', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=50,
+                        help='Sequential requests per endpoint.')
+    parser.add_argument('--warmup', type=int, default=3,
+                        help='Untimed requests per endpoint before measuring.')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Worker threads of the concurrent load driver (0 disables it).')
+    parser.add_argument('--concurrent-requests', type=int, default=200,
+                        help='Total requests per endpoint in the concurrent phase.')
+    parser.add_argument('--only', action='append', default=[],
+                        help='Run only the named endpoint(s).')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout.')
+    return parser.parse_args(argv)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1,
+                       int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KiB."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SRC_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class QueryCounter:
+    """Counts SQL statements per thread through SQLAlchemy engine events."""
+
+    def __init__(self, engine):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.total = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args, **kwargs):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+        with self._lock:
+            self.total += 1
+
+    def reset_thread(self):
+        self._local.count = 0
+
+    @property
+    def thread_count(self):
+        return getattr(self._local, 'count', 0)
+
+
+def summarize(latencies, wall_time, queries, errors):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3) if count else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3) if count else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3) if count else None,
+        'mean_ms': round(sum(latencies) / count * 1000, 3) if count else None,
+        'throughput_rps': round(count / wall_time, 2) if wall_time else None,
+        'queries_per_request': round(queries / count, 2) if count else None,
+    }
+
+
+def build_endpoints(data):
+    """Return (name, path, needs_auth) for every benchmarked endpoint."""
+    country = data['country_names'][0]
+    city = data['city_names'][0]
+    return [
+        ('pois_all', '/api/pois', False),
+        ('pois_by_country', f'/api/pois?country_name={country}', False),
+        ('pois_by_city', f'/api/pois?city_name={city}', False),
+        ('pois_by_tag', f"/api/pois?tag_name={data['tags'][0]}", False),
+        ('poi_detail', f"/api/pois/{data['pois'][0]}", False),
+        ('popular_pois', '/api/popular-pois', False),
+        ('countries', '/api/countries', False),
+        ('country_by_name', f'/api/countries/{country}', False),
+        ('cities', '/api/cities', False),
+        ('cities_by_country', f'/api/{country}/cities', False),
+        ('tags', '/api/tags', False),
+        ('users', '/api/users', False),
+        ('favorites', '/api/favorites', True),
+        ('visited', '/api/visited', True),
+        ('my_profile', '/api/myProfile', True),
+    ]
+
+
+def run_sequential(app, counter, path, headers, iterations, warmup):
+    client = app.test_client()
+    for _ in range(warmup):
+        client.get(path, headers=headers)
+    latencies, queries, errors, response_bytes = [], 0, 0, 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        counter.reset_thread()
+        t0 = time.perf_counter()
+        response = client.get(path, headers=headers)
+        latencies.append(time.perf_counter() - t0)
+        queries += counter.thread_count
+        response_bytes = len(response.data)
+        if response.status_code >= 400:
+            errors += 1
+    result = summarize(latencies, time.perf_counter() - started, queries, errors)
+    result['response_bytes'] = response_bytes
+    return result
+
+
+def run_concurrent(app, counter, path, headers, concurrency, total):
+    per_worker = [total // concurrency + (1 if i < total % concurrency else 0)
+                  for i in range(concurrency)]
+
+    def worker(n):
+        client = app.test_client()
+        latencies, queries, errors = [], 0, 0
+        for _ in range(n):
+            counter.reset_thread()
+            t0 = time.perf_counter()
+            response = client.get(path, headers=headers)
+            latencies.append(time.perf_counter() - t0)
+            queries += counter.thread_count
+            if response.status_code >= 400:
+                errors += 1
+        return latencies, queries, errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(worker, per_worker))
+    wall_time = time.perf_counter() - started
+    latencies = [lat for result in results for lat in result[0]]
+    result = summarize(latencies, wall_time, sum(r[1] for r in results),
+                       sum(r[2] for r in results))
+    result['concurrency'] = concurrency
+    return result
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    tmp_db = None
+    if args.db_url:
+        os.environ['DATABASE_URL'] = args.db_url
+    else:
+        tmp_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        tmp_db.close()
+        os.environ['DATABASE_URL'] = f'sqlite:///{tmp_db.name}'
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark-secret-key-not-for-production')
+    os.environ.setdefault('FLASK_DEBUG', '0')
+    sys.path.insert(0, os.path.realpath(SRC_DIR))
+
+    from flask_jwt_extended import create_access_token
+    from app import create_app
+    from api.models import db
+    from api.seed import CatalogSpec, seed_catalog
+
+    app = create_app({'ENABLE_ADMIN': False, 'ENABLE_SITEMAP': False, 'RATE_LIMIT_ENABLED': False, 'JOB_WORKERS': 0})
+    spec = CatalogSpec(countries=args.countries, cities_per_country=args.cities_per_country,
+                       pois_per_city=args.pois_per_city, tags=args.tags,
+                       users=args.users, seed=args.seed)
+    try:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            seed_started = time.perf_counter()
+            data = seed_catalog(spec)
+            seed_time = time.perf_counter() - seed_started
+            token = create_access_token(identity=data['users'][0])
+            counter = QueryCounter(db.engine)
+            dialect = db.engine.dialect.name
+        auth_headers = {'Authorization': f'Bearer {token}'}
+
+        endpoints = []
+        for name, path, needs_auth in build_endpoints(data):
+            if args.only and name not in args.only:
+                continue
+            headers = auth_headers if needs_auth else {}
+            entry = {'name': name, 'path': path}
+            entry['sequential'] = run_sequential(app, counter, path, headers,
+                                                 args.iterations, args.warmup)
+            if args.concurrency > 0:
+                entry['concurrent'] = run_concurrent(app, counter, path, headers,
+                                                     args.concurrency,
+                                                     args.concurrent_requests)
+            entry['peak_rss_kb'] = peak_rss_kb()
+            endpoints.append(entry)
+            print(f"{name:20s} p50={entry['sequential']['p50_ms']}ms "
+                  f"p95={entry['sequential']['p95_ms']}ms "
+                  f"queries={entry['sequential']['queries_per_request']}", file=sys.stderr)
+
+        report = {
+            'meta': {
+                'git_revision': git_revision(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'database': dialect,
+                'dataset': spec.to_dict(),
+                'seed_seconds': round(seed_time, 3),
+                'iterations': args.iterations,
+            },
+            'endpoints': endpoints,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        else:
+            print(output)
+    finally:
+        if tmp_db is not None:
+            os.unlink(tmp_db.name)
+
+
+if __name__ == '__main__':
+    main()
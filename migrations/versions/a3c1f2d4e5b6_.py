@@ -0,0 +1,55 @@
+"""on delete cascade foreign keys
+
+Revision ID: a3c1f2d4e5b6
+Revises: 69e9ab5a73a7
+Create Date: 2026-10-19 10:12:44.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c1f2d4e5b6'
+down_revision = '69e9ab5a73a7'
+branch_labels = None
+depends_on = None
+
+# (table, column, referred table) of every foreign key, parents first
+FOREIGN_KEYS = (
+    ('city', 'country_id', 'country'),
+    ('poi', 'city_id', 'city'),
+    ('poi_image', 'poi_id', 'poi'),
+    ('poi_tag', 'poi_id', 'poi'),
+    ('poi_tag', 'tag_id', 'tag'),
+    ('favorite', 'poi_id', 'poi'),
+    ('favorite', 'user_id', 'user'),
+    ('visited', 'poi_id', 'poi'),
+    ('visited', 'user_id', 'user'),
+)
+
+# the initial migration left the foreign keys unnamed: Postgres called them
+# <table>_<column>_fkey, SQLite keeps no name so batch mode reflects them under this one
+NAMING_CONVENTION = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def _replace_foreign_keys(ondelete):
+    tables = {}
+    for table, column, referred in FOREIGN_KEYS:
+        tables.setdefault(table, []).append((column, referred))
+    for table, columns in tables.items():
+        with op.batch_alter_table(table, schema=None,
+                                  naming_convention=NAMING_CONVENTION) as batch_op:
+            for column, referred in columns:
+                name = f'{table}_{column}_fkey'
+                batch_op.drop_constraint(name, type_='foreignkey')
+                batch_op.create_foreign_key(name, referred, [column], ['id'],
+                                            ondelete=ondelete)
+
+
+def upgrade():
+    _replace_foreign_keys('CASCADE')
+
+
+def downgrade():
+    _replace_foreign_keys(None)
@@ -5,6 +5,9 @@ set -o errexit
 npm install
 npm run build
 
+# precompress the front end build so it is served without gzipping per request
+find dist -type f \( -name "*.js" -o -name "*.css" -o -name "*.html" -o -name "*.svg" -o -name "*.json" \) -exec gzip -kf9 {} \;
+
 pip install pipenv
 pipenv install
 
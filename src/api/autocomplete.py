@@ -0,0 +1,306 @@
+"""
+Typeahead suggestions over country, city, POI and tag names.
+
+Names are accent folded and lower cased ("São Paulo" -> "sao paulo") and every
+suffix starting at a word ("sao paulo", "paulo") is kept in one sorted array.
+A query is a bisect to the first key with its prefix and a scan of the keys
+that share it, so suggestions never touch the database. Matches are ranked
+exact name, then name prefix, then word prefix, and then by popularity (POIs
+of a place or a tag, favorites and visits of a POI). For prefixes shared by
+many keys ("p", "par") the best suggestions of each kind are kept after the
+first scan and updated in place as names change.
+
+Each process builds its index on first use and follows the change feed to
+stay current: right after a commit that touched the catalog in this process,
+and at most every AUTOCOMPLETE_REFRESH_SECONDS for writes made by others.
+"""
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, literal, select
+from api.models import (db, ChangeLog, City, Country, Favorite, PlaceStats, PlaceTagStats,
+                        Poi, Tag, Visited)
+from api.change_feed import current_seq
+
+TYPES = ('country', 'city', 'poi', 'tag')
+ENTITY_TYPES = {'countries': 'country', 'cities': 'city', 'pois': 'poi', 'tags': 'tag'}
+MODELS = {'country': Country, 'city': City, 'poi': Poi, 'tag': Tag}
+PARENT_COLUMNS = {'city': City.country_id, 'poi': Poi.city_id}
+MAX_WORDS = 8
+MAX_SUGGESTIONS = 20
+CACHE_MIN_KEYS = 200
+MAX_CACHED_PREFIXES = 4096
+REBUILD_AFTER_CHANGES = 20000
+WORD_RE = re.compile(r'\w+')
+
+
+def normalize(text):
+    """
+    Fold a name for matching: no accents, case folded, words separated by single spaces.
+    Args:
+        text (str): Name or query.
+    Returns:
+        str: The normalized text.
+    """
+    decomposed = unicodedata.normalize('NFKD', text)
+    folded = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(WORD_RE.findall(folded.casefold()))
+
+
+class Suggestion:
+    """Entry of the index: what is shown and how it ranks."""
+    __slots__ = ('kind', 'id', 'name', 'normalized', 'parent_id', 'weight')
+
+    def __init__(self, kind, id, name, parent_id, weight):
+        self.kind = kind
+        self.id = id
+        self.name = name
+        self.normalized = normalize(name)
+        self.parent_id = parent_id
+        self.weight = weight
+
+    def keys(self):
+        words = self.normalized.split(' ')[:MAX_WORDS]
+        return {(' '.join(words[i:]), self.kind, self.id) for i in range(len(words)) if words[i]}
+
+
+def _rows(kind, ids=None):
+    """(id, name, parent id) of the rows of one type, all of them or the given ids."""
+    model = MODELS[kind]
+    parent = PARENT_COLUMNS.get(kind)
+    query = select(model.id, model.name, parent if parent is not None else literal(None))
+    if ids is not None:
+        query = query.where(model.id.in_(ids))
+    return db.session.execute(query).all()
+
+
+def _weights():
+    """Popularity of every country, city, tag and POI, read once when the index is built."""
+    weights = {}
+    for scope, kind in (('country', 'country'), ('city', 'city')):
+        weights.update(((kind, place_id), n) for place_id, n in db.session.execute(
+            select(PlaceStats.place_id, PlaceStats.poi_count).where(PlaceStats.scope == scope)))
+    weights.update((('tag', tag_id), int(n)) for tag_id, n in db.session.execute(
+        select(PlaceTagStats.tag_id, func.sum(PlaceTagStats.poi_count))
+        .where(PlaceTagStats.scope == 'country').group_by(PlaceTagStats.tag_id)))
+    for model in (Favorite, Visited):
+        for poi_id, n in db.session.execute(
+                select(model.poi_id, func.count()).group_by(model.poi_id)):
+            weights[('poi', poi_id)] = weights.get(('poi', poi_id), 0) + n
+    return weights
+
+
+def _rank(prefix, key, suggestion):
+    """Sort key of a match: exact name, name prefix, word prefix, then the most popular."""
+    if suggestion.normalized == prefix:
+        match = 0
+    elif key == suggestion.normalized:
+        match = 1
+    else:
+        match = 2
+    return match, -suggestion.weight, len(suggestion.name), suggestion.name, suggestion.id
+
+
+class AutocompleteIndex:
+    """
+    In-memory prefix index of the catalog names of one process.
+    """
+
+    def __init__(self, refresh_seconds=5.0):
+        self.refresh_seconds = refresh_seconds
+        self.keys = []
+        self.suggestions = {}
+        self.seq = None
+        self.stale = False
+        self._checked_at = 0.0
+        # prefix shared by many keys -> kind -> best MAX_SUGGESTIONS (rank, suggestion)
+        self._top = {}
+        self._lock = threading.Lock()
+
+    def _add(self, suggestion):
+        self.suggestions[(suggestion.kind, suggestion.id)] = suggestion
+        for key in suggestion.keys():
+            insort(self.keys, key)
+            for n in range(1, len(key[0]) + 1):
+                prefix = key[0][:n]
+                if prefix not in self._top:
+                    continue
+                ranked = self._top[prefix][suggestion.kind]
+                rank = _rank(prefix, key[0], suggestion)
+                ranked[:] = [item for item in ranked if item[1] is not suggestion or item[0] < rank]
+                if all(item[1] is not suggestion for item in ranked):
+                    insort(ranked, (rank, suggestion))
+                    del ranked[MAX_SUGGESTIONS:]
+
+    def _remove(self, kind, id):
+        suggestion = self.suggestions.pop((kind, id), None)
+        if suggestion is None:
+            return None
+        for key in suggestion.keys():
+            i = bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+            for n in range(1, len(key[0]) + 1):
+                prefix = key[0][:n]
+                ranked = self._top.get(prefix, {}).get(kind)
+                if ranked and any(item[1] is suggestion for item in ranked):
+                    if len(ranked) < MAX_SUGGESTIONS:
+                        ranked[:] = [item for item in ranked if item[1] is not suggestion]
+                    else:
+                        # the next best is unknown, scan again on the next query
+                        del self._top[prefix]
+        return suggestion
+
+    def build(self):
+        """Load every name from the database."""
+        seq = current_seq()
+        weights = _weights()
+        suggestions, keys = {}, []
+        for kind in TYPES:
+            for id, name, parent_id in _rows(kind):
+                suggestion = Suggestion(kind, id, name, parent_id, weights.get((kind, id), 0))
+                suggestions[(kind, id)] = suggestion
+                keys.extend(suggestion.keys())
+        keys.sort()
+        self.keys, self.suggestions, self.seq = keys, suggestions, seq
+        self._top = {}
+
+    def _apply_changes(self):
+        changes = db.session.execute(
+            select(ChangeLog.seq, ChangeLog.entity, ChangeLog.entity_id)
+            .where(ChangeLog.seq > self.seq, ChangeLog.entity.in_(list(ENTITY_TYPES)))
+            .order_by(ChangeLog.seq).limit(REBUILD_AFTER_CHANGES + 1)).all()
+        if not changes:
+            return
+        if len(changes) > REBUILD_AFTER_CHANGES:
+            self.build()
+            return
+        changed = {}
+        for _, entity, entity_id in changes:
+            changed.setdefault(ENTITY_TYPES[entity], set()).add(entity_id)
+        for kind, ids in changed.items():
+            current = {id: (name, parent_id) for id, name, parent_id in _rows(kind, ids)}
+            for id in ids:
+                previous = self._remove(kind, id)
+                if id in current:
+                    name, parent_id = current[id]
+                    self._add(Suggestion(kind, id, name, parent_id,
+                                         previous.weight if previous else 0))
+        self.seq = changes[-1].seq
+
+    def refresh(self):
+        """Build the index on first use, then apply the changes recorded since the last check."""
+        now = time.monotonic()
+        if self.seq is not None and not self.stale and now - self._checked_at < self.refresh_seconds:
+            return
+        with self._lock:
+            if self.seq is None:
+                self.build()
+            elif self.stale or now - self._checked_at >= self.refresh_seconds:
+                self.stale = False
+                self._apply_changes()
+            self._checked_at = now
+
+    def _scan(self, prefix):
+        """Best match of every suggestion with a key starting with prefix, and the keys scanned."""
+        best = {}
+        keys = self.keys
+        start = i = bisect_left(keys, (prefix,))
+        while i < len(keys) and keys[i][0].startswith(prefix):
+            key, kind, id = keys[i]
+            i += 1
+            suggestion = self.suggestions[(kind, id)]
+            rank = _rank(prefix, key, suggestion)
+            if (kind, id) not in best or rank < best[(kind, id)][0]:
+                best[(kind, id)] = (rank, suggestion)
+        return best.values(), i - start
+
+    def _matches(self, prefix):
+        if prefix in self._top:
+            return [item for ranked in self._top[prefix].values() for item in ranked]
+        matches, scanned = self._scan(prefix)
+        if scanned >= CACHE_MIN_KEYS:
+            if len(self._top) >= MAX_CACHED_PREFIXES:
+                del self._top[next(iter(self._top))]
+            top = {kind: [] for kind in TYPES}
+            for item in matches:
+                top[item[1].kind].append(item)
+            for ranked in top.values():
+                ranked.sort()
+                del ranked[MAX_SUGGESTIONS:]
+            self._top[prefix] = top
+        return matches
+
+    def search(self, query, types=TYPES, limit=10):
+        """
+        Suggest names starting with a query, or with a word starting with it.
+        Args:
+            query (str): Text typed so far.
+            types (tuple): Kinds of names to return, from TYPES.
+            limit (int): Maximum number of suggestions, up to MAX_SUGGESTIONS.
+        Returns:
+            list: Dicts with type, id, name and context (the city of a POI or the country of a city).
+        """
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        with self._lock:
+            matches = [item for item in self._matches(prefix) if item[1].kind in types]
+            return [self._serialize(suggestion)
+                    for _, suggestion in heapq.nsmallest(min(limit, MAX_SUGGESTIONS), matches)]
+
+    def _serialize(self, suggestion):
+        context = None
+        parent_kind = {'poi': 'city', 'city': 'country'}.get(suggestion.kind)
+        if parent_kind:
+            parent = self.suggestions.get((parent_kind, suggestion.parent_id))
+            context = parent.name if parent else None
+        return {'type': suggestion.kind, 'id': suggestion.id, 'name': suggestion.name,
+                'context': context}
+
+
+def _note_catalog_writes(session, flush_context, instances):
+    for objects in (session.new, session.dirty, session.deleted):
+        if any(isinstance(obj, (Country, City, Poi, Tag)) for obj in objects):
+            session.info['autocomplete_stale'] = True
+            return
+
+
+def _mark_stale(session):
+    if session.info.pop('autocomplete_stale', False) and has_app_context():
+        index = current_app.extensions.get('autocomplete')
+        if index is not None:
+            index.stale = True
+
+
+def get_autocomplete_index():
+    """
+    Index of the current application, built or refreshed as needed.
+    Returns:
+        AutocompleteIndex: The index.
+    """
+    index = current_app.extensions['autocomplete']
+    index.refresh()
+    return index
+
+
+_listeners_installed = False
+
+
+def setup_autocomplete(app):
+    """
+    Create the autocomplete index of the application and refresh it after catalog commits.
+    Args:
+        app (Flask): The application.
+    """
+    global _listeners_installed
+    app.config.setdefault('AUTOCOMPLETE_REFRESH_SECONDS', 5.0)
+    app.extensions['autocomplete'] = AutocompleteIndex(app.config['AUTOCOMPLETE_REFRESH_SECONDS'])
+    if not _listeners_installed:
+        event.listen(db.session, 'before_flush', _note_catalog_writes)
+        event.listen(db.session, 'after_commit', _mark_stale)
+        _listeners_installed = True
@@ -0,0 +1,140 @@
+"""
+Streaming export of the whole catalog as NDJSON (optionally gzipped).
+Countries, cities and tags are written first, then one denormalized line per
+POI with its city, country, tags and image URLs. The records use the same
+fields as import-catalog, so an export can be loaded back as it is.
+
+Everything is read on a dedicated connection inside one read only snapshot
+transaction with server-side cursors. POI tags and images come from cursors
+ordered by poi_id that are merged with the POI cursor, so memory use does not
+depend on the catalog size and no query is issued per POI.
+"""
+import json
+import zlib
+from flask import current_app
+from sqlalchemy import select
+from api.models import db, Country, City, Tag, Poi, PoiTag, PoiImage
+
+CHUNK_BYTES = 64 * 1024
+
+
+def _snapshot_connection(yield_per):
+    """Open a connection reading from a single consistent snapshot."""
+    connection = db.engine.connect()
+    if connection.dialect.name == 'postgresql':
+        connection = connection.execution_options(
+            isolation_level='REPEATABLE READ', postgresql_readonly=True)
+    return connection.execution_options(stream_results=True, yield_per=yield_per)
+
+
+def _by_id(column, connection):
+    """Order by an id column bytewise, the same way Python compares the strings."""
+    if connection.dialect.name == 'postgresql':
+        return column.collate('C')
+    return column
+
+
+class _GroupedCursor:
+    """Walks (poi_id, value) rows ordered by poi_id, one POI at a time."""
+
+    def __init__(self, result):
+        self._rows = iter(result)
+        self._current = next(self._rows, None)
+
+    def take(self, poi_id):
+        values = []
+        # poi_id is the merge key: skip rows of POIs the main cursor has passed
+        while self._current is not None and self._current[0] < poi_id:
+            self._current = next(self._rows, None)
+        while self._current is not None and self._current[0] == poi_id:
+            values.append(self._current[1])
+            self._current = next(self._rows, None)
+        return values
+
+
+def iter_catalog(yield_per=1000):
+    """
+    Yield the denormalized catalog records.
+    Args:
+        yield_per (int): Rows fetched from the server-side cursors at a time.
+    Returns:
+        Generator of dict records, each with a "type" field.
+    """
+    with _snapshot_connection(yield_per) as connection:
+        with connection.begin():
+            for row in connection.execute(select(Country.id, Country.name, Country.img)
+                                          .order_by(Country.name)):
+                yield {'type': 'countries', 'id': row.id, 'name': row.name, 'img': row.img}
+
+            cities = select(City.id, City.name, City.season, City.country_id,
+                            Country.name.label('country_name'))\
+                .join(Country, City.country_id == Country.id).order_by(Country.name, City.name)
+            for row in connection.execute(cities):
+                yield {'type': 'cities', 'id': row.id, 'name': row.name, 'season': row.season,
+                       'country_id': row.country_id, 'country_name': row.country_name}
+
+            for row in connection.execute(select(Tag.id, Tag.name).order_by(Tag.name)):
+                yield {'type': 'tags', 'id': row.id, 'name': row.name}
+
+            tags = _GroupedCursor(connection.execute(
+                select(PoiTag.poi_id, Tag.name).join(Tag, PoiTag.tag_id == Tag.id)
+                .order_by(_by_id(PoiTag.poi_id, connection), Tag.name)))
+            images = _GroupedCursor(connection.execute(
+                select(PoiImage.poi_id, PoiImage.url).order_by(_by_id(PoiImage.poi_id, connection), PoiImage.id)))
+            pois = select(Poi.id, Poi.name, Poi.description, Poi.latitude, Poi.longitude,
+                          Poi.city_id, City.name.label('city_name'),
+                          Country.name.label('country_name'))\
+                .join(City, Poi.city_id == City.id)\
+                .join(Country, City.country_id == Country.id)\
+                .order_by(_by_id(Poi.id, connection))
+            for row in connection.execute(pois):
+                yield {
+                    'type': 'pois',
+                    'id': row.id,
+                    'name': row.name,
+                    'description': row.description,
+                    'latitude': row.latitude,
+                    'longitude': row.longitude,
+                    'city_id': row.city_id,
+                    'city_name': row.city_name,
+                    'country_name': row.country_name,
+                    'tags': tags.take(row.id),
+                    'poiimages': images.take(row.id),
+                }
+
+
+def _encoder():
+    dumps_bytes = getattr(current_app.json, 'dumps_bytes', None)
+    if dumps_bytes is not None:
+        return dumps_bytes
+    return lambda obj: json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def iter_export_chunks(compress=False, yield_per=1000):
+    """
+    Yield the NDJSON export as byte chunks of roughly CHUNK_BYTES.
+    Args:
+        compress (bool): Gzip the stream.
+        yield_per (int): Rows fetched from the server-side cursors at a time.
+    Returns:
+        Generator of bytes.
+    """
+    encode = _encoder()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer, size = [], 0
+    for record in iter_catalog(yield_per=yield_per):
+        line = encode(record) + b'\n'
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_BYTES:
+            chunk = b''.join(buffer)
+            buffer, size = [], 0
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    chunk = b''.join(buffer)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
@@ -0,0 +1,366 @@
+"""
+Streaming bulk import of catalog data (countries, cities, tags, POIs and POI
+images) from NDJSON or CSV files. Records are read one at a time, references
+are resolved through in-memory name -> id maps and rows are upserted in
+batches, so memory use does not grow with the size of the file. Records that
+cannot be imported are written to a rejects file instead of failing the run.
+
+Record fields follow the POST endpoints:
+    countries: name, img
+    cities:    name, season, country_name
+    tags:      name
+    pois:      name, description, latitude, longitude, country_name, city_name,
+               tags (optional list), poiimages (optional list of URLs)
+    images:    url and either poi_id or poi_name + city_name + country_name
+In CSV files list fields are separated by "|". NDJSON records may carry a
+"type" field (one of the kinds above) instead of passing a kind for the file.
+"""
+import csv
+import gzip
+import io
+import json
+import sys
+import time
+import uuid
+from sqlalchemy import tuple_, update
+from sqlalchemy.exc import IntegrityError
+from api.models import db, Country, City, Tag, Poi, PoiTag, PoiImage
+from api.change_feed import ENTITIES, log_changes
+
+KINDS = ('countries', 'cities', 'tags', 'pois', 'images')
+LIST_SEPARATOR = '|'
+
+REQUIRED_FIELDS = {
+    'countries': ['name', 'img'],
+    'cities': ['name', 'season', 'country_name'],
+    'tags': ['name'],
+    'pois': ['name', 'description', 'latitude', 'longitude', 'country_name', 'city_name'],
+    'images': ['url'],
+}
+
+
+class RecordError(Exception):
+    """Raised when a single record cannot be imported."""
+
+
+def open_text(path):
+    """Open a (optionally gzipped) text file, "-" reads standard input."""
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8', newline='')
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'csv' if name.endswith('.csv') else 'ndjson'
+
+
+def iter_records(stream, fmt):
+    """
+    Yield (line_number, record) pairs from an NDJSON or CSV stream.
+    Lines that are not valid JSON objects are yielded as RecordError instances.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, RecordError(f'Invalid JSON: {e}')
+            continue
+        if not isinstance(record, dict):
+            yield line_number, RecordError('Each line must be a JSON object')
+            continue
+        yield line_number, record
+
+
+def _as_list(value):
+    if value is None or value == '':
+        return []
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(LIST_SEPARATOR) if item.strip()]
+    if not isinstance(value, list) or not all(isinstance(item, str) and item for item in value):
+        raise RecordError('list fields must be lists of non-empty strings')
+    return value
+
+
+class ImportStats:
+    """Counters of an import run."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.processed = 0
+        self.inserted = 0
+        self.updated = 0
+        self.rejected = 0
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rate(self):
+        return self.processed / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self):
+        return {'processed': self.processed, 'inserted': self.inserted,
+                'updated': self.updated, 'rejected': self.rejected,
+                'elapsed': round(self.elapsed, 3), 'records_per_sec': round(self.rate, 1)}
+
+
+class CatalogImporter:
+    """
+    Imports catalog records in batches inside the current app context.
+    Args:
+        batch_size (int): Records written (and committed) together.
+        rejects: Writable text stream receiving one JSON line per rejected record.
+    """
+
+    def __init__(self, batch_size=1000, rejects=None):
+        self.batch_size = batch_size
+        self.rejects = rejects
+        self.stats = ImportStats()
+        self._load_maps()
+
+    def _load_maps(self):
+        self.country_ids = dict(db.session.query(Country.name, Country.id))
+        self.city_ids = {(country_id, name): city_id for city_id, name, country_id
+                         in db.session.query(City.id, City.name, City.country_id)}
+        self.tag_ids = dict(db.session.query(Tag.name, Tag.id))
+
+    def reject(self, line_number, record, error):
+        self.stats.rejected += 1
+        if self.rejects is not None:
+            self.rejects.write(json.dumps({'line': line_number, 'error': str(error),
+                                           'record': record}, default=str) + '\n')
+
+    def run(self, records, kind=None, progress=None):
+        """
+        Import a stream of (line_number, record) pairs.
+        Args:
+            records: Iterable as produced by iter_records().
+            kind (str, optional): Kind of every record, otherwise read from each record's "type".
+            progress (callable, optional): Called with the ImportStats after every batch.
+        Returns:
+            ImportStats: Counters of the run.
+        """
+        batches = {k: [] for k in KINDS}
+        for line_number, record in records:
+            self.stats.processed += 1
+            if isinstance(record, RecordError):
+                self.reject(line_number, None, record)
+                continue
+            record_kind = kind or record.pop('type', None)
+            if record_kind not in KINDS:
+                self.reject(line_number, record, f'Unknown record type: {record_kind}')
+                continue
+            batch = batches[record_kind]
+            batch.append((line_number, record))
+            if len(batch) >= self.batch_size:
+                # pending parents go first so this batch can resolve its references
+                for pending_kind in KINDS[:KINDS.index(record_kind) + 1]:
+                    if batches[pending_kind]:
+                        self.flush(pending_kind, batches[pending_kind])
+                        batches[pending_kind] = []
+                if progress:
+                    progress(self.stats)
+        # parents before children so mixed files resolve their references
+        for record_kind in KINDS:
+            if batches[record_kind]:
+                self.flush(record_kind, batches[record_kind])
+        if progress:
+            progress(self.stats)
+        return self.stats
+
+    def flush(self, kind, batch):
+        """Validate and write one batch, retrying row by row if the batch write fails."""
+        prepare = getattr(self, f'_prepare_{kind}')
+        valid = []
+        for line_number, record in batch:
+            try:
+                missing = [f for f in REQUIRED_FIELDS[kind]
+                           if record.get(f) is None or record.get(f) == '']
+                if missing:
+                    raise RecordError(f"Missing fields: {', '.join(missing)}")
+                valid.append((line_number, record, prepare(record)))
+            except RecordError as e:
+                self.reject(line_number, record, e)
+        if not valid:
+            return
+        write = getattr(self, f'_write_{kind}')
+        counters = (self.stats.inserted, self.stats.updated)
+        try:
+            write([item[2] for item in valid])
+            db.session.commit()
+        except (IntegrityError, RecordError):
+            db.session.rollback()
+            self.stats.inserted, self.stats.updated = counters
+            self._load_maps()
+            for line_number, record, _ in valid:
+                try:
+                    write([prepare(record)])
+                    db.session.commit()
+                except (IntegrityError, RecordError) as e:
+                    db.session.rollback()
+                    self._load_maps()
+                    self.reject(line_number, record, getattr(e, 'orig', e))
+
+    def _country_id(self, name):
+        country_id = self.country_ids.get(name)
+        if not country_id:
+            raise RecordError(f"Country '{name}' not found")
+        return country_id
+
+    def _city_id(self, country_name, city_name):
+        city_id = self.city_ids.get((self._country_id(country_name), city_name))
+        if not city_id:
+            raise RecordError(
+                f"City '{city_name}' in country '{country_name}' not found")
+        return city_id
+
+    def _upsert(self, model, rows, existing_ids):
+        """Insert rows without an existing id and update the others by primary key."""
+        inserts, updates = [], []
+        for row in rows:
+            existing_id = existing_ids(row)
+            if existing_id:
+                row['id'] = existing_id
+                updates.append(row)
+            else:
+                row['id'] = str(uuid.uuid4())
+                inserts.append(row)
+        if inserts:
+            db.session.execute(model.__table__.insert(), inserts)
+        if updates:
+            db.session.execute(update(model), updates)
+        log_changes(db.session, ENTITIES[model], [row['id'] for row in rows], 'upsert')
+        self.stats.inserted += len(inserts)
+        self.stats.updated += len(updates)
+        return rows
+
+    def _prepare_countries(self, record):
+        return {'name': record['name'], 'img': record['img']}
+
+    def _write_countries(self, rows):
+        rows = list({row['name']: row for row in rows}.values())
+        for row in self._upsert(Country, rows, lambda r: self.country_ids.get(r['name'])):
+            self.country_ids[row['name']] = row['id']
+
+    def _prepare_cities(self, record):
+        return {'name': record['name'], 'season': record['season'],
+                'country_id': self._country_id(record['country_name'])}
+
+    def _write_cities(self, rows):
+        rows = list({(row['country_id'], row['name']): row for row in rows}.values())
+        saved = self._upsert(City, rows, lambda r: self.city_ids.get((r['country_id'], r['name'])))
+        for row in saved:
+            self.city_ids[(row['country_id'], row['name'])] = row['id']
+
+    def _prepare_tags(self, record):
+        return {'name': record['name']}
+
+    def _write_tags(self, rows):
+        rows = list({row['name']: row for row in rows}.values())
+        for row in self._upsert(Tag, rows, lambda r: self.tag_ids.get(r['name'])):
+            self.tag_ids[row['name']] = row['id']
+
+    def _prepare_pois(self, record):
+        try:
+            latitude = float(record['latitude'])
+            longitude = float(record['longitude'])
+        except (TypeError, ValueError):
+            raise RecordError('latitude/longitude must be numeric')
+        tag_ids = []
+        for tag_name in _as_list(record.get('tags')):
+            tag_id = self.tag_ids.get(tag_name)
+            if not tag_id:
+                raise RecordError(f"Tag '{tag_name}' not found")
+            tag_ids.append(tag_id)
+        return {
+            'name': record['name'],
+            'description': record['description'],
+            'latitude': latitude,
+            'longitude': longitude,
+            'city_id': self._city_id(record['country_name'], record['city_name']),
+            '_tag_ids': tag_ids,
+            '_images': _as_list(record.get('poiimages')),
+        }
+
+    def _existing_poi_ids(self, keys):
+        if not keys:
+            return {}
+        query = db.session.query(Poi.id, Poi.name, Poi.city_id).filter(
+            tuple_(Poi.name, Poi.city_id).in_(list(keys)))
+        return {(name, city_id): poi_id for poi_id, name, city_id in query}
+
+    def _write_pois(self, rows):
+        rows = list({(row['name'], row['city_id']): row for row in rows}.values())
+        existing = self._existing_poi_ids({(row['name'], row['city_id']) for row in rows})
+        children = [(row.pop('_tag_ids'), row.pop('_images')) for row in rows]
+        self._upsert(Poi, rows, lambda r: existing.get((r['name'], r['city_id'])))
+        poi_tags, images = [], []
+        for row, (tag_ids, urls) in zip(rows, children):
+            poi_tags.extend((row['id'], tag_id) for tag_id in tag_ids)
+            images.extend((row['id'], url) for url in urls)
+        self._add_poi_tags(poi_tags)
+        self._add_images(images)
+
+    def _add_poi_tags(self, pairs):
+        """Create the (poi_id, tag_id) associations that do not exist yet."""
+        pairs = set(pairs)
+        if not pairs:
+            return
+        existing = set(db.session.query(PoiTag.poi_id, PoiTag.tag_id).filter(
+            tuple_(PoiTag.poi_id, PoiTag.tag_id).in_(list(pairs))))
+        rows = [{'poi_id': poi_id, 'tag_id': tag_id} for poi_id, tag_id in pairs - existing]
+        if rows:
+            db.session.execute(PoiTag.__table__.insert(), rows)
+            log_changes(db.session, 'poi_tags',
+                        [f"{row['poi_id']}:{row['tag_id']}" for row in rows], 'upsert')
+
+    def _add_images(self, pairs):
+        """Create the (poi_id, url) images that do not exist yet."""
+        pairs = set(pairs)
+        if not pairs:
+            return
+        existing = set(db.session.query(PoiImage.poi_id, PoiImage.url).filter(
+            tuple_(PoiImage.poi_id, PoiImage.url).in_(list(pairs))))
+        rows = [{'id': str(uuid.uuid4()), 'poi_id': poi_id, 'url': url}
+                for poi_id, url in pairs - existing]
+        if rows:
+            db.session.execute(PoiImage.__table__.insert(), rows)
+            log_changes(db.session, 'images', [row['id'] for row in rows], 'upsert')
+        return len(rows)
+
+    def _prepare_images(self, record):
+        if record.get('poi_id'):
+            return {'url': record['url'], 'poi_id': record['poi_id']}
+        missing = [f for f in ('poi_name', 'city_name', 'country_name') if not record.get(f)]
+        if missing:
+            raise RecordError(f"Missing fields: poi_id or {', '.join(missing)}")
+        return {'url': record['url'], 'poi_key': (
+            record['poi_name'], self._city_id(record['country_name'], record['city_name']))}
+
+    def _write_images(self, rows):
+        existing = self._existing_poi_ids({row['poi_key'] for row in rows if 'poi_key' in row})
+        ids = {row['poi_id'] for row in rows if 'poi_id' in row}
+        known_ids = {poi_id for (poi_id,) in db.session.query(Poi.id).filter(
+            Poi.id.in_(list(ids)))} if ids else set()
+        known_ids.update(existing.values())
+        pairs = []
+        for row in rows:
+            poi_id = row.get('poi_id') or existing.get(row['poi_key'])
+            if poi_id not in known_ids:
+                # fails the batch, the row by row retry rejects just this record
+                raise RecordError('POI not found')
+            pairs.append((poi_id, row['url']))
+        inserted = self._add_images(pairs) or 0
+        self.stats.inserted += inserted
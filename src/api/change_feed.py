@@ -0,0 +1,228 @@
+"""
+Change feed of the catalog for incremental client sync.
+
+Every create, update or delete of a Country, City, Poi, Tag, PoiImage or PoiTag
+appends a row to change_log in the same transaction, numbered by a
+monotonically increasing sequence. ORM writes are picked up when the session
+flushes. The ids of the rows the database removes through ON DELETE CASCADE are
+read before the parent goes away, and bulk writers that bypass the ORM call
+log_changes() themselves.
+
+The entries are kept in the session until it commits and only then inserted,
+right before the COMMIT (the ones of flushes undone by rolling back a
+savepoint are dropped). On Postgres that insert takes a transaction level
+advisory lock, so sequence numbers become visible in commit order and a client
+that reads since=<seq> never misses a change committed late with a lower
+number, while writers only wait for each other during their final insert and
+commit instead of for their whole transaction.
+"""
+from sqlalchemy import event, func, select, text, tuple_
+from api.models import db, ChangeLog, Country, City, Tag, Poi, PoiImage, PoiTag
+
+ENTITIES = {
+    Country: 'countries',
+    City: 'cities',
+    Tag: 'tags',
+    Poi: 'pois',
+    PoiImage: 'images',
+    PoiTag: 'poi_tags',
+}
+CHANGE_LOCK_KEY = 7336020
+MAX_LIMIT = 1000
+PENDING_KEY = 'change_feed_pending'
+SAVEPOINTS_KEY = 'change_feed_savepoints'
+
+
+def _entity_id(obj):
+    if isinstance(obj, PoiTag):
+        return f'{obj.poi_id}:{obj.tag_id}'
+    return obj.id
+
+
+def _poi_tag_id():
+    return (PoiTag.poi_id + ':' + PoiTag.tag_id).label('id')
+
+
+def _lock(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'),
+                           {'key': CHANGE_LOCK_KEY})
+
+
+def log_changes(session, entity, ids, op):
+    """
+    Add change feed entries to the current transaction, recorded when it commits.
+    Args:
+        session (Session): Session of the transaction that made the change.
+        entity (str): Entity name, one of the ENTITIES values.
+        ids (iterable): Ids of the changed rows ("<poi_id>:<tag_id>" for poi_tags).
+        op (str): 'upsert' or 'delete'.
+    """
+    session.info.setdefault(PENDING_KEY, []).extend(
+        {'entity': entity, 'entity_id': entity_id, 'op': op} for entity_id in ids)
+
+
+def _cascaded_deletes(model, ids):
+    """(entity, select of ids) of the rows ON DELETE CASCADE removes with these parents."""
+    if model is Tag:
+        return [('poi_tags', select(_poi_tag_id()).where(PoiTag.tag_id.in_(ids)))]
+    if model is Country:
+        poi_ids = select(Poi.id).join(City, Poi.city_id == City.id)\
+            .where(City.country_id.in_(ids))
+        selects = [('cities', select(City.id.label('id')).where(City.country_id.in_(ids))),
+                   ('pois', poi_ids)]
+    elif model is City:
+        poi_ids = select(Poi.id).where(Poi.city_id.in_(ids))
+        selects = [('pois', poi_ids)]
+    elif model is Poi:
+        poi_ids = ids
+        selects = []
+    else:
+        return []
+    selects.append(('images', select(PoiImage.id.label('id')).where(PoiImage.poi_id.in_(poi_ids))))
+    selects.append(('poi_tags', select(_poi_tag_id()).where(PoiTag.poi_id.in_(poi_ids))))
+    return selects
+
+
+def _log_deletes(session, flush_context, instances):
+    deleted = {}
+    for obj in session.deleted:
+        if type(obj) in ENTITIES:
+            deleted.setdefault(type(obj), []).append(_entity_id(obj))
+    if not deleted:
+        return
+    connection = session.connection()
+    for model, ids in deleted.items():
+        log_changes(session, ENTITIES[model], ids, 'delete')
+        # the database deletes these rows itself, log them while they still exist
+        for entity, id_select in _cascaded_deletes(model, ids):
+            log_changes(session, entity, connection.execute(id_select).scalars(), 'delete')
+
+
+def _log_upserts(session, flush_context):
+    changed = {}
+    for obj in session.new:
+        if type(obj) in ENTITIES:
+            changed.setdefault(ENTITIES[type(obj)], []).append(_entity_id(obj))
+    for obj in session.dirty:
+        if type(obj) in ENTITIES and session.is_modified(obj, include_collections=False):
+            changed.setdefault(ENTITIES[type(obj)], []).append(_entity_id(obj))
+    for entity, ids in changed.items():
+        log_changes(session, entity, ids, 'upsert')
+
+
+def _record_pending(session):
+    if session.in_nested_transaction():
+        return
+    # the last writes of the transaction, then nothing is left for commit() to flush
+    session.flush()
+    rows = session.info.pop(PENDING_KEY, None)
+    session.info.pop(SAVEPOINTS_KEY, None)
+    if rows:
+        connection = session.connection()
+        _lock(connection)
+        connection.execute(ChangeLog.__table__.insert(), rows)
+
+
+def _mark_savepoint(session, transaction):
+    if transaction.nested:
+        session.info.setdefault(SAVEPOINTS_KEY, {})[transaction] = len(session.info.get(PENDING_KEY, ()))
+
+
+def _discard_pending(session, previous_transaction):
+    if previous_transaction.nested:
+        # only the entries of the flushes undone with the savepoint
+        pending = session.info.get(PENDING_KEY)
+        start = session.info.get(SAVEPOINTS_KEY, {}).get(previous_transaction)
+        if pending is not None and start is not None:
+            del pending[start:]
+    elif not session.in_transaction():
+        session.info.pop(PENDING_KEY, None)
+        session.info.pop(SAVEPOINTS_KEY, None)
+
+
+_listeners_installed = False
+
+
+def setup_change_feed(app):
+    """
+    Record catalog changes made through the database session.
+    Args:
+        app (Flask): The application (the listeners are shared by all apps).
+    """
+    global _listeners_installed
+    if not _listeners_installed:
+        event.listen(db.session, 'before_flush', _log_deletes)
+        event.listen(db.session, 'after_flush', _log_upserts)
+        event.listen(db.session, 'before_commit', _record_pending)
+        event.listen(db.session, 'after_transaction_create', _mark_savepoint)
+        event.listen(db.session, 'after_soft_rollback', _discard_pending)
+        _listeners_installed = True
+
+
+MODELS = {entity: model for model, entity in ENTITIES.items()}
+
+
+def _payloads(entity, ids):
+    """Current serialized rows of one entity by id, in a constant number of queries."""
+    if entity == 'poi_tags':
+        pairs = [tuple(entity_id.split(':', 1)) for entity_id in ids]
+        rows = db.session.execute(select(PoiTag.poi_id, PoiTag.tag_id).where(
+            tuple_(PoiTag.poi_id, PoiTag.tag_id).in_(pairs)))
+        return {f'{poi_id}:{tag_id}': {'poi_id': poi_id, 'tag_id': tag_id}
+                for poi_id, tag_id in rows}
+    model = MODELS[entity]
+    options = model.serialize_options() if hasattr(model, 'serialize_options') else ()
+    objs = db.session.scalars(select(model).where(model.id.in_(ids)).options(*options))
+    return {obj.id: obj.serialize() for obj in objs}
+
+
+def current_seq():
+    """Sequence number of the latest recorded change (0 when there is none)."""
+    return db.session.scalar(select(func.max(ChangeLog.seq))) or 0
+
+
+def changes_since(since, limit):
+    """
+    Read the changes recorded after a sequence number.
+    Only the latest entry of each row is returned and upserts carry the current
+    payload of the row, or are reported as deletes when it no longer exists.
+    Args:
+        since (int): Sequence number of the last change the client applied.
+        limit (int): Maximum number of change log entries to read.
+    Returns:
+        dict: changes, next_since (cursor for the next call) and has_more.
+    """
+    entries = db.session.execute(
+        select(ChangeLog.seq, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.op)
+        .where(ChangeLog.seq > since).order_by(ChangeLog.seq).limit(limit + 1)).all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    latest = {}
+    for entry in entries:
+        key = (entry.entity, entry.entity_id)
+        latest.pop(key, None)
+        latest[key] = entry
+
+    upserts = {}
+    for entity, entity_id in latest:
+        if latest[(entity, entity_id)].op == 'upsert':
+            upserts.setdefault(entity, []).append(entity_id)
+    payloads = {entity: _payloads(entity, ids) for entity, ids in upserts.items()}
+
+    changes = []
+    for (entity, entity_id), entry in latest.items():
+        change = {'seq': entry.seq, 'type': entity, 'id': entity_id, 'op': entry.op}
+        if entry.op == 'upsert':
+            data = payloads[entity].get(entity_id)
+            if data is None:
+                change['op'] = 'delete'
+            else:
+                change['data'] = data
+        changes.append(change)
+    return {
+        'changes': changes,
+        'next_since': entries[-1].seq if entries else since,
+        'has_more': has_more,
+    }
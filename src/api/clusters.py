@@ -0,0 +1,219 @@
+"""
+Server-side clustering of POIs for zoomed-out map views.
+
+POIs are bucketed into a hierarchical Web Mercator grid: at map zoom z the
+world is 2^(z + CELL_BITS) cells wide, so a 256 px tile holds 4 x 4 cells of
+64 px, and every cell splits into 4 cells at z + 1. poi_cluster_cell stores
+the number of POIs and the sum of their coordinates for the non-empty cells
+of zooms 0 to MAX_CLUSTER_ZOOM, so a viewport is one primary key range scan
+however many POIs it covers. Cells with at most EXPAND_MAX_POIS POIs are
+returned as the POIs themselves.
+
+The cells are maintained in the same transaction as the POI writes (new,
+moved and deleted POIs, including the ones ON DELETE CASCADE removes with
+their city or country). Bulk loaders bypass the session and call
+rebuild_cluster_cells() afterwards, which is also `flask rebuild-clusters`.
+"""
+import numpy as np
+from sqlalchemy import and_, delete, event, inspect, or_, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from api.models import db, City, Country, Poi, PoiClusterCell
+from api.geo import tile_bounds, tile_xy
+
+CELL_BITS = 2
+MAX_CLUSTER_ZOOM = 16
+GRID_SIZE = 1 << (MAX_CLUSTER_ZOOM + CELL_BITS)
+EXPAND_MAX_POIS = 4
+MAX_VIEWPORT_CELLS = 4096
+WRITE_BATCH = 10000
+EXPAND_BATCH = 100
+
+
+def grid_position(latitudes, longitudes):
+    """
+    Cells of points in the grid of MAX_CLUSTER_ZOOM.
+    Args:
+        latitudes, longitudes (array-like): Coordinates in degrees.
+    Returns:
+        tuple: x and y integer arrays (the cell at zoom z is x >> (MAX_CLUSTER_ZOOM - z)).
+    """
+    return tile_xy(latitudes, longitudes, MAX_CLUSTER_ZOOM + CELL_BITS)
+
+
+def _cell_sums(latitudes, longitudes, signs):
+    """Yield (zoom, x, y, poi_count, latitude_sum, longitude_sum) of every cell holding the points."""
+    lat = np.asarray(latitudes, dtype=np.float64)
+    lon = np.asarray(longitudes, dtype=np.float64)
+    signs = np.asarray(signs, dtype=np.float64)
+    x, y = grid_position(lat, lon)
+    for zoom in range(MAX_CLUSTER_ZOOM + 1):
+        shift = MAX_CLUSTER_ZOOM - zoom
+        keys, inverse = np.unique(((x >> shift) << 32) | (y >> shift), return_inverse=True)
+        counts = np.bincount(inverse, weights=signs)
+        lat_sums = np.bincount(inverse, weights=signs * lat)
+        lon_sums = np.bincount(inverse, weights=signs * lon)
+        for key, n, lat_sum, lon_sum in zip(keys.tolist(), counts.tolist(),
+                                             lat_sums.tolist(), lon_sums.tolist()):
+            yield zoom, key >> 32, key & 0xFFFFFFFF, int(round(n)), lat_sum, lon_sum
+
+
+def _update_cluster_cells(session, flush_context, instances):
+    stored, added = set(), {}
+    removed_places = {Country: set(), City: set()}
+    for obj in session.deleted:
+        if isinstance(obj, Poi):
+            stored.add(obj.id)
+        elif isinstance(obj, (Country, City)):
+            removed_places[type(obj)].add(obj.id)
+    for obj in session.new:
+        if isinstance(obj, Poi):
+            added[obj.id] = (obj.latitude, obj.longitude)
+    for obj in session.dirty:
+        if isinstance(obj, Poi) and obj not in session.deleted:
+            attrs = inspect(obj).attrs
+            if attrs.latitude.history.has_changes() or attrs.longitude.history.has_changes():
+                stored.add(obj.id)
+                added[obj.id] = (obj.latitude, obj.longitude)
+    if not (stored or added or removed_places[Country] or removed_places[City]):
+        return
+    connection = session.connection()
+
+    # the previous coordinates are read back, expired attributes have no history
+    removed = {}
+    if stored:
+        removed.update((poi_id, (lat, lon)) for poi_id, lat, lon in connection.execute(
+            select(Poi.id, Poi.latitude, Poi.longitude).where(Poi.id.in_(stored))))
+    if removed_places[Country] or removed_places[City]:
+        in_countries = select(City.id).where(City.country_id.in_(removed_places[Country]))
+        for poi_id, lat, lon in connection.execute(
+                select(Poi.id, Poi.latitude, Poi.longitude).where(
+                    or_(Poi.city_id.in_(removed_places[City]), Poi.city_id.in_(in_countries)))):
+            removed[poi_id] = (lat, lon)
+            added.pop(poi_id, None)
+
+    points = [(point, -1) for point in removed.values()] + [(point, 1) for point in added.values()]
+    if not points:
+        return
+    rows, emptied = [], []
+    for zoom, x, y, n, lat_sum, lon_sum in _cell_sums(
+            [lat for (lat, _), _ in points], [lon for (_, lon), _ in points],
+            [sign for _, sign in points]):
+        if n or lat_sum or lon_sum:
+            rows.append({'zoom': zoom, 'x': x, 'y': y, 'poi_count': n,
+                         'latitude_sum': lat_sum, 'longitude_sum': lon_sum})
+        if n < 0:
+            emptied.append((zoom, x, y))
+    if rows:
+        insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+        stmt = insert(PoiClusterCell)
+        table = PoiClusterCell.__table__
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=['zoom', 'x', 'y'],
+            set_={column: table.c[column] + stmt.excluded[column]
+                  for column in ('poi_count', 'latitude_sum', 'longitude_sum')}), rows)
+    key = tuple_(PoiClusterCell.zoom, PoiClusterCell.x, PoiClusterCell.y)
+    for start in range(0, len(emptied), 500):
+        connection.execute(delete(PoiClusterCell).where(
+            key.in_(emptied[start:start + 500]), PoiClusterCell.poi_count <= 0))
+
+
+def rebuild_cluster_cells(connection):
+    """
+    Recompute the clustering grid from the coordinates of every POI.
+    Args:
+        connection (Connection): Connection of the transaction to rebuild in.
+    """
+    connection.execute(delete(PoiClusterCell))
+    points = np.array(connection.execute(select(Poi.latitude, Poi.longitude)).all(),
+                      dtype=np.float64).reshape(-1, 2)
+    if not len(points):
+        return
+    batch = []
+    for zoom, x, y, n, lat_sum, lon_sum in _cell_sums(points[:, 0], points[:, 1], np.ones(len(points))):
+        batch.append({'zoom': zoom, 'x': x, 'y': y, 'poi_count': n,
+                      'latitude_sum': lat_sum, 'longitude_sum': lon_sum})
+        if len(batch) >= WRITE_BATCH:
+            connection.execute(PoiClusterCell.__table__.insert(), batch)
+            batch = []
+    if batch:
+        connection.execute(PoiClusterCell.__table__.insert(), batch)
+
+
+def _cell_bounds(zoom, x, y):
+    """(south, west, north, east) of a cell, padded so points on its edges are not missed."""
+    south, west, north, east = tile_bounds(zoom + CELL_BITS, x, y)
+    pad = 1e-9
+    return south - pad, west - pad, north + pad, east + pad
+
+
+def _expand(zoom, cells):
+    """Yield the POIs of the given (x, y) cells of a zoom level."""
+    shift = MAX_CLUSTER_ZOOM - zoom
+    wanted = set(cells)
+    for start in range(0, len(cells), EXPAND_BATCH):
+        boxes = []
+        for x, y in cells[start:start + EXPAND_BATCH]:
+            south, west, north, east = _cell_bounds(zoom, x, y)
+            boxes.append(and_(Poi.latitude.between(south, north), Poi.longitude.between(west, east)))
+        rows = db.session.execute(select(Poi.id, Poi.name, Poi.latitude, Poi.longitude)
+                                  .where(or_(*boxes))).all()
+        if not rows:
+            continue
+        xs, ys = grid_position([row.latitude for row in rows], [row.longitude for row in rows])
+        for row, x, y in zip(rows, (xs >> shift).tolist(), (ys >> shift).tolist()):
+            if (x, y) in wanted:
+                yield {'id': row.id, 'name': row.name,
+                       'latitude': row.latitude, 'longitude': row.longitude}
+
+
+def get_clusters(zoom, west, south, east, north):
+    """
+    Cluster the POIs of a map viewport.
+    Args:
+        zoom (int): Map zoom level; levels above MAX_CLUSTER_ZOOM use its grid.
+        west, south, east, north (float): Viewport in degrees. west > east crosses the antimeridian.
+    Raises:
+        ValueError: If the viewport covers more than MAX_VIEWPORT_CELLS cells at this zoom.
+    Returns:
+        dict: clusters (latitude and longitude of the centroid, count) and pois
+            (id, name, latitude, longitude) for the cells with few POIs.
+    """
+    zoom = min(zoom, MAX_CLUSTER_ZOOM)
+    shift = MAX_CLUSTER_ZOOM - zoom
+    (x_west, x_east), (y_north, y_south) = (
+        (v >> shift).tolist() for v in grid_position([north, south], [west, east]))
+    x_ranges = [(x_west, x_east)] if west <= east else \
+        [(x_west, (GRID_SIZE >> shift) - 1), (0, x_east)]
+    cells = sum(x1 - x0 + 1 for x0, x1 in x_ranges) * (y_south - y_north + 1)
+    if cells > MAX_VIEWPORT_CELLS:
+        raise ValueError(f'The viewport covers {cells} cells at zoom {zoom}, '
+                         f'at most {MAX_VIEWPORT_CELLS} are allowed')
+
+    rows = db.session.execute(select(PoiClusterCell).where(
+        PoiClusterCell.zoom == zoom, PoiClusterCell.y.between(y_north, y_south),
+        or_(*[PoiClusterCell.x.between(x0, x1) for x0, x1 in x_ranges]),
+        PoiClusterCell.poi_count > 0).order_by(PoiClusterCell.y, PoiClusterCell.x)).scalars()
+    clusters, small = [], []
+    for cell in rows:
+        if cell.poi_count <= EXPAND_MAX_POIS:
+            small.append((cell.x, cell.y))
+        else:
+            clusters.append({'latitude': round(cell.latitude_sum / cell.poi_count, 6),
+                             'longitude': round(cell.longitude_sum / cell.poi_count, 6),
+                             'count': cell.poi_count})
+    return {'clusters': clusters, 'pois': list(_expand(zoom, small))}
+
+
+_listeners_installed = False
+
+
+def setup_clusters(app):
+    """
+    Keep the clustering grid up to date on POI writes made through the session.
+    Args:
+        app (Flask): The application (the listener is shared by all apps).
+    """
+    global _listeners_installed
+    if not _listeners_installed:
+        event.listen(db.session, 'before_flush', _update_cluster_cells)
+        _listeners_installed = True
@@ -1,15 +1,44 @@
-
 import click
+import sys
+import time
+import uuid
+from datetime import datetime
+from werkzeug.security import generate_password_hash
 from api.models import db, User
+from api.seed import CatalogSpec, seed_catalog
+from api.catalog_import import KINDS, CatalogImporter, detect_format, iter_records, open_text
+from api.catalog_export import iter_export_chunks
+from api.place_stats import check_place_stats, rebuild_place_stats
+from api.similarity import SCOPES, METRICS, build_similarity_index
+from api.recommendations import FAVORITE_WEIGHT, build_recommendations
+from api.clusters import rebuild_cluster_cells
+from api.tiles import clear_tile_cache
+
+
+def rebuild_stats():
+    """Recompute the per city and per country statistics after a bulk write."""
+    started = time.perf_counter()
+    rebuild_place_stats(db.session.connection())
+    db.session.commit()
+    print(f"Place statistics rebuilt in {time.perf_counter() - started:.1f}s")
+
+
+def rebuild_clusters():
+    """Recompute the map clustering grid after a bulk write."""
+    started = time.perf_counter()
+    rebuild_cluster_cells(db.session.connection())
+    db.session.commit()
+    print(f"Map clusters rebuilt in {time.perf_counter() - started:.1f}s")
+
 
 """
 In this file, you can add as many commands as you want using the @app.cli.command decorator
-Flask commands are usefull to run cronjobs or tasks outside of the API but sill in integration 
+Flask commands are usefull to run cronjobs or tasks outside of the API but sill in integration
 with youy database, for example: Import the price of bitcoin every night as 12am
 """
 def setup_commands(app):
-    
-    """ 
+
+    """
     This is an example command "insert-test-users" that you can run from the command line
     by typing: $ flask insert-test-users 5
     Note: 5 is the number of users to add
@@ -18,18 +47,238 @@ def setup_commands(app):
     @click.argument("count") # argument of out command
     def insert_test_users(count):
         print("Creating test users")
+        password = generate_password_hash("123456")
+        users = []
         for x in range(1, int(count) + 1):
             user = User()
+            user.id = str(uuid.uuid4())
+            user.name = "Test User " + str(x)
+            user.user_name = "test_user" + str(x)
             user.email = "test_user" + str(x) + "@test.com"
-            user.password = "123456"
-            user.is_active = True
-            db.session.add(user)
-            db.session.commit()
+            user.password = password
+            user.birth_date = datetime(1990, 1, 1)
+            users.append(user)
             print("User: ", user.email, " created.")
 
+        db.session.add_all(users)
+        db.session.commit()
         print("All test users created")
 
+    """
+    Generate a synthetic catalog for local performance work, for example:
+    $ flask insert-test-data --countries 50 --cities-per-country 100 --pois-per-city 200
+    builds 1M POIs with their tags, images, users, favorites and visits.
+    """
     @app.cli.command("insert-test-data")
-    def insert_test_data():
-        pass
-    
\ No newline at end of file
+    @click.option("--countries", default=5, show_default=True)
+    @click.option("--cities-per-country", default=10, show_default=True)
+    @click.option("--pois-per-city", default=20, show_default=True)
+    @click.option("--tags", default=20, show_default=True, help="Number of distinct tags.")
+    @click.option("--tags-per-poi", default=3.0, show_default=True, help="Mean tags per POI (Poisson).")
+    @click.option("--tag-skew", default=1.0, show_default=True, help="Zipf exponent of tag popularity.")
+    @click.option("--images-per-poi", default=2.0, show_default=True, help="Mean images per POI (Poisson).")
+    @click.option("--users", default=50, show_default=True)
+    @click.option("--favorites-per-user", default=10, show_default=True, help="Mean favorites per user.")
+    @click.option("--visited-per-user", default=10, show_default=True, help="Mean visited POIs per user.")
+    @click.option("--popularity-skew", default=1.2, show_default=True,
+                  help="Power-law exponent of POI popularity for favorites/visits (0 = uniform).")
+    @click.option("--seed", default=42, show_default=True)
+    @click.option("--batch-size", default=10000, show_default=True)
+    @click.option("--copy/--no-copy", "use_copy", default=None,
+                  help="Load with COPY (default: on for Postgres).")
+    def insert_test_data(countries, cities_per_country, pois_per_city, tags, tags_per_poi,
+                         tag_skew, images_per_poi, users, favorites_per_user,
+                         visited_per_user, popularity_skew, seed, batch_size, use_copy):
+        spec = CatalogSpec(countries=countries, cities_per_country=cities_per_country,
+                           pois_per_city=pois_per_city, tags=tags, tags_per_poi=tags_per_poi,
+                           images_per_poi=images_per_poi, users=users,
+                           favorites_per_user=favorites_per_user,
+                           visited_per_user=visited_per_user, tag_skew=tag_skew,
+                           popularity_skew=popularity_skew, seed=seed)
+        print(f"Generating {spec.total_pois} POIs and {users} users")
+        report_every = max(1, 100000 // max(1, pois_per_city))
+        progress_state = {'cities': 0}
+
+        def progress(writer):
+            progress_state['cities'] += 1
+            if progress_state['cities'] % report_every == 0:
+                print(f"  {writer.total_rows} rows, {writer.total_rows / writer.elapsed:.0f} rows/sec")
+
+        result = seed_catalog(spec, batch_size=batch_size, use_copy=use_copy, progress=progress)
+        elapsed = result['elapsed']
+        total = sum(result['rows'].values())
+        for table, count in result['rows'].items():
+            print(f"  {table}: {count}")
+        print(f"Inserted {total} rows in {elapsed:.1f}s ({total / elapsed:.0f} rows/sec)")
+        rebuild_stats()
+        rebuild_clusters()
+        clear_tile_cache(app.config['TILE_CACHE_DIR'])
+
+    """
+    Stream a catalog dump into the database, for example:
+    $ flask import-catalog pois.ndjson.gz --kind pois --batch-size 5000
+    Rejected records are written to <file>.rejects.ndjson with the reason.
+    """
+    @app.cli.command("import-catalog")
+    @click.argument("path")
+    @click.option("--kind", type=click.Choice(KINDS),
+                  help="Kind of every record (default: each NDJSON record's \"type\").")
+    @click.option("--format", "fmt", type=click.Choice(["ndjson", "csv"]),
+                  help="File format (default: from the file extension).")
+    @click.option("--batch-size", default=1000, show_default=True)
+    @click.option("--rejects", "rejects_path", help="Rejects file (default: <path>.rejects.ndjson).")
+    def import_catalog(path, kind, fmt, batch_size, rejects_path):
+        fmt = fmt or detect_format(path)
+        if fmt == "csv" and not kind:
+            raise click.UsageError("--kind is required for CSV files")
+        rejects_path = rejects_path or ("import" if path == "-" else path) + ".rejects.ndjson"
+
+        def progress(stats):
+            print(f"  {stats.processed} records, {stats.rate:.0f} records/sec, {stats.rejected} rejected")
+
+        with open_text(path) as stream, open(rejects_path, "w", encoding="utf-8") as rejects:
+            importer = CatalogImporter(batch_size=batch_size, rejects=rejects)
+            stats = importer.run(iter_records(stream, fmt), kind=kind, progress=progress)
+
+        print(f"Imported {stats.processed} records in {stats.elapsed:.1f}s "
+              f"({stats.rate:.0f} records/sec): {stats.inserted} inserted, "
+              f"{stats.updated} updated, {stats.rejected} rejected")
+        if stats.rejected:
+            print(f"Rejected records written to {rejects_path}")
+        rebuild_stats()
+        rebuild_clusters()
+        clear_tile_cache(app.config['TILE_CACHE_DIR'])
+
+    """
+    Write the whole catalog as NDJSON (gzipped when the path ends with .gz), for example:
+    $ flask export-catalog catalog.ndjson.gz
+    The output can be loaded again with import-catalog.
+    """
+    @app.cli.command("export-catalog")
+    @click.argument("path")
+    @click.option("--gzip/--no-gzip", "compress", default=None,
+                  help="Gzip the output (default: when the path ends with .gz).")
+    @click.option("--yield-per", default=1000, show_default=True,
+                  help="Rows fetched from the database cursors at a time.")
+    def export_catalog(path, compress, yield_per):
+        if compress is None:
+            compress = path.endswith(".gz")
+        started = time.perf_counter()
+        written = 0
+        output = sys.stdout.buffer if path == "-" else open(path, "wb")
+        try:
+            for chunk in iter_export_chunks(compress=compress, yield_per=yield_per):
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+        print(f"Exported {written} bytes in {time.perf_counter() - started:.1f}s",
+              file=sys.stderr)
+
+    """
+    Recompute the per city and per country statistics from scratch:
+    $ flask rebuild-stats
+    They are maintained on every write, this is for bulk loads and repairs.
+    """
+    @app.cli.command("rebuild-stats")
+    def rebuild_stats_command():
+        rebuild_stats()
+
+    """
+    Check that the statistics maintained on every write match a rebuild, without changing them:
+    $ flask check-stats
+    Exits with status 1 and lists the differences when they do not.
+    """
+    @app.cli.command("check-stats")
+    def check_stats_command():
+        differences = check_place_stats(db.session.connection())
+        db.session.rollback()
+        for key, maintained, rebuilt in differences:
+            print(f"{key}: maintained {maintained}, rebuilt {rebuilt}")
+        if differences:
+            raise click.ClickException(f"{len(differences)} statistics differ from a rebuild")
+        print("Place statistics match a rebuild")
+
+    """
+    Recompute the grid behind /api/pois/clusters:
+    $ flask rebuild-clusters
+    It is maintained on every POI write, this is for bulk loads and repairs.
+    """
+    @app.cli.command("rebuild-clusters")
+    def rebuild_clusters_command():
+        rebuild_clusters()
+
+    """
+    Drop every cached map tile, they are rendered again on the next request:
+    $ flask clear-tiles
+    """
+    @app.cli.command("clear-tiles")
+    def clear_tiles():
+        clear_tile_cache(app.config['TILE_CACHE_DIR'])
+        print("Tile cache cleared")
+
+    """
+    Run the bulk writes queued with ?async=true in a dedicated process, e.g. with JOB_WORKERS=0
+    in the web processes:
+    $ flask run-jobs --workers 4
+    $ flask run-jobs --once             (run the queued jobs and exit)
+    """
+    @app.cli.command("run-jobs")
+    @click.option("--workers", default=2, show_default=True, help="Worker threads.")
+    @click.option("--once", is_flag=True, help="Exit when the queue is empty.")
+    def run_jobs(workers, once):
+        runner = app.extensions['jobs']
+        if once:
+            print(f"Ran {runner.run_pending()} jobs")
+            return
+        runner.workers = workers - 1
+        runner.start()
+        print(f"Running bulk jobs with {workers} workers")
+        runner.work()
+
+    """
+    Build the similar places index served by /api/pois/<poi_id>/similar:
+    $ flask build-similarity            (every city or country)
+    $ flask build-similarity --stale    (only those whose tags changed, e.g. from cron)
+    """
+    @app.cli.command("build-similarity")
+    @click.option("--stale", "stale_only", is_flag=True, help="Only rebuild groups with tag changes.")
+    @click.option("--scope", type=click.Choice(SCOPES), help="Group POIs by city or country (default: SIMILARITY_SCOPE).")
+    @click.option("--metric", type=click.Choice(METRICS), help="Similarity metric (default: SIMILARITY_METRIC).")
+    @click.option("--top-k", type=int, help="Neighbours stored per POI (default: SIMILARITY_TOP_K).")
+    @click.option("--distance-km", type=float,
+                  help="Distance decay in km, 0 disables it (default: SIMILARITY_DISTANCE_KM).")
+    def build_similarity(stale_only, scope, metric, top_k, distance_km):
+        config = dict(app.config)
+        for key, value in (("SIMILARITY_SCOPE", scope), ("SIMILARITY_METRIC", metric),
+                           ("SIMILARITY_TOP_K", top_k), ("SIMILARITY_DISTANCE_KM", distance_km)):
+            if value is not None:
+                config[key] = value
+
+        def progress(done, total):
+            if done % 100 == 0 or done == total:
+                print(f"  {done}/{total} groups")
+
+        result = build_similarity_index(config, stale_only=stale_only, progress=progress)
+        print(f"Stored {result['rows']} neighbours for {result['groups']} groups "
+              f"in {result['elapsed']:.1f}s")
+
+    """
+    Rebuild the item-item recommendations served by /api/recommendations, e.g. nightly:
+    $ flask build-recommendations --top-k 20
+    """
+    @app.cli.command("build-recommendations")
+    @click.option("--top-k", default=20, show_default=True, help="Neighbours kept per POI.")
+    @click.option("--favorite-weight", default=FAVORITE_WEIGHT, show_default=True,
+                  help="Weight of a favorite relative to a visit.")
+    @click.option("--block-size", default=2000, show_default=True,
+                  help="POIs whose co-occurrences are computed at a time (memory bound).")
+    def build_recommendations_command(top_k, favorite_weight, block_size):
+        def progress(done, total):
+            print(f"  {done}/{total} POIs")
+
+        result = build_recommendations(top_k=top_k, favorite_weight=favorite_weight,
+                                       block_size=block_size, progress=progress)
+        print(f"Stored {result['rows']} neighbours for {result['pois']} POIs "
+              f"in {result['elapsed']:.1f}s")
@@ -0,0 +1,85 @@
+"""
+Country page in one request: a country with its cities and their POIs.
+
+The tree is built from one set-based query per level (country, cities, POIs,
+and POI images and tags only when those fields are asked for), each filtered
+by the country, and assembled in memory. The number of SQL statements does not
+depend on how many cities or POIs the country has.
+"""
+from sqlalchemy import select
+from api.models import db, Country, City, Poi, PoiImage, PoiTag, Tag
+
+MAX_DEPTH = 2
+POI_COLUMNS = {
+    'name': Poi.name,
+    'description': Poi.description,
+    'latitude': Poi.latitude,
+    'longitude': Poi.longitude,
+}
+POI_FIELDS = tuple(POI_COLUMNS) + ('images', 'tags')
+
+
+def _group_by_poi(rows, pois):
+    for poi_id, value in rows:
+        poi = pois.get(poi_id)
+        if poi is not None:
+            poi.append(value)
+
+
+def build_country_tree(country_name, depth=MAX_DEPTH, poi_fields=POI_FIELDS):
+    """
+    Build the nested country -> cities -> POIs representation.
+    Args:
+        country_name (str): Country name.
+        depth (int): 0 for the country only, 1 to add its cities, 2 to add their POIs.
+        poi_fields (iterable): POI fields to include besides the id, from POI_FIELDS.
+    Returns:
+        dict: The country with nested "cities" and "pois" lists, or None if it does not exist.
+    """
+    row = db.session.execute(select(Country.id, Country.name, Country.img)
+                             .where(Country.name == country_name)).first()
+    if row is None:
+        return None
+    country = {'id': row.id, 'name': row.name, 'img': row.img}
+    if depth < 1:
+        return country
+
+    cities = {}
+    country['cities'] = []
+    for row in db.session.execute(select(City.id, City.name, City.season)
+                                  .where(City.country_id == country['id']).order_by(City.name)):
+        city = {'id': row.id, 'name': row.name, 'season': row.season}
+        cities[row.id] = city
+        country['cities'].append(city)
+    if depth < 2 or not cities:
+        return country
+
+    columns = [POI_COLUMNS[field] for field in poi_fields if field in POI_COLUMNS]
+    in_country = (Poi.city_id == City.id) & (City.country_id == country['id'])
+    for city in cities.values():
+        city['pois'] = []
+    pois = {}
+    for row in db.session.execute(select(Poi.id, Poi.city_id, *columns).join(City, in_country)
+                                  .order_by(Poi.name)):
+        poi = {'id': row.id}
+        for column in columns:
+            poi[column.key] = getattr(row, column.key)
+        pois[row.id] = poi
+        cities[row.city_id]['pois'].append(poi)
+
+    if 'images' in poi_fields:
+        images = {poi_id: [] for poi_id in pois}
+        _group_by_poi(db.session.execute(
+            select(PoiImage.poi_id, PoiImage.url).join(Poi, PoiImage.poi_id == Poi.id)
+            .join(City, in_country).order_by(PoiImage.id)), images)
+        for poi_id, urls in images.items():
+            pois[poi_id]['images'] = urls
+    if 'tags' in poi_fields:
+        tags = {poi_id: [] for poi_id in pois}
+        _group_by_poi(db.session.execute(
+            select(PoiTag.poi_id, Tag.name).join(Tag, PoiTag.tag_id == Tag.id)
+            .join(Poi, PoiTag.poi_id == Poi.id).join(City, in_country)
+            .order_by(Tag.name)), tags)
+        for poi_id, names in tags.items():
+            pois[poi_id]['tags'] = names
+    return country
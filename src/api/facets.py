@@ -0,0 +1,74 @@
+"""
+Facet counts for POI searches ("Museum (132), Beach (48)...").
+
+With filters every facet is one GROUP BY over the ids of the matching POIs.
+Without filters the counts come from the precomputed place statistics, so
+they cost a scan of the cities/countries and not of every POI.
+"""
+from sqlalchemy import func, select
+from api.models import db, City, Country, PlaceStats, PlaceTagStats, Poi, PoiTag, Tag
+
+FACETS = ('tag', 'country', 'city', 'season')
+
+
+def _facet_rows(rows, with_id):
+    facet = []
+    for row in rows:
+        item = {'id': row[0], 'value': row[1], 'count': int(row[2])} if with_id \
+            else {'value': row[0], 'count': int(row[1])}
+        facet.append(item)
+    facet.sort(key=lambda item: (-item['count'], item['value']))
+    return facet
+
+
+def _filtered_facet(facet, poi_ids):
+    count = func.count(Poi.id.distinct())
+    if facet == 'tag':
+        return _facet_rows(db.session.execute(
+            select(Tag.name, func.count(PoiTag.poi_id.distinct())).join(PoiTag, PoiTag.tag_id == Tag.id)
+            .where(PoiTag.poi_id.in_(poi_ids)).group_by(Tag.name)), with_id=False)
+    in_city = select(City).join(Poi, Poi.city_id == City.id).where(Poi.id.in_(poi_ids))
+    if facet == 'city':
+        return _facet_rows(db.session.execute(
+            in_city.with_only_columns(City.id, City.name, count).group_by(City.id, City.name)), with_id=True)
+    if facet == 'season':
+        return _facet_rows(db.session.execute(
+            in_city.with_only_columns(City.season, count).group_by(City.season)), with_id=False)
+    return _facet_rows(db.session.execute(
+        in_city.join(Country, City.country_id == Country.id)
+        .with_only_columns(Country.id, Country.name, count).group_by(Country.id, Country.name)), with_id=True)
+
+
+def _catalog_facet(facet):
+    if facet == 'tag':
+        return _facet_rows(db.session.execute(
+            select(Tag.name, func.sum(PlaceTagStats.poi_count))
+            .join(PlaceTagStats, PlaceTagStats.tag_id == Tag.id)
+            .where(PlaceTagStats.scope == 'country', PlaceTagStats.poi_count > 0)
+            .group_by(Tag.name)), with_id=False)
+    model = Country if facet == 'country' else City
+    stats = select(PlaceStats.poi_count).join(
+        model, (PlaceStats.place_id == model.id) & (PlaceStats.scope == ('country' if model is Country else 'city')))\
+        .where(PlaceStats.poi_count > 0)
+    if facet == 'season':
+        return _facet_rows(db.session.execute(
+            stats.with_only_columns(City.season, func.sum(PlaceStats.poi_count)).group_by(City.season)),
+            with_id=False)
+    return _facet_rows(db.session.execute(
+        stats.with_only_columns(model.id, model.name, PlaceStats.poi_count)), with_id=True)
+
+
+def facet_counts(poi_query, facets, filtered):
+    """
+    Count the POIs of a search by tag, country, city and/or season.
+    Args:
+        poi_query (Query): Query of the matching POIs.
+        facets (list): Facets to compute, from FACETS.
+        filtered (bool): False when the query matches the whole catalog.
+    Returns:
+        dict: facet -> list of {"value", "count"} (plus "id" for countries and cities), most common first.
+    """
+    if not filtered:
+        return {facet: _catalog_facet(facet) for facet in facets}
+    poi_ids = poi_query.with_entities(Poi.id).scalar_subquery()
+    return {facet: _filtered_facet(facet, poi_ids) for facet in facets}
@@ -0,0 +1,62 @@
+"""
+Vectorized geographic helpers (NumPy).
+"""
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+MAX_LATITUDE = 85.0511287798
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in kilometres between every point of one set and every point of another.
+    Args:
+        lat1, lon1 (array-like): Coordinates in degrees of the first set (length M).
+        lat2, lon2 (array-like): Coordinates in degrees of the second set (length N).
+    Returns:
+        numpy.ndarray: M x N matrix of distances.
+    """
+    lat1 = np.radians(np.asarray(lat1, dtype=np.float64))[:, None]
+    lon1 = np.radians(np.asarray(lon1, dtype=np.float64))[:, None]
+    lat2 = np.radians(np.asarray(lat2, dtype=np.float64))[None, :]
+    lon2 = np.radians(np.asarray(lon2, dtype=np.float64))[None, :]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def tile_xy(latitudes, longitudes, zoom):
+    """
+    Web Mercator (XYZ) tiles holding each point.
+    Args:
+        latitudes, longitudes (array-like): Coordinates in degrees.
+        zoom (int): Zoom level, the world is 2^zoom tiles wide.
+    Returns:
+        tuple: x and y integer arrays. Latitudes beyond MAX_LATITUDE fall in the first or last row.
+    """
+    size = 1 << zoom
+    lat = np.radians(np.clip(np.asarray(latitudes, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    lon = np.asarray(longitudes, dtype=np.float64)
+    x = np.floor((lon + 180.0) / 360.0 * size)
+    y = np.floor((1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0 * size)
+    return (np.clip(x, 0, size - 1).astype(np.int64),
+            np.clip(y, 0, size - 1).astype(np.int64))
+
+
+def _tile_latitude(fraction):
+    return math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * fraction))))
+
+
+def tile_bounds(zoom, x, y):
+    """
+    Extent of a Web Mercator (XYZ) tile.
+    Args:
+        zoom, x, y (int): Tile coordinates.
+    Returns:
+        tuple: (south, west, north, east) in degrees. The first and last rows extend to the poles.
+    """
+    size = 1 << zoom
+    north = 90.0 if y == 0 else _tile_latitude(y / size)
+    south = -90.0 if y == size - 1 else _tile_latitude((y + 1) / size)
+    return south, x / size * 360.0 - 180.0, north, (x + 1) / size * 360.0 - 180.0
@@ -0,0 +1,253 @@
+"""
+Idempotency-Key support for POST endpoints.
+
+A view decorated with @idempotent that receives an Idempotency-Key header
+first claims the key in the idempotency_key table (scoped to the endpoint and
+the JWT identity, if any), then runs and stores its response. A retry with the
+same key and the same body gets the stored response back, with an
+Idempotent-Replayed header, without running the view again; the same key with
+another body is rejected with 422. A retry that arrives while the first request
+is still running waits for it (up to IDEMPOTENCY_WAIT_SECONDS, then 409 with
+Retry-After). Server errors (5xx) are not stored, so they can be retried.
+
+Keys expire after IDEMPOTENCY_TTL_HOURS and each worker deletes the expired
+ones from time to time. A claim whose request died before storing its
+response is released after IDEMPOTENCY_LOCK_SECONDS.
+"""
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from flask import Response, current_app, jsonify, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from sqlalchemy import delete, or_, update
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import Headers
+from api.models import db, IdempotencyKey
+from api.utils import APIException
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+STORED_HEADERS = ('Content-Type', 'Location')
+POLL_SECONDS = 0.1
+PURGE_INTERVAL = 300.0
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _scope():
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+    except Exception:
+        identity = None
+    return f'{request.endpoint}:{identity or ""}'
+
+
+def _request_hash():
+    digest = hashlib.sha256()
+    for part in (request.method.encode('ascii'), request.full_path.encode('utf-8'), request.get_data()):
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def _error_response(message, status_code, retry_after=None):
+    response = jsonify({'message': message})
+    response.status_code = status_code
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+class IdempotencyStore:
+    """Claims and responses of the idempotency keys, with waiters woken in this worker."""
+
+    def __init__(self, ttl_seconds, lock_seconds, wait_seconds):
+        self.ttl_seconds = ttl_seconds
+        self.lock_seconds = lock_seconds
+        self.wait_seconds = wait_seconds
+        self._done = {}
+        self._lock = threading.Lock()
+        self._purged_at = 0.0
+
+    def _event(self, scope, key):
+        with self._lock:
+            return self._done.setdefault((scope, key), threading.Event())
+
+    def _notify(self, scope, key):
+        with self._lock:
+            event = self._done.pop((scope, key), None)
+        if event is not None:
+            event.set()
+
+    def claim(self, scope, key, request_hash):
+        """
+        Claim a key for a request.
+        Args:
+            scope (str): Endpoint and identity of the request.
+            key (str): Idempotency-Key header.
+            request_hash (str): Hash of the method, URL and body.
+        Raises:
+            APIException: If the key keeps being claimed and released by other requests.
+        Returns:
+            IdempotencyKey: None when the key was claimed, otherwise the row of the
+                request that claimed it first.
+        """
+        if time.monotonic() - self._purged_at >= PURGE_INTERVAL:
+            self._purged_at = time.monotonic()
+            self.purge()
+        for _ in range(3):
+            now = _now()
+            # expired keys and claims of requests that died are free again
+            db.session.execute(delete(IdempotencyKey).where(
+                IdempotencyKey.scope == scope, IdempotencyKey.key == key,
+                or_(IdempotencyKey.expires_at < now,
+                    (IdempotencyKey.status == 'in_progress')
+                    & (IdempotencyKey.locked_at < now - timedelta(seconds=self.lock_seconds)))))
+            db.session.add(IdempotencyKey(scope=scope, key=key, request_hash=request_hash,
+                                          status='in_progress', locked_at=now,
+                                          expires_at=now + timedelta(seconds=self.ttl_seconds)))
+            try:
+                db.session.commit()
+                return None
+            except IntegrityError:
+                db.session.rollback()
+            row = db.session.get(IdempotencyKey, (scope, key), populate_existing=True)
+            db.session.commit()
+            if row is not None:
+                return row
+        raise APIException(f'A request with this {HEADER} is still in progress', status_code=409)
+
+    def wait(self, scope, key):
+        """
+        Wait for the request that claimed a key to store its response.
+        Returns:
+            IdempotencyKey: The row, still in progress if the wait timed out,
+                or None if the request failed and released the key.
+        """
+        deadline = time.monotonic() + self.wait_seconds
+        event = self._event(scope, key)
+        try:
+            while True:
+                row = db.session.get(IdempotencyKey, (scope, key), populate_existing=True)
+                db.session.commit()
+                remaining = deadline - time.monotonic()
+                if row is None or row.status == 'complete' or remaining <= 0:
+                    return row
+                # woken right away by a request of this worker, polling for the others
+                event.wait(min(POLL_SECONDS, remaining))
+        finally:
+            with self._lock:
+                if self._done.get((scope, key)) is event:
+                    del self._done[(scope, key)]
+
+    def complete(self, scope, key, response):
+        """Store the response of a claimed key."""
+        headers = [[name, response.headers[name]] for name in STORED_HEADERS if name in response.headers]
+        db.session.rollback()
+        db.session.execute(update(IdempotencyKey).where(
+            IdempotencyKey.scope == scope, IdempotencyKey.key == key).values(
+            status='complete', response_status=response.status_code,
+            response_body=response.get_data(), response_headers=headers)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+        self._notify(scope, key)
+
+    def release(self, scope, key):
+        """Drop the claim of a request that failed, so a retry runs it again."""
+        db.session.rollback()
+        db.session.execute(delete(IdempotencyKey).where(
+            IdempotencyKey.scope == scope, IdempotencyKey.key == key,
+            IdempotencyKey.status == 'in_progress'))
+        db.session.commit()
+        self._notify(scope, key)
+
+    def purge(self):
+        """
+        Delete the expired keys.
+        Returns:
+            int: Number of keys deleted.
+        """
+        deleted = db.session.execute(delete(IdempotencyKey).where(
+            IdempotencyKey.expires_at < _now())).rowcount
+        db.session.commit()
+        return deleted
+
+
+def _replay(row):
+    response = Response(row.response_body, status=row.response_status,
+                        headers=Headers([tuple(header) for header in row.response_headers or ()]))
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Run a POST view once per Idempotency-Key and replay its response for the retries.
+    Place it right above the view function, under @jwt_required() when there is one.
+    Args:
+        view (callable): The view function.
+    Returns:
+        callable: The wrapped view.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        store = current_app.extensions.get('idempotency')
+        key = request.headers.get(HEADER)
+        if store is None or key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise APIException(f'{HEADER} must have 1 to {MAX_KEY_LENGTH} characters',
+                               status_code=400)
+        scope, request_hash = _scope(), _request_hash()
+        row = store.claim(scope, key, request_hash)
+        if row is not None and row.request_hash == request_hash and row.status != 'complete':
+            # a failed first request releases the key, this one then runs instead
+            row = store.wait(scope, key) or store.claim(scope, key, request_hash)
+        if row is not None:
+            if row.request_hash != request_hash:
+                raise APIException(f'{HEADER} was already used for another request', status_code=422)
+            if row.status != 'complete':
+                return _error_response(
+                    f'A request with this {HEADER} is still in progress', 409, retry_after=1)
+            return _replay(row)
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except APIException as error:
+            if error.status_code >= 500:
+                store.release(scope, key)
+                raise
+            response = jsonify(error.to_dict())
+            response.status_code = error.status_code
+        except Exception:
+            store.release(scope, key)
+            raise
+        if response.status_code >= 500 or response.is_streamed:
+            store.release(scope, key)
+        else:
+            store.complete(scope, key, response)
+        return response
+    return wrapper
+
+
+def setup_idempotency(app):
+    """
+    Store the responses of the @idempotent views of the app sent with an Idempotency-Key.
+    Args:
+        app (Flask): The application.
+    Returns:
+        IdempotencyStore: The store of this worker.
+    """
+    app.config.setdefault('IDEMPOTENCY_TTL_HOURS', 24.0)
+    app.config.setdefault('IDEMPOTENCY_LOCK_SECONDS', 60.0)
+    app.config.setdefault('IDEMPOTENCY_WAIT_SECONDS', 10.0)
+    store = IdempotencyStore(app.config['IDEMPOTENCY_TTL_HOURS'] * 3600,
+                             app.config['IDEMPOTENCY_LOCK_SECONDS'],
+                             app.config['IDEMPOTENCY_WAIT_SECONDS'])
+    app.extensions['idempotency'] = store
+    return store
@@ -0,0 +1,352 @@
+"""
+Background processing of bulk writes.
+
+POST /api/pois, /api/cities and /api/poiimages with ?async=true check the
+shape of the items, store them as a bulk_job row and answer 202 right away.
+Worker threads of every web process (JOB_WORKERS of them, started on the first
+request) or a dedicated `flask run-jobs` process claim queued jobs from that
+table, so no broker is needed, and write their items JOB_BATCH_SIZE at a time.
+Each batch is committed with the job's progress, so GET /api/jobs/<id> shows
+how far it got and a job taken over after a crash resumes at the first batch
+that was not committed. Items that cannot be written (unknown country, city or
+tag, a name that already exists...) are skipped and reported with their index.
+
+A running job whose heartbeat is older than JOB_STALE_SECONDS is given to
+another worker; the previous one notices at its next commit and stops.
+"""
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from api.models import db, BulkJob, City, Country, Poi, PoiImage, PoiTag, Tag
+
+KINDS = ('pois', 'cities', 'poiimages')
+MAX_JOB_ITEMS = 100000
+MAX_JOB_ERRORS = 1000
+CLAIM_CANDIDATES = 5
+PURGE_INTERVAL = 3600.0
+
+
+class JobConflict(Exception):
+    """The job was given to another worker."""
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def create_job(kind, items):
+    """
+    Queue a bulk write.
+    Args:
+        kind (str): One of KINDS.
+        items (list): Items as validated by the endpoint.
+    Returns:
+        BulkJob: The queued job.
+    """
+    job = BulkJob(id=str(uuid.uuid4()), kind=kind, status='queued', items=items,
+                  total=len(items), processed=0, succeeded=0, failed=0, errors=[],
+                  created_at=_now())
+    db.session.add(job)
+    db.session.commit()
+    runner = current_app.extensions.get('jobs')
+    if runner is not None:
+        runner.start()
+        runner.notify()
+    return job
+
+
+def _process_pois(batch):
+    names = {item['name'] for _, item in batch}
+    countries = dict(db.session.execute(
+        select(Country.name, Country.id).where(Country.name.in_({item['country_name'] for _, item in batch}))).all())
+    cities = {(name, country_id): city_id for city_id, name, country_id in db.session.execute(
+        select(City.id, City.name, City.country_id).where(
+            City.country_id.in_(set(countries.values())),
+            City.name.in_({item['city_name'] for _, item in batch})))}
+    tag_names = {tag for _, item in batch for tag in item.get('tags', [])}
+    tags = dict(db.session.execute(
+        select(Tag.name, Tag.id).where(Tag.name.in_(tag_names))).all()) if tag_names else {}
+    existing = set(db.session.execute(select(Poi.name, Poi.city_id).where(
+        Poi.name.in_(names), Poi.city_id.in_(set(cities.values())))).all()) if cities else set()
+
+    pois, relations, errors = [], [], []
+    for index, item in batch:
+        country_id = countries.get(item['country_name'])
+        city_id = cities.get((item['city_name'], country_id))
+        missing_tags = [tag for tag in item.get('tags', []) if tag not in tags]
+        if country_id is None:
+            errors.append((index, f"Country '{item['country_name']}' not found"))
+        elif city_id is None:
+            errors.append((index, f"City '{item['city_name']}' in country "
+                                  f"'{item['country_name']}' not found"))
+        elif (item['name'], city_id) in existing:
+            errors.append((index, f"POI '{item['name']}' already exists in this city"))
+        elif missing_tags:
+            errors.append((index, f"Tag '{missing_tags[0]}' not found"))
+        else:
+            poi = Poi(id=str(uuid.uuid4()), name=item['name'], description=item['description'],
+                      latitude=float(item['latitude']), longitude=float(item['longitude']),
+                      city_id=city_id)
+            pois.append(poi)
+            relations.extend(PoiTag(poi_id=poi.id, tag_id=tags[tag]) for tag in item.get('tags', []))
+            relations.extend(PoiImage(id=str(uuid.uuid4()), url=url, poi_id=poi.id)
+                             for url in item.get('poiimages', []))
+    db.session.add_all(pois)
+    db.session.flush()
+    db.session.add_all(relations)
+    db.session.flush()
+    return len(pois), errors
+
+
+def _process_cities(batch):
+    countries = dict(db.session.execute(
+        select(Country.name, Country.id).where(Country.name.in_({item['country_name'] for _, item in batch}))).all())
+    existing = set(db.session.execute(select(City.name, City.country_id).where(
+        City.name.in_({item['name'] for _, item in batch}),
+        City.country_id.in_(set(countries.values())))).all()) if countries else set()
+
+    cities, errors = [], []
+    for index, item in batch:
+        country_id = countries.get(item['country_name'])
+        if country_id is None:
+            errors.append((index, 'Country not found'))
+        elif (item['name'], country_id) in existing:
+            errors.append((index, f"City '{item['name']}' already exists in this country"))
+        else:
+            cities.append(City(id=str(uuid.uuid4()), name=item['name'], season=item['season'],
+                               country_id=country_id))
+    db.session.add_all(cities)
+    db.session.flush()
+    return len(cities), errors
+
+
+def _process_poiimages(batch):
+    pois = set(db.session.scalars(select(Poi.id).where(Poi.id.in_({item['poi_id'] for _, item in batch}))))
+    images, errors = [], []
+    for index, item in batch:
+        if item['poi_id'] not in pois:
+            errors.append((index, 'POI not found'))
+        else:
+            images.append(PoiImage(id=str(uuid.uuid4()), url=item['url'], poi_id=item['poi_id']))
+    db.session.add_all(images)
+    db.session.flush()
+    return len(images), errors
+
+
+PROCESSORS = {'pois': _process_pois, 'cities': _process_cities, 'poiimages': _process_poiimages}
+
+
+def _claimable(stale_seconds):
+    return or_(BulkJob.status == 'queued',
+               and_(BulkJob.status == 'running',
+                    BulkJob.heartbeat_at < _now() - timedelta(seconds=stale_seconds)))
+
+
+def claim_job(stale_seconds=300):
+    """
+    Take the oldest queued job, or a running one whose worker stopped sending heartbeats.
+    Args:
+        stale_seconds (float): Heartbeat age after which a running job is taken over.
+    Returns:
+        tuple: (job id, heartbeat set by the claim), or None when there is nothing to do.
+    """
+    candidates = db.session.scalars(select(BulkJob.id).where(_claimable(stale_seconds))
+                                    .order_by(BulkJob.created_at).limit(CLAIM_CANDIDATES)).all()
+    db.session.commit()
+    for job_id in candidates:
+        heartbeat = _now()
+        claimed = db.session.execute(
+            update(BulkJob).where(BulkJob.id == job_id, _claimable(stale_seconds))
+            .values(status='running', heartbeat_at=heartbeat,
+                    started_at=db.func.coalesce(BulkJob.started_at, heartbeat))
+            .execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        if claimed:
+            return job_id, heartbeat
+    return None
+
+
+class _Progress:
+    """Counters of a claimed job, written with every batch."""
+
+    def __init__(self, job_id, heartbeat, processed, succeeded, failed, errors):
+        self.job_id = job_id
+        self.heartbeat = heartbeat
+        self.processed = processed
+        self.succeeded = succeeded
+        self.failed = failed
+        self.errors = list(errors)
+
+    def add(self, processed, succeeded, errors):
+        self.processed += processed
+        self.succeeded += succeeded
+        self.failed += len(errors)
+        room = max(0, MAX_JOB_ERRORS - len(self.errors))
+        self.errors.extend({'index': index, 'message': message} for index, message in errors[:room])
+
+    def commit(self, **values):
+        """Save the counters with the writes of the session, unless the job was taken over."""
+        heartbeat = _now()
+        saved = db.session.execute(
+            update(BulkJob).where(BulkJob.id == self.job_id, BulkJob.status == 'running',
+                                  BulkJob.heartbeat_at == self.heartbeat)
+            .values(processed=self.processed, succeeded=self.succeeded, failed=self.failed,
+                    errors=self.errors, heartbeat_at=heartbeat, **values)
+            .execution_options(synchronize_session=False)).rowcount
+        if not saved:
+            db.session.rollback()
+            raise JobConflict(self.job_id)
+        db.session.commit()
+        self.heartbeat = heartbeat
+
+
+def _write_batch(process, progress, batch):
+    """Write a batch in one transaction, or item by item if it hits a constraint."""
+    try:
+        succeeded, errors = process(batch)
+        progress.add(len(batch), succeeded, errors)
+        progress.commit()
+        return
+    except IntegrityError:
+        # e.g. a duplicate created concurrently, isolate the offending items
+        db.session.rollback()
+    for entry in batch:
+        try:
+            succeeded, errors = process([entry])
+        except IntegrityError as e:
+            db.session.rollback()
+            current_app.logger.warning(f"Integrity error in job {progress.job_id}: {str(e.orig)}")
+            succeeded, errors = 0, [(entry[0], 'Database integrity error')]
+        progress.add(1, succeeded, errors)
+        progress.commit()
+
+
+def run_job(job_id, heartbeat, batch_size=500):
+    """
+    Write the remaining items of a claimed job.
+    Args:
+        job_id (str): Job ID.
+        heartbeat (datetime): Heartbeat set when the job was claimed.
+        batch_size (int): Items written per transaction.
+    """
+    kind, items, processed, succeeded, failed, errors = db.session.execute(
+        select(BulkJob.kind, BulkJob.items, BulkJob.processed, BulkJob.succeeded,
+               BulkJob.failed, BulkJob.errors).where(BulkJob.id == job_id)).one()
+    db.session.commit()
+    progress = _Progress(job_id, heartbeat, processed, succeeded, failed, errors)
+    process = PROCESSORS[kind]
+    try:
+        while progress.processed < len(items):
+            start = progress.processed
+            _write_batch(process, progress, list(enumerate(items[start:start + batch_size], start)))
+        progress.commit(status='done', finished_at=_now())
+    except JobConflict:
+        current_app.logger.warning(f"Job {job_id} was taken over by another worker")
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception(f"Job {job_id} failed")
+        try:
+            progress.commit(status='failed', error=f"{type(e).__name__}: {e}"[:500],
+                            finished_at=_now())
+        except JobConflict:
+            pass
+
+
+def purge_jobs(retention_seconds):
+    """
+    Delete the jobs that finished more than retention_seconds ago.
+    Args:
+        retention_seconds (float): How long finished jobs can be polled.
+    Returns:
+        int: Number of jobs deleted.
+    """
+    deleted = db.session.execute(delete(BulkJob).where(
+        BulkJob.status.in_(('done', 'failed')),
+        BulkJob.finished_at < _now() - timedelta(seconds=retention_seconds))).rowcount
+    db.session.commit()
+    return deleted
+
+
+class JobRunner:
+    """
+    Threads of one process that run the queued jobs.
+    """
+
+    def __init__(self, app, workers=2):
+        self.app = app
+        self.workers = workers
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._purged_at = 0.0
+
+    def start(self):
+        """Start the threads of this process, once (also after a fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for n in range(self.workers):
+                threading.Thread(target=self.work, name=f'bulk-job-worker-{n}', daemon=True).start()
+
+    def notify(self):
+        """Wake up an idle thread, e.g. after a job was queued."""
+        self._wake.set()
+
+    def run_pending(self):
+        """
+        Run queued jobs until there are none left.
+        Returns:
+            int: Number of jobs run.
+        """
+        config = self.app.config
+        ran = 0
+        with self.app.app_context():
+            while True:
+                claimed = claim_job(config['JOB_STALE_SECONDS'])
+                if claimed is None:
+                    break
+                run_job(*claimed, batch_size=config['JOB_BATCH_SIZE'])
+                ran += 1
+            now = time.monotonic()
+            if now - self._purged_at >= PURGE_INTERVAL:
+                self._purged_at = now
+                purge_jobs(config['JOB_RETENTION_HOURS'] * 3600)
+        return ran
+
+    def work(self):
+        """Run jobs forever, polling every JOB_POLL_SECONDS when idle."""
+        while True:
+            try:
+                self.run_pending()
+            except Exception:
+                self.app.logger.exception('Bulk job worker error')
+            self._wake.wait(self.app.config['JOB_POLL_SECONDS'])
+            self._wake.clear()
+
+
+def setup_jobs(app):
+    """
+    Run the bulk jobs in threads of the web processes, started on their first request.
+    Args:
+        app (Flask): The application.
+    Returns:
+        JobRunner: The runner, also used by `flask run-jobs`.
+    """
+    app.config.setdefault('JOB_WORKERS', 2)
+    app.config.setdefault('JOB_BATCH_SIZE', 500)
+    app.config.setdefault('JOB_POLL_SECONDS', 2.0)
+    app.config.setdefault('JOB_STALE_SECONDS', 300.0)
+    app.config.setdefault('JOB_RETENTION_HOURS', 168.0)
+    runner = JobRunner(app, app.config['JOB_WORKERS'])
+    app.extensions['jobs'] = runner
+    if app.config['JOB_WORKERS'] > 0:
+        app.before_request(runner.start)
+    return runner
@@ -0,0 +1,132 @@
+"""
+JSON provider used by the Flask app for every jsonify() call and request body.
+It encodes with orjson when the package is installed and falls back to the
+standard library json module otherwise, so responses look the same either way.
+
+Serializers can also hand over JSON they encoded before, wrapped with
+json_fragment(): orjson (3.9 and later) embeds it natively as an
+orjson.Fragment, the other encoders write a marker string in its place and the
+marker is then replaced with the bytes, which are never decoded again.
+"""
+import re
+import uuid
+from datetime import date, datetime
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib encoder is used instead
+    orjson = None
+
+NATIVE_FRAGMENTS = orjson is not None and hasattr(orjson, 'Fragment')
+# a NUL is always escaped by the encoders, so "\u0000<nonce>:<n>" cannot come from the data
+_MARKER_NONCE = uuid.uuid4().hex
+_MARKER_RE = re.compile(r'"\\u0000' + _MARKER_NONCE + r':(\d+)"')
+_MARKER_BYTES_RE = re.compile(_MARKER_RE.pattern.encode('ascii'))
+
+
+class PreEncodedJSON:
+    """Bytes that are already valid JSON and must be embedded verbatim."""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data if isinstance(data, bytes) else data.encode('utf-8')
+
+
+def json_fragment(data):
+    """
+    Wrap pre-encoded JSON so it can be placed inside a jsonify() payload.
+    Args:
+        data (bytes | str): A complete JSON document, e.g. a cached serialization.
+    Returns:
+        PreEncodedJSON: A value the provider embeds without encoding it again.
+    """
+    return PreEncodedJSON(data)
+
+
+def _fragment_default(default, fragments):
+    """default() of one encoding, replacing the fragments with markers collected in fragments."""
+    def encode(obj):
+        if isinstance(obj, PreEncodedJSON):
+            if NATIVE_FRAGMENTS and fragments is None:
+                return orjson.Fragment(obj.data)
+            fragments.append(obj.data)
+            return f'\x00{_MARKER_NONCE}:{len(fragments) - 1}'
+        return default(obj)
+    return encode
+
+
+def _default(obj):
+    """
+    Convert the types the encoders do not handle on their own.
+    Args:
+        obj: The object that could not be serialized.
+    Raises:
+        TypeError: If the object is not JSON serializable.
+    Returns:
+        A JSON serializable value.
+    """
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    return DefaultJSONProvider.default(obj)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson with a standard library fallback.
+    datetime/date values are encoded as ISO 8601 strings and UUIDs as strings
+    with both backends.
+    """
+    default = staticmethod(_default)
+    ensure_ascii = False
+
+    def _orjson_options(self, indent=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps_bytes(self, obj, indent=False):
+        """
+        Serialize data as UTF-8 encoded JSON.
+        Args:
+            obj: The data to serialize.
+            indent (bool): Pretty print the output with two spaces.
+        Returns:
+            bytes: The encoded document.
+        """
+        if orjson is not None:
+            fragments = None if NATIVE_FRAGMENTS else []
+            data = orjson.dumps(obj, default=_fragment_default(self.default, fragments),
+                                option=self._orjson_options(indent))
+            if fragments:
+                data = _MARKER_BYTES_RE.sub(lambda match: fragments[int(match.group(1))], data)
+            return data
+        if indent:
+            return self.dumps(obj, indent=2).encode('utf-8')
+        return self.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and (not kwargs or set(kwargs) == {'indent'}):
+            return self.dumps_bytes(obj, indent=bool(kwargs.get('indent'))).decode('utf-8')
+        fragments = []
+        kwargs['default'] = _fragment_default(kwargs.get('default', self.default), fragments)
+        text = super().dumps(obj, **kwargs)
+        if fragments:
+            text = _MARKER_RE.sub(lambda match: fragments[int(match.group(1))].decode('utf-8'), text)
+        return text
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(
+            self.dumps_bytes(obj, indent=indent) + b'\n', mimetype=self.mimetype)
@@ -0,0 +1,329 @@
+"""
+Request instrumentation exposed at /metrics in the Prometheus text format.
+
+For every endpoint, method and status it records a latency histogram, the
+number and total time of SQL statements (through SQLAlchemy engine events) and
+the response bytes. Each worker keeps its own counters in memory. When
+PROMETHEUS_MULTIPROC_DIR is set (multi-process gunicorn) every worker also
+writes its counters to a file in that directory and /metrics adds up the files
+of all workers, including ones that have exited, so totals never go backwards.
+The files of exited workers are folded into one archive file on the next
+scrape, so restarts (e.g. gunicorn max_requests) do not grow the directory.
+Workers are told apart by pid, so the directory must not be shared between
+hosts or containers.
+
+When METRICS_TOKEN is set, /metrics only answers scrapers sending it as an
+`Authorization: Bearer <token>` header.
+"""
+import atexit
+import contextlib
+import hmac
+import json
+import os
+import threading
+import time
+import uuid
+from flask import g, has_request_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where the directory is not locked
+    fcntl = None
+
+METRIC_PREFIX = 'odyssey'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FLUSH_INTERVAL = 1.0
+ARCHIVE_FILE = 'metrics_archive.json'
+LOCK_FILE = 'metrics.lock'
+
+
+def _worker_pid(name):
+    """Pid in the name of a worker file (metrics_<pid>_<suffix>.json), None for other files."""
+    parts = name[:-len('.json')].split('_') if name.endswith('.json') else ()
+    if len(parts) == 3 and parts[0] == 'metrics' and parts[1].isdigit():
+        return int(parts[1])
+    return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _Series:
+    """Counters of one (endpoint, method, status) combination."""
+    __slots__ = ('buckets', 'count', 'latency_sum', 'sql_count', 'sql_time', 'response_bytes')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.latency_sum = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.response_bytes = 0
+
+    def to_list(self):
+        return [self.buckets, self.count, self.latency_sum, self.sql_count,
+                self.sql_time, self.response_bytes]
+
+    def merge(self, values):
+        buckets, count, latency_sum, sql_count, sql_time, response_bytes = values
+        self.buckets = [a + b for a, b in zip(self.buckets, buckets)]
+        self.count += count
+        self.latency_sum += latency_sum
+        self.sql_count += sql_count
+        self.sql_time += sql_time
+        self.response_bytes += response_bytes
+
+
+class MetricsRegistry:
+    """Per-worker request metrics, optionally shared through a directory."""
+
+    def __init__(self, multiproc_dir=None):
+        self.multiproc_dir = multiproc_dir
+        self._series = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        self._pid = None
+        self._file_name = None
+        if multiproc_dir:
+            atexit.register(self.flush)
+
+    @property
+    def _worker_file(self):
+        # unique per process, also when the app was preloaded before the fork
+        # or a new worker reuses the pid of one that exited
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._file_name = f'metrics_{self._pid}_{uuid.uuid4().hex[:8]}.json'
+        return os.path.join(self.multiproc_dir, self._file_name)
+
+    def observe(self, endpoint, method, status, latency, sql_count, sql_time, response_bytes):
+        key = (endpoint, method, str(status))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series()
+            index = len(LATENCY_BUCKETS)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    index = i
+                    break
+            series.buckets[index] += 1
+            series.count += 1
+            series.latency_sum += latency
+            series.sql_count += sql_count
+            series.sql_time += sql_time
+            series.response_bytes += response_bytes
+        if self.multiproc_dir and time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            return {key: series.to_list() for key, series in self._series.items()}
+
+    def flush(self):
+        """Write this worker's counters to the shared directory (atomically)."""
+        if not self.multiproc_dir:
+            return
+        self._last_flush = time.monotonic()
+        data = [[list(key), values] for key, values in self.snapshot().items()]
+        tmp_path = f'{self._worker_file}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self._worker_file)
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        """Hold the lock of the shared directory, shared to read or exclusive to archive."""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.multiproc_dir, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.multiproc_dir, name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _read_archive(self):
+        archive = self._read(ARCHIVE_FILE)
+        return archive if isinstance(archive, dict) else {'merged': [], 'series': []}
+
+    def _archive_exited_workers(self, own_file):
+        """Fold the files of workers that exited into the archive and delete them."""
+        exited = [name for name in os.listdir(self.multiproc_dir)
+                  if name != own_file and _worker_pid(name) is not None
+                  and not _pid_alive(_worker_pid(name))]
+        if not exited:
+            return
+        with self._locked(fcntl.LOCK_EX if fcntl else None):
+            archive = self._read_archive()
+            # already in the archive, left behind by a run that stopped before deleting them
+            for name in archive['merged']:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.multiproc_dir, name))
+            series = {}
+            for key, values in archive['series']:
+                series.setdefault(tuple(key), _Series()).merge(values)
+            merged = []
+            for name in exited:
+                data = None if name in archive['merged'] else self._read(name)
+                if data is None:
+                    continue
+                for key, values in data:
+                    series.setdefault(tuple(key), _Series()).merge(values)
+                merged.append(name)
+            if not merged:
+                return
+            path = os.path.join(self.multiproc_dir, ARCHIVE_FILE)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'merged': merged,
+                           'series': [[list(key), values.to_list()] for key, values in series.items()]}, f)
+            os.replace(tmp_path, path)
+            for name in merged:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.multiproc_dir, name))
+
+    def collect(self):
+        """Merge the counters of every worker, this one read from memory."""
+        merged = {}
+
+        def add(key, values):
+            series = merged.get(key)
+            if series is None:
+                series = merged[key] = _Series()
+            series.merge(values)
+
+        if self.multiproc_dir and os.path.isdir(self.multiproc_dir):
+            own_file = os.path.basename(self._worker_file)
+            self._archive_exited_workers(own_file)
+            with self._locked(fcntl.LOCK_SH if fcntl else None):
+                archive = self._read_archive()
+                for key, values in archive['series']:
+                    add(tuple(key), values)
+                for name in os.listdir(self.multiproc_dir):
+                    if _worker_pid(name) is None or name == own_file or name in archive['merged']:
+                        continue
+                    for key, values in self._read(name) or ():
+                        add(tuple(key), values)
+        for key, values in self.snapshot().items():
+            add(key, values)
+        return merged
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        merged = sorted(self.collect().items())
+        name = f'{METRIC_PREFIX}_http_request_duration_seconds'
+        lines = [f'# HELP {name} Request latency by endpoint, method and status.',
+                 f'# TYPE {name} histogram']
+        for (endpoint, method, status), series in merged:
+            labels = _labels(endpoint, method, status)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, series.buckets):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {series.count}')
+            lines.append(f'{name}_sum{{{labels}}} {series.latency_sum}')
+            lines.append(f'{name}_count{{{labels}}} {series.count}')
+        for suffix, help_text, attr in (
+                ('sql_statements_total', 'SQL statements executed while handling requests.', 'sql_count'),
+                ('sql_duration_seconds_total', 'Time spent in SQL statements while handling requests.', 'sql_time'),
+                ('response_bytes_total', 'Response body bytes sent.', 'response_bytes')):
+            name = f'{METRIC_PREFIX}_http_{suffix}'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for (endpoint, method, status), series in merged:
+                lines.append(f'{name}{{{_labels(endpoint, method, status)}}} {getattr(series, attr)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(endpoint, method, status):
+    return f'endpoint="{_escape(endpoint)}",method="{_escape(method)}",status="{_escape(status)}"'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and context is not None:
+        context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_metrics_started', None)
+    if started is None or not has_request_context():
+        return
+    sql = g.get('_sql_stats')
+    if sql is not None:
+        sql[0] += 1
+        sql[1] += time.perf_counter() - started
+
+
+_listeners_installed = False
+
+
+def _install_sql_listeners():
+    global _listeners_installed
+    if not _listeners_installed:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listeners_installed = True
+
+
+def setup_metrics(app):
+    """
+    Instrument every request of the app and expose the results at /metrics.
+    Args:
+        app (Flask): The application to instrument.
+    Returns:
+        MetricsRegistry: The registry of this worker.
+    """
+    app.config.setdefault('METRICS_TOKEN', None)
+    registry = MetricsRegistry(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+    app.extensions['metrics'] = registry
+    _install_sql_listeners()
+
+    @app.before_request
+    def start_request_metrics():
+        g._request_started = time.perf_counter()
+        g._sql_stats = [0, 0.0]
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.pop('_request_started', None)
+        if started is None:
+            return response
+        sql_count, sql_time = g.pop('_sql_stats', (0, 0.0))
+        endpoint = request.endpoint or 'unmatched'
+        registry.observe(endpoint, request.method, response.status_code,
+                         time.perf_counter() - started, sql_count, sql_time,
+                         response.content_length or 0)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        token = app.config['METRICS_TOKEN']
+        if token and not hmac.compare_digest(
+                request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+            return Response('Unauthorized\n', status=401, mimetype='text/plain',
+                            headers={'WWW-Authenticate': 'Bearer'})
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    return registry
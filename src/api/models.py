@@ -1,12 +1,23 @@
+import sqlite3
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
-from sqlalchemy import String, Float
-from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import String, Float, BigInteger, Integer, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapped, mapped_column, joinedload, load_only, selectinload
 from typing import List
 
 db = SQLAlchemy()
 
 
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite ignores foreign keys (and ON DELETE CASCADE) unless asked to."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
 class User(db.Model):
     """Represents a registered user.
 
@@ -27,9 +38,11 @@ class User(db.Model):
         String(20), nullable=False, default='user')
     img: Mapped[str] = mapped_column(String(240), nullable=True)
     favorites: Mapped[List["Favorite"]] = db.relationship(
-        'Favorite', back_populates='user', cascade='all, delete-orphan')
+        'Favorite', back_populates='user', cascade='all, delete-orphan',
+        passive_deletes=True)
     visited: Mapped[List["Visited"]] = db.relationship(
-        'Visited', back_populates='user', cascade='all, delete-orphan')
+        'Visited', back_populates='user', cascade='all, delete-orphan',
+        passive_deletes=True)
 
     def serialize(self):
         return {
@@ -55,7 +68,8 @@ class Country(db.Model):
     name: Mapped[str] = mapped_column(String(120), nullable=False, unique=True)
     img: Mapped[str] = mapped_column(String(240), nullable=False)
     cities: Mapped[List["City"]] = db.relationship(
-        'City', back_populates='country', cascade='all, delete-orphan')
+        'City', back_populates='country', cascade='all, delete-orphan',
+        passive_deletes=True)
 
     def serialize(self):
         return {
@@ -65,6 +79,11 @@ class Country(db.Model):
             "cities": [city.id for city in self.cities]
         }
 
+    @staticmethod
+    def serialize_options():
+        """Loader options that batch the relationships serialize() reads."""
+        return (selectinload(Country.cities).options(load_only(City.id)),)
+
 
 class City(db.Model):
     """City belonging to a country.
@@ -79,11 +98,12 @@ class City(db.Model):
     name: Mapped[str] = mapped_column(String(120), nullable=False)
     season: Mapped[str] = mapped_column(String(120), nullable=False)
     country_id: Mapped[str] = mapped_column(
-        db.ForeignKey('country.id'), nullable=False)
+        db.ForeignKey('country.id', ondelete='CASCADE'), nullable=False)
     country: Mapped["Country"] = db.relationship(
         'Country', back_populates='cities')
     pois: Mapped[List["Poi"]] = db.relationship(
-        'Poi', back_populates='city', cascade='all, delete-orphan')
+        'Poi', back_populates='city', cascade='all, delete-orphan',
+        passive_deletes=True)
 
     def serialize(self):
         return {
@@ -94,14 +114,19 @@ class City(db.Model):
             "pois": [poi.id for poi in self.pois]
         }
 
+    @staticmethod
+    def serialize_options():
+        """Loader options that batch the relationships serialize() reads."""
+        return (selectinload(City.pois).options(load_only(Poi.id)),)
+
 
 class PoiTag(db.Model):
     """Association table linking POIs with tags."""
     __tablename__ = 'poi_tag'
     poi_id: Mapped[str] = mapped_column(
-        db.ForeignKey('poi.id'), primary_key=True)
+        db.ForeignKey('poi.id', ondelete='CASCADE'), primary_key=True)
     tag_id: Mapped[str] = mapped_column(
-        db.ForeignKey('tag.id'), primary_key=True)
+        db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
     poi: Mapped["Poi"] = db.relationship('Poi', back_populates='poi_tags')
     tag: Mapped["Tag"] = db.relationship('Tag', back_populates='poi_tags')
 
@@ -112,7 +137,8 @@ class Tag(db.Model):
     id: Mapped[str] = mapped_column(String(36), primary_key=True)
     name: Mapped[str] = mapped_column(String(240), nullable=False, unique=True)
     poi_tags: Mapped[List["PoiTag"]] = db.relationship(
-        'PoiTag', back_populates='tag', cascade='all, delete-orphan')
+        'PoiTag', back_populates='tag', cascade='all, delete-orphan',
+        passive_deletes=True)
 
     def serialize(self):
         return {
@@ -130,6 +156,7 @@ class Poi(db.Model):
     __tablename__ = 'poi'
     __table_args__ = (
         db.UniqueConstraint('name', 'city_id', name='uq_poi_name_city'),
+        db.Index('ix_poi_latitude_longitude', 'latitude', 'longitude'),
     )
     id: Mapped[str] = mapped_column(String(36), primary_key=True)
     name: Mapped[str] = mapped_column(String(120), nullable=False)
@@ -137,16 +164,20 @@ class Poi(db.Model):
     latitude: Mapped[float] = mapped_column(Float, nullable=False)
     longitude: Mapped[float] = mapped_column(Float, nullable=False)
     city_id: Mapped[str] = mapped_column(
-        db.ForeignKey('city.id'), nullable=False)
+        db.ForeignKey('city.id', ondelete='CASCADE'), nullable=False)
     city: Mapped["City"] = db.relationship('City', back_populates='pois')
     images: Mapped[List["PoiImage"]] = db.relationship(
-        'PoiImage', back_populates='poi', cascade='all, delete-orphan')
+        'PoiImage', back_populates='poi', cascade='all, delete-orphan',
+        passive_deletes=True)
     poi_tags: Mapped[List["PoiTag"]] = db.relationship(
-        'PoiTag', back_populates='poi', cascade='all, delete-orphan')
+        'PoiTag', back_populates='poi', cascade='all, delete-orphan',
+        passive_deletes=True)
     favorited_by: Mapped[List["Favorite"]] = db.relationship(
-        'Favorite', back_populates='poi', cascade='all, delete-orphan')
+        'Favorite', back_populates='poi', cascade='all, delete-orphan',
+        passive_deletes=True)
     visited_by: Mapped[List["Visited"]] = db.relationship(
-        'Visited', back_populates='poi', cascade='all, delete-orphan')
+        'Visited', back_populates='poi', cascade='all, delete-orphan',
+        passive_deletes=True)
 
     def serialize(self):
         return {
@@ -160,6 +191,12 @@ class Poi(db.Model):
             "tags": [pt.tag.name for pt in self.poi_tags]
         }
 
+    @staticmethod
+    def serialize_options():
+        """Loader options that batch the relationships serialize() reads."""
+        return (selectinload(Poi.images),
+                selectinload(Poi.poi_tags).options(joinedload(PoiTag.tag)))
+
 
 class PoiImage(db.Model):
     """Image URL associated with a specific POI."""
@@ -167,7 +204,7 @@ class PoiImage(db.Model):
     id: Mapped[str] = mapped_column(String(36), primary_key=True)
     url: Mapped[str] = mapped_column(String(240), nullable=False)
     poi_id: Mapped[str] = mapped_column(
-        db.ForeignKey('poi.id'), nullable=False)
+        db.ForeignKey('poi.id', ondelete='CASCADE'), nullable=False)
     poi: Mapped["Poi"] = db.relationship('Poi', back_populates='images')
 
     def serialize(self):
@@ -182,9 +219,9 @@ class Favorite(db.Model):
     """Join table mapping users to their favorite POIs."""
     __tablename__ = 'favorite'
     user_id: Mapped[str] = mapped_column(db.ForeignKey(
-        'user.id'), nullable=False, primary_key=True)
+        'user.id', ondelete='CASCADE'), nullable=False, primary_key=True)
     poi_id: Mapped[str] = mapped_column(db.ForeignKey(
-        'poi.id'), nullable=False, primary_key=True)
+        'poi.id', ondelete='CASCADE'), nullable=False, primary_key=True)
     user: Mapped["User"] = db.relationship('User', back_populates='favorites')
     poi: Mapped["Poi"] = db.relationship('Poi', back_populates='favorited_by')
 
@@ -199,9 +236,9 @@ class Visited(db.Model):
     """Join table mapping users to POIs they have visited."""
     __tablename__ = 'visited'
     user_id: Mapped[str] = mapped_column(db.ForeignKey(
-        'user.id'), nullable=False, primary_key=True)
+        'user.id', ondelete='CASCADE'), nullable=False, primary_key=True)
     poi_id: Mapped[str] = mapped_column(db.ForeignKey(
-        'poi.id'), nullable=False, primary_key=True)
+        'poi.id', ondelete='CASCADE'), nullable=False, primary_key=True)
     user: Mapped["User"] = db.relationship('User', back_populates='visited')
     poi: Mapped["Poi"] = db.relationship('Poi', back_populates='visited_by')
 
@@ -210,3 +247,152 @@ class Visited(db.Model):
             "user_id": self.user_id,
             "poi_id": self.poi_id
         }
+
+
+class ChangeLog(db.Model):
+    """Entry of the catalog change feed.
+
+    Records that a catalog row was created/updated ("upsert") or deleted,
+    ordered by a monotonically increasing sequence number.
+    """
+    __tablename__ = 'change_log'
+    seq: Mapped[int] = mapped_column(
+        BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    entity: Mapped[str] = mapped_column(String(20), nullable=False)
+    entity_id: Mapped[str] = mapped_column(String(80), nullable=False)
+    op: Mapped[str] = mapped_column(String(10), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        nullable=False, server_default=db.func.now())
+
+    def serialize(self):
+        return {
+            "seq": self.seq,
+            "type": self.entity,
+            "id": self.entity_id,
+            "op": self.op
+        }
+
+
+class PlaceStats(db.Model):
+    """Precomputed totals of a city or a country.
+
+    Kept up to date by api.place_stats on every catalog write, so clients
+    read them by primary key instead of aggregating the POIs.
+    """
+    __tablename__ = 'place_stats'
+    scope: Mapped[str] = mapped_column(String(10), primary_key=True)
+    place_id: Mapped[str] = mapped_column(String(36), primary_key=True)
+    poi_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    favorite_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    visited_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class PlaceTagStats(db.Model):
+    """Number of POIs of a city or a country carrying a tag."""
+    __tablename__ = 'place_tag_stats'
+    scope: Mapped[str] = mapped_column(String(10), primary_key=True)
+    place_id: Mapped[str] = mapped_column(String(36), primary_key=True)
+    tag_id: Mapped[str] = mapped_column(
+        db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    poi_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class PoiSimilarity(db.Model):
+    """Precomputed neighbour of a POI in the similar places index."""
+    __tablename__ = 'poi_similarity'
+    poi_id: Mapped[str] = mapped_column(
+        db.ForeignKey('poi.id', ondelete='CASCADE'), primary_key=True)
+    similar_poi_id: Mapped[str] = mapped_column(
+        db.ForeignKey('poi.id', ondelete='CASCADE'), primary_key=True)
+    score: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+class PoiClusterCell(db.Model):
+    """Number of POIs and sum of their coordinates in one cell of the map clustering grid.
+
+    Kept up to date by api.clusters on every POI write.
+    """
+    __tablename__ = 'poi_cluster_cell'
+    zoom: Mapped[int] = mapped_column(Integer, primary_key=True)
+    x: Mapped[int] = mapped_column(Integer, primary_key=True)
+    y: Mapped[int] = mapped_column(Integer, primary_key=True)
+    poi_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    latitude_sum: Mapped[float] = mapped_column(Float, nullable=False, default=0.0)
+    longitude_sum: Mapped[float] = mapped_column(Float, nullable=False, default=0.0)
+
+
+class SimilarityStaleCity(db.Model):
+    """City whose POIs changed tags since the similarity index was built."""
+    __tablename__ = 'similarity_stale_city'
+    city_id: Mapped[str] = mapped_column(
+        db.ForeignKey('city.id', ondelete='CASCADE'), primary_key=True)
+
+
+class PoiCooccurrence(db.Model):
+    """Precomputed item-item neighbour of a POI from users' favorites and visits."""
+    __tablename__ = 'poi_cooccurrence'
+    poi_id: Mapped[str] = mapped_column(
+        db.ForeignKey('poi.id', ondelete='CASCADE'), primary_key=True)
+    related_poi_id: Mapped[str] = mapped_column(
+        db.ForeignKey('poi.id', ondelete='CASCADE'), primary_key=True)
+    score: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+class BulkJob(db.Model):
+    """Bulk write accepted by the API and applied in the background by api.jobs.
+
+    Holds the submitted items, how far the workers got and the errors of the
+    items that could not be written.
+    """
+    __tablename__ = 'bulk_job'
+    __table_args__ = (
+        db.Index('ix_bulk_job_status_created_at', 'status', 'created_at'),
+    )
+    id: Mapped[str] = mapped_column(String(36), primary_key=True)
+    kind: Mapped[str] = mapped_column(String(20), nullable=False)
+    status: Mapped[str] = mapped_column(String(10), nullable=False, default='queued')
+    items: Mapped[list] = mapped_column(db.JSON, nullable=False)
+    total: Mapped[int] = mapped_column(Integer, nullable=False)
+    processed: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    succeeded: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    failed: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    errors: Mapped[list] = mapped_column(db.JSON, nullable=False, default=list)
+    error: Mapped[str] = mapped_column(String(500), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(nullable=False)
+    started_at: Mapped[datetime] = mapped_column(nullable=True)
+    heartbeat_at: Mapped[datetime] = mapped_column(nullable=True)
+    finished_at: Mapped[datetime] = mapped_column(nullable=True)
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "type": self.kind,
+            "status": self.status,
+            "total": self.total,
+            "processed": self.processed,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "errors": self.errors,
+            "error": self.error,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class IdempotencyKey(db.Model):
+    """Response of a POST sent with an Idempotency-Key header, replayed for its retries.
+
+    Rows are claimed ("in_progress") before the request runs and expire after
+    IDEMPOTENCY_TTL_HOURS, see api.idempotency.
+    """
+    __tablename__ = 'idempotency_key'
+    scope: Mapped[str] = mapped_column(String(120), primary_key=True)
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    request_hash: Mapped[str] = mapped_column(String(64), nullable=False)
+    status: Mapped[str] = mapped_column(String(12), nullable=False)
+    response_status: Mapped[int] = mapped_column(Integer, nullable=True)
+    response_body: Mapped[bytes] = mapped_column(db.LargeBinary, nullable=True)
+    response_headers: Mapped[list] = mapped_column(db.JSON, nullable=True)
+    locked_at: Mapped[datetime] = mapped_column(nullable=False)
+    expires_at: Mapped[datetime] = mapped_column(nullable=False, index=True)
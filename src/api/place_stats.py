@@ -0,0 +1,336 @@
+"""
+Per-city and per-country summary statistics: number of POIs, favorites and
+visits, and a histogram of the POI tags.
+
+The numbers live in place_stats and place_tag_stats keyed by scope ('city' or
+'country') and place id, so reading them is a primary key lookup and not a
+GROUP BY over the POIs. They are maintained in the same transaction as the
+writes that change them: before every flush the pending POI, tag, favorite,
+visit, city, country and user changes are turned into counter deltas
+(including the rows ON DELETE CASCADE is about to remove) and applied with one
+upsert per table. Bulk loaders bypass the session and call
+rebuild_place_stats() afterwards, which is also the `flask rebuild-stats`
+command.
+"""
+from collections import defaultdict
+from sqlalchemy import delete, event, func, inspect, literal, select, String
+from sqlalchemy.dialects import postgresql, sqlite
+from api.models import (db, City, Country, Favorite, PlaceStats, PlaceTagStats, Poi,
+                        PoiTag, Tag, User, Visited)
+
+COUNTERS = ('poi_count', 'favorite_count', 'visited_count')
+TRACKED = (Country, City, Poi, PoiTag, Tag, Favorite, Visited, User)
+
+
+class _Deltas:
+    """Counter changes of one flush, for a city and its country at once."""
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.tags = defaultdict(int)
+        self.removed = {'city': set(), 'country': set()}
+
+    def add(self, place, counter, n):
+        city_id, country_id = place
+        self.counts[('city', city_id, counter)] += n
+        self.counts[('country', country_id, counter)] += n
+
+    def add_tag(self, place, tag_id, n):
+        city_id, country_id = place
+        self.tags[('city', city_id, tag_id)] += n
+        self.tags[('country', country_id, tag_id)] += n
+
+
+def _committed(obj, attr):
+    """Value of an attribute as it is in the database, before pending changes."""
+    history = inspect(obj).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(obj, attr)
+
+
+def _pending_id(obj, relationship):
+    """Foreign key of a new row, also when it was only given the related object."""
+    value = getattr(obj, f'{relationship}_id')
+    if value is None:
+        related = getattr(obj, relationship)
+        value = related.id if related is not None else None
+    return value
+
+
+def _city_countries(session, connection, city_ids):
+    countries = {obj.id: obj.country_id for obj in session.new if isinstance(obj, City)}
+    missing = set(city_ids) - countries.keys()
+    if missing:
+        countries.update(connection.execute(
+            select(City.id, City.country_id).where(City.id.in_(missing))).all())
+    return countries
+
+
+def _poi_places(session, connection, poi_ids):
+    """(city_id, country_id) of POIs, as stored or as pending for new POIs."""
+    cities = {obj.id: obj.city_id for obj in session.new
+              if isinstance(obj, Poi) and obj.id in poi_ids}
+    missing = set(poi_ids) - cities.keys()
+    if missing:
+        cities.update(connection.execute(
+            select(Poi.id, Poi.city_id).where(Poi.id.in_(missing))).all())
+    countries = _city_countries(session, connection, set(cities.values()))
+    return {poi_id: (city_id, countries[city_id])
+            for poi_id, city_id in cities.items() if city_id in countries}
+
+
+def _add_pois(connection, deltas, places, sign, skip_tags=()):
+    """Add (or with sign=-1 remove) stored POIs and everything counted for them."""
+    if not places:
+        return
+    ids = list(places)
+    for model, counter in ((Favorite, 'favorite_count'), (Visited, 'visited_count')):
+        for poi_id, n in connection.execute(select(model.poi_id, func.count())
+                                            .where(model.poi_id.in_(ids)).group_by(model.poi_id)):
+            deltas.add(places[poi_id], counter, sign * n)
+    for poi_id, tag_id in connection.execute(select(PoiTag.poi_id, PoiTag.tag_id)
+                                             .where(PoiTag.poi_id.in_(ids))):
+        if tag_id not in skip_tags:
+            deltas.add_tag(places[poi_id], tag_id, sign)
+    for place in places.values():
+        deltas.add(place, 'poi_count', sign)
+
+
+def _add_cities_to_countries(connection, deltas, countries, sign):
+    """Move the stored totals of cities into (or out of) the given countries."""
+    if not countries:
+        return
+    ids = list(countries)
+    for row in connection.execute(select(PlaceStats).where(
+            PlaceStats.scope == 'city', PlaceStats.place_id.in_(ids))):
+        for counter in COUNTERS:
+            deltas.counts[('country', countries[row.place_id], counter)] += sign * getattr(row, counter)
+    for place_id, tag_id, n in connection.execute(
+            select(PlaceTagStats.place_id, PlaceTagStats.tag_id, PlaceTagStats.poi_count).where(
+                PlaceTagStats.scope == 'city', PlaceTagStats.place_id.in_(ids))):
+        deltas.tags[('country', countries[place_id], tag_id)] += sign * n
+
+
+def _increment(connection, table, keys, counters):
+    """INSERT ... ON CONFLICT DO UPDATE that adds the given counters."""
+    insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=keys, set_={counter: table.c[counter] + stmt.excluded[counter]
+                                   for counter in counters})
+
+
+def _apply(connection, deltas):
+    places = defaultdict(dict)
+    for (scope, place_id, counter), n in deltas.counts.items():
+        if n and place_id not in deltas.removed[scope]:
+            places[(scope, place_id)][counter] = n
+    rows = [{'scope': scope, 'place_id': place_id,
+             **{counter: values.get(counter, 0) for counter in COUNTERS}}
+            for (scope, place_id), values in places.items()]
+    if rows:
+        connection.execute(_increment(connection, PlaceStats.__table__,
+                                      ['scope', 'place_id'], COUNTERS), rows)
+
+    rows = [{'scope': scope, 'place_id': place_id, 'tag_id': tag_id, 'poi_count': n}
+            for (scope, place_id, tag_id), n in deltas.tags.items()
+            if n and place_id not in deltas.removed[scope]]
+    if rows:
+        connection.execute(_increment(connection, PlaceTagStats.__table__,
+                                      ['scope', 'place_id', 'tag_id'], ['poi_count']), rows)
+
+    for scope, ids in deltas.removed.items():
+        if ids:
+            for model in (PlaceStats, PlaceTagStats):
+                connection.execute(delete(model).where(
+                    model.scope == scope, model.place_id.in_(list(ids))))
+
+
+def _update_place_stats(session, flush_context, instances):
+    new, deleted, dirty = defaultdict(list), defaultdict(list), defaultdict(list)
+    for objects, groups in ((session.new, new), (session.deleted, deleted)):
+        for obj in objects:
+            if isinstance(obj, TRACKED):
+                groups[type(obj)].append(obj)
+    for obj in session.dirty:
+        if isinstance(obj, (City, Poi)) and session.is_modified(obj, include_collections=False):
+            dirty[type(obj)].append(obj)
+    if not (new or deleted or dirty):
+        return
+    connection = session.connection()
+    deltas = _Deltas()
+
+    # countries and cities going away, with everything the database cascades
+    removed_countries = {country.id for country in deleted[Country]}
+    deltas.removed['country'] |= removed_countries
+    if removed_countries:
+        deltas.removed['city'] |= set(connection.execute(
+            select(City.id).where(City.country_id.in_(removed_countries))).scalars())
+    removed_cities = {city.id: _committed(city, 'country_id') for city in deleted[City]}
+    removed_cities = {city_id: country_id for city_id, country_id in removed_cities.items()
+                      if country_id not in removed_countries}
+    _add_cities_to_countries(connection, deltas, removed_cities, -1)
+    deltas.removed['city'] |= removed_cities.keys()
+    for city in dirty[City]:
+        old_country_id = _committed(city, 'country_id')
+        if old_country_id != city.country_id:
+            _add_cities_to_countries(connection, deltas, {city.id: old_country_id}, -1)
+            _add_cities_to_countries(connection, deltas, {city.id: city.country_id}, 1)
+
+    removed_tags = {tag.id for tag in deleted[Tag]}
+    removed_pois = {poi.id for poi in deleted[Poi]}
+    if removed_pois:
+        places = _poi_places(session, connection, removed_pois)
+        _add_pois(connection, deltas, {poi_id: place for poi_id, place in places.items()
+                                       if place[0] not in deltas.removed['city']},
+                  -1, skip_tags=removed_tags)
+    for poi in dirty[Poi]:
+        old_city_id = _committed(poi, 'city_id')
+        if old_city_id != poi.city_id:
+            countries = _city_countries(session, connection, {old_city_id, poi.city_id})
+            if old_city_id in countries:
+                _add_pois(connection, deltas, {poi.id: (old_city_id, countries[old_city_id])}, -1)
+            if poi.city_id in countries:
+                _add_pois(connection, deltas, {poi.id: (poi.city_id, countries[poi.city_id])}, 1)
+    if new[Poi]:
+        for place in _poi_places(session, connection, {poi.id for poi in new[Poi]}).values():
+            deltas.add(place, 'poi_count', 1)
+
+    # favorites and visits of deleted users are removed by the database
+    removed_users = {user.id for user in deleted[User]}
+    changes = []
+    if removed_users:
+        for model, counter in ((Favorite, 'favorite_count'), (Visited, 'visited_count')):
+            changes.extend((poi_id, counter, -1) for poi_id in connection.execute(
+                select(model.poi_id).where(model.user_id.in_(removed_users))).scalars())
+    for model, counter in ((Favorite, 'favorite_count'), (Visited, 'visited_count')):
+        changes.extend((_pending_id(obj, 'poi'), counter, 1) for obj in new[model])
+        changes.extend((obj.poi_id, counter, -1) for obj in deleted[model]
+                       if obj.user_id not in removed_users)
+    tag_changes = [(_pending_id(obj, 'poi'), _pending_id(obj, 'tag'), 1) for obj in new[PoiTag]]
+    tag_changes.extend((obj.poi_id, obj.tag_id, -1) for obj in deleted[PoiTag]
+                       if obj.tag_id not in removed_tags)
+    poi_ids = {poi_id for poi_id, _, _ in changes + tag_changes} - removed_pois
+    if poi_ids:
+        places = _poi_places(session, connection, poi_ids)
+        for poi_id, counter, n in changes:
+            if poi_id in places:
+                deltas.add(places[poi_id], counter, n)
+        for poi_id, tag_id, n in tag_changes:
+            if poi_id in places:
+                deltas.add_tag(places[poi_id], tag_id, n)
+
+    _apply(connection, deltas)
+
+
+def rebuild_place_stats(connection):
+    """
+    Recompute both statistics tables from the catalog with set-based queries.
+    Args:
+        connection (Connection): Connection of the transaction to rebuild in.
+    """
+    connection.execute(delete(PlaceTagStats))
+    connection.execute(delete(PlaceStats))
+
+    totals = [select(Poi.city_id.label('city_id'), func.count().label('n'))
+              .group_by(Poi.city_id).subquery()]
+    for model in (Favorite, Visited):
+        totals.append(select(Poi.city_id.label('city_id'), func.count().label('n'))
+                      .select_from(model).join(Poi, model.poi_id == Poi.id)
+                      .group_by(Poi.city_id).subquery())
+    cities = select(literal('city', String), City.id,
+                    *[func.coalesce(total.c.n, 0) for total in totals]).select_from(City)
+    for total in totals:
+        cities = cities.outerjoin(total, total.c.city_id == City.id)
+    columns = ['scope', 'place_id', *COUNTERS]
+    connection.execute(PlaceStats.__table__.insert().from_select(columns, cities))
+    connection.execute(PlaceStats.__table__.insert().from_select(columns, select(
+        literal('country', String), City.country_id,
+        *[func.sum(getattr(PlaceStats, counter)) for counter in COUNTERS])
+        .join(City, PlaceStats.place_id == City.id).where(PlaceStats.scope == 'city')
+        .group_by(City.country_id)))
+
+    columns = ['scope', 'place_id', 'tag_id', 'poi_count']
+    connection.execute(PlaceTagStats.__table__.insert().from_select(columns, select(
+        literal('city', String), Poi.city_id, PoiTag.tag_id, func.count())
+        .join(Poi, PoiTag.poi_id == Poi.id).group_by(Poi.city_id, PoiTag.tag_id)))
+    connection.execute(PlaceTagStats.__table__.insert().from_select(columns, select(
+        literal('country', String), City.country_id, PlaceTagStats.tag_id,
+        func.sum(PlaceTagStats.poi_count))
+        .join(City, PlaceTagStats.place_id == City.id).where(PlaceTagStats.scope == 'city')
+        .group_by(City.country_id, PlaceTagStats.tag_id)))
+
+
+def _stats_rows(connection):
+    counts = {(row.scope, row.place_id): tuple(getattr(row, counter) for counter in COUNTERS)
+              for row in connection.execute(select(PlaceStats))}
+    tags = {(row.scope, row.place_id, row.tag_id): row.poi_count
+            for row in connection.execute(select(PlaceTagStats))}
+    # a place or tag without anything counted is the same as no row
+    return ({key: value for key, value in counts.items() if any(value)},
+            {key: value for key, value in tags.items() if value})
+
+
+def check_place_stats(connection):
+    """
+    Compare the maintained statistics with a rebuild from the catalog.
+    The rebuild is left in the transaction, the caller rolls it back.
+    Args:
+        connection (Connection): Connection of the transaction to compare in.
+    Returns:
+        list: (key, maintained value, rebuilt value) of every difference, empty when they agree.
+    """
+    maintained = _stats_rows(connection)
+    rebuild_place_stats(connection)
+    rebuilt = _stats_rows(connection)
+    differences = []
+    for kept, fresh in zip(maintained, rebuilt):
+        for key in sorted(kept.keys() | fresh.keys()):
+            if kept.get(key) != fresh.get(key):
+                differences.append((key, kept.get(key), fresh.get(key)))
+    return differences
+
+
+def get_place_stats(scope, place_ids):
+    """
+    Read the statistics of several cities or countries.
+    Args:
+        scope (str): 'city' or 'country'.
+        place_ids (list): Ids of the places.
+    Returns:
+        dict: place id -> poi_count, favorite_count, visited_count and tags
+            (tag name -> number of POIs, most common first).
+    """
+    stats = {place_id: {'poi_count': 0, 'favorite_count': 0, 'visited_count': 0, 'tags': {}}
+             for place_id in place_ids}
+    if not stats:
+        return stats
+    ids = list(stats)
+    for row in db.session.execute(select(PlaceStats).where(
+            PlaceStats.scope == scope, PlaceStats.place_id.in_(ids))).scalars():
+        for counter in COUNTERS:
+            stats[row.place_id][counter] = getattr(row, counter)
+    for place_id, name, n in db.session.execute(
+            select(PlaceTagStats.place_id, Tag.name, PlaceTagStats.poi_count)
+            .join(Tag, PlaceTagStats.tag_id == Tag.id)
+            .where(PlaceTagStats.scope == scope, PlaceTagStats.place_id.in_(ids),
+                   PlaceTagStats.poi_count > 0)
+            .order_by(PlaceTagStats.poi_count.desc(), Tag.name)):
+        stats[place_id]['tags'][name] = n
+    return stats
+
+
+_listeners_installed = False
+
+
+def setup_place_stats(app):
+    """
+    Keep the place statistics up to date on writes made through the session.
+    Args:
+        app (Flask): The application (the listener is shared by all apps).
+    """
+    global _listeners_installed
+    if not _listeners_installed:
+        event.listen(db.session, 'before_flush', _update_place_stats)
+        _listeners_installed = True
@@ -0,0 +1,166 @@
+"""
+Per-process cache of the encoded JSON of the POIs, for the POI listings.
+
+Poi.serialize() reads the images and tags of every POI, so encoding a large
+listing costs several queries and a dict per POI. The cache keeps the encoded
+bytes of each POI and listings embed them with json_fragment(), which the JSON
+provider writes out verbatim.
+
+The cache follows the change feed: before every use it reads the change_log
+entries recorded since it last looked and drops the POIs whose row, images or
+tags changed (a renamed tag drops the POIs that carry it). Sequence numbers
+become visible in commit order, so nothing committed before a listing starts is
+missed. A POI encoded while a commit changes it is only stored when no change
+was applied in the meantime, and is dropped on the next use otherwise.
+"""
+import threading
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import select
+from api.models import db, ChangeLog, Poi, PoiImage
+from api.change_feed import current_seq
+from api.json_provider import json_fragment
+
+ENTITIES = ('pois', 'images', 'poi_tags', 'tags')
+CLEAR_AFTER_CHANGES = 5000
+LOAD_CHUNK = 500
+
+
+class PoiJSONCache:
+    """Encoded POIs of this worker, dropped as the change feed reports their changes."""
+
+    def __init__(self, max_entries=50000):
+        self.max_entries = max_entries
+        self.seq = None
+        self._entries = OrderedDict()
+        self._image_pois = {}
+        self._tag_pois = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        self._entries.clear()
+        self._image_pois.clear()
+        self._tag_pois.clear()
+
+    def _drop(self, poi_id):
+        self._entries.pop(poi_id, None)
+
+    def _apply(self, changes):
+        images = {}
+        for entity, entity_id in changes:
+            if entity == 'pois':
+                self._drop(entity_id)
+            elif entity == 'poi_tags':
+                self._drop(entity_id.split(':', 1)[0])
+            elif entity == 'tags':
+                for poi_id in self._tag_pois.pop(entity_id, ()):
+                    self._drop(poi_id)
+            else:
+                if entity_id in self._image_pois:
+                    self._drop(self._image_pois.pop(entity_id))
+                images[entity_id] = None
+        if images:
+            # the POI an image was added or moved to
+            for poi_id in db.session.scalars(select(PoiImage.poi_id).where(PoiImage.id.in_(list(images)))):
+                self._drop(poi_id)
+
+    def sync(self):
+        """
+        Drop the POIs changed since the last call.
+        Returns:
+            int: Sequence number the cache is now up to date with.
+        """
+        seq = current_seq()
+        with self._lock:
+            if self.seq is None:
+                self.clear()
+            elif seq <= self.seq:
+                # another request already applied these changes
+                return self.seq
+            else:
+                changes = db.session.execute(
+                    select(ChangeLog.entity, ChangeLog.entity_id)
+                    .where(ChangeLog.seq > self.seq, ChangeLog.seq <= seq,
+                           ChangeLog.entity.in_(ENTITIES))
+                    .limit(CLEAR_AFTER_CHANGES + 1)).all()
+                if len(changes) > CLEAR_AFTER_CHANGES:
+                    self.clear()
+                else:
+                    self._apply(changes)
+            self.seq = seq
+        return seq
+
+    def serialize(self, pois, seq):
+        """
+        Encoded JSON of POIs, from the cache or serialized and stored.
+        Args:
+            pois (list): Poi objects.
+            seq (int): What sync() returned before the POIs were loaded.
+        Returns:
+            list: json_fragment() of every POI, in order.
+        """
+        cached = [self._entries.get(poi.id) for poi in pois]
+        missing = [poi.id for poi, data in zip(pois, cached) if data is None]
+        # images and tags of the POIs to encode in a few queries instead of two per POI
+        for start in range(0, len(missing), LOAD_CHUNK):
+            db.session.scalars(select(Poi).where(Poi.id.in_(missing[start:start + LOAD_CHUNK]))
+                               .options(*Poi.serialize_options())).all()
+        fragments, encoded = [], []
+        for poi, data in zip(pois, cached):
+            if data is None:
+                data = current_app.json.dumps_bytes(poi.serialize())
+                encoded.append((poi, data))
+            fragments.append(json_fragment(data))
+        if encoded:
+            with self._lock:
+                # a change applied meanwhile may be newer than what was encoded
+                if self.seq == seq:
+                    for poi, data in encoded:
+                        self._store(poi, data)
+        return fragments
+
+    def _store(self, poi, data):
+        self._entries[poi.id] = data
+        self._entries.move_to_end(poi.id)
+        for image in poi.images:
+            self._image_pois[image.id] = poi.id
+        for poi_tag in poi.poi_tags:
+            self._tag_pois.setdefault(poi_tag.tag_id, set()).add(poi.id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def serialize_pois(pois, seq=None):
+    """
+    Encoded JSON of POIs for a response, through the cache when it is enabled.
+    Args:
+        pois (list): Poi objects.
+        seq (int, optional): What the cache's sync() returned before the POIs were loaded.
+    Returns:
+        list: Serialized POIs, or json_fragment() of their encoded JSON.
+    """
+    cache = current_app.extensions.get('poi_cache')
+    if cache is None or seq is None:
+        return [poi.serialize() for poi in pois]
+    return cache.serialize(pois, seq)
+
+
+def sync_poi_cache():
+    """
+    Bring the cache up to date before loading POIs.
+    Returns:
+        int: Value to pass to serialize_pois(), None when the cache is disabled.
+    """
+    cache = current_app.extensions.get('poi_cache')
+    return cache.sync() if cache is not None else None
+
+
+def setup_poi_cache(app):
+    """
+    Create the encoded POI cache of the application (POI_CACHE_SIZE entries, 0 disables it).
+    Args:
+        app (Flask): The application.
+    """
+    app.config.setdefault('POI_CACHE_SIZE', 50000)
+    if app.config['POI_CACHE_SIZE'] > 0:
+        app.extensions['poi_cache'] = PoiJSONCache(app.config['POI_CACHE_SIZE'])
@@ -0,0 +1,152 @@
+"""
+Debug/profiling mode that watches the SQL issued while handling a request.
+
+Identical statements (same SQL text, any parameters) are grouped per request
+and a warning is logged when one repeats more than N_PLUS_ONE_THRESHOLD times,
+with the route and the application frame that first issued it, which is the
+typical signature of lazy loads inside a serialization loop. Statements slower
+than SLOW_QUERY_MS are logged with their plan (EXPLAIN, or EXPLAIN ANALYZE for
+SELECTs when enabled on Postgres), and with their parameters only when
+LOG_QUERY_PARAMETERS is on, since they can hold emails or password hashes.
+
+The plan is read on the request's own connection inside a savepoint that is
+always rolled back, so a failed EXPLAIN does not abort the request's
+transaction and whatever EXPLAIN ANALYZE executed is undone. Statements that
+take locks (SELECT ... FOR UPDATE/SHARE, advisory locks) only get a plain
+EXPLAIN, which does not run them.
+
+Only a QUERY_PROFILER_SAMPLE_RATE fraction of requests is profiled and the
+others return from the SQL hooks right away, so it can be sampled in production.
+"""
+import os
+import random
+import re
+import sys
+import time
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+THIS_FILE = os.path.realpath(__file__)
+LOCKING_RE = re.compile(
+    r'\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b|\bpg_(try_)?advisory', re.IGNORECASE)
+SAVEPOINT = 'query_profiler_explain'
+
+
+def _app_frame():
+    """Return 'file:line in function' of the innermost frame of our own code."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.realpath(frame.f_code.co_filename)
+        if (filename.startswith(APP_ROOT) and filename != THIS_FILE
+                and 'site-packages' not in filename):
+            return f'{os.path.relpath(filename, APP_ROOT)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return 'unknown'
+
+
+def _explain(conn, statement, parameters, analyze):
+    """Return the plan of a statement as text, run on the raw DBAPI connection in a savepoint."""
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        analyze = analyze and not LOCKING_RE.search(statement)
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN '
+    elif dialect == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    # a raw cursor keeps the plan query out of the engine events
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(f'SAVEPOINT {SAVEPOINT}')
+    except Exception as e:
+        cursor.close()
+        return f'EXPLAIN skipped, no savepoint: {e}'
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return '\n'.join(' '.join(str(col) for col in row) for row in cursor.fetchall())
+    except Exception as e:
+        return f'EXPLAIN failed: {e}'
+    finally:
+        cursor.execute(f'ROLLBACK TO SAVEPOINT {SAVEPOINT}')
+        cursor.execute(f'RELEASE SAVEPOINT {SAVEPOINT}')
+        cursor.close()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_request_context() and g.get('_query_profile') is not None:
+        context._profiler_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_profiler_started', None)
+    if started is None or not has_request_context():
+        return
+    profile = g.get('_query_profile')
+    if profile is None:
+        return
+    elapsed = time.perf_counter() - started
+    entry = profile.get(statement)
+    if entry is None:
+        entry = profile[statement] = [0, 0.0, _app_frame()]
+    entry[0] += 1
+    entry[1] += elapsed
+
+    config = current_app.config
+    if elapsed * 1000 >= config['SLOW_QUERY_MS']:
+        plan = None
+        is_select = statement.lstrip().upper().startswith('SELECT')
+        if is_select and not executemany:
+            plan = _explain(conn, statement, parameters,
+                            analyze=config['EXPLAIN_ANALYZE'])
+        if config['LOG_QUERY_PARAMETERS']:
+            statement = f'{statement}\nParameters: {parameters!r}'
+        current_app.logger.warning(
+            'Slow query (%.1f ms) on %s %s from %s:\n%s\nPlan:\n%s',
+            elapsed * 1000, request.method, request.path, entry[2], statement,
+            plan or 'not available')
+
+
+_listeners_installed = False
+
+
+def _install_sql_listeners():
+    global _listeners_installed
+    if not _listeners_installed:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listeners_installed = True
+
+
+def setup_query_profiler(app):
+    """
+    Enable the N+1 detector and slow query log for a sample of requests.
+    Args:
+        app (Flask): The application to profile.
+    """
+    app.config.setdefault('QUERY_PROFILER_SAMPLE_RATE', 1.0)
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', 5)
+    app.config.setdefault('SLOW_QUERY_MS', 200)
+    app.config.setdefault('EXPLAIN_ANALYZE', False)
+    app.config.setdefault('LOG_QUERY_PARAMETERS', False)
+    _install_sql_listeners()
+
+    @app.before_request
+    def start_query_profile():
+        if random.random() < app.config['QUERY_PROFILER_SAMPLE_RATE']:
+            g._query_profile = {}
+
+    @app.teardown_request
+    def report_query_profile(exc=None):
+        profile = g.pop('_query_profile', None)
+        if not profile:
+            return
+        threshold = app.config['N_PLUS_ONE_THRESHOLD']
+        for statement, (count, total, origin) in profile.items():
+            if count > threshold:
+                app.logger.warning(
+                    'Possible N+1 on %s %s (%s): statement repeated %d times '
+                    '(%.1f ms total), first issued from %s:\n%s',
+                    request.method, request.path, request.endpoint, count,
+                    total * 1000, origin, statement)
@@ -0,0 +1,171 @@
+"""
+Per-client rate limiting and load shedding for the API.
+
+Every /api request takes tokens from the bucket of its client: the JWT
+identity when a valid token is sent, the remote address otherwise. Behind a
+reverse proxy (Render, Heroku) the remote address is the proxy's unless
+PROXY_FIX_X_FOR is set to the number of proxies in front of the app, so that
+every anonymous client would share one bucket. Buckets
+hold RATE_LIMIT_BURST tokens and refill at RATE_LIMIT_PER_SECOND; a request
+costs 1 token unless its view is decorated with @rate_cost(n) (password
+hashing, unfiltered listings, bulk writes). Requests without enough tokens get
+a 429 with Retry-After. The buckets live in the worker (MemoryBucketStore);
+another store with the same take() method, e.g. one shared by all workers,
+can be passed to setup_rate_limit().
+
+Independently, a worker whose database pool is exhausted and that already
+has LOAD_SHED_QUEUE_DEPTH requests waiting behind it answers 503 with
+Retry-After right away, instead of queueing more work that would time out.
+That needs concurrent requests in the same worker, i.e. threaded (gthread) or
+gevent gunicorn workers: the default sync workers handle one request at a time
+and never wait for their pool, so they never shed.
+"""
+import math
+import threading
+import time
+from flask import current_app, g, jsonify, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from api.models import db
+
+PRUNE_INTERVAL = 60.0
+
+
+def rate_cost(cost):
+    """
+    Set the number of tokens a view takes from the client's bucket.
+    Args:
+        cost (int): Tokens per request (the default is 1).
+    Returns:
+        callable: Decorator to place right under the route decorator.
+    """
+    def decorator(view):
+        view.rate_limit_cost = cost
+        return view
+    return decorator
+
+
+class MemoryBucketStore:
+    """Token buckets of the clients seen by this worker."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+
+    def take(self, key, cost, rate, burst):
+        """
+        Take tokens from a bucket if it holds enough of them.
+        Args:
+            key (str): Client key.
+            cost (float): Tokens to take.
+            rate (float): Tokens added per second.
+            burst (float): Capacity of the bucket.
+        Returns:
+            tuple: (allowed, seconds until the request would be allowed).
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if now - self._pruned_at >= PRUNE_INTERVAL:
+                self._prune(now, rate, burst)
+        return allowed, 0.0 if allowed else (cost - tokens) / rate
+
+    def _prune(self, now, rate, burst):
+        # a bucket that has refilled is the same as no bucket
+        self._buckets = {key: (tokens, updated) for key, (tokens, updated) in self._buckets.items()
+                         if tokens + (now - updated) * rate < burst}
+        self._pruned_at = now
+
+
+def _client_key():
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+    except Exception:
+        identity = None
+    if identity is not None:
+        return f'user:{identity}'
+    return f'ip:{request.remote_addr}'
+
+
+def _pool_capacity(pool):
+    """Connections the pool can hand out and how many are out, or None for pools without a limit."""
+    size = getattr(pool, 'size', None)
+    if not callable(size) or not hasattr(pool, 'checkedout'):
+        return None
+    return size() + max(getattr(pool, '_max_overflow', 0), 0), pool.checkedout()
+
+
+def _retry_response(message, status_code, retry_after):
+    response = jsonify({'message': message})
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+class _InFlight:
+    """Number of API requests being handled by this worker."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self, n):
+        with self._lock:
+            self.count += n
+            return self.count
+
+
+def setup_rate_limit(app, store=None):
+    """
+    Rate limit and shed the load of the API requests of the app.
+    Args:
+        app (Flask): The application.
+        store (object, optional): Bucket store with a take(key, cost, rate, burst) method.
+            Defaults to a MemoryBucketStore per worker.
+    Returns:
+        object: The bucket store in use.
+    """
+    app.config.setdefault('RATE_LIMIT_PER_SECOND', 20.0)
+    app.config.setdefault('RATE_LIMIT_BURST', 100.0)
+    app.config.setdefault('LOAD_SHED_QUEUE_DEPTH', 20)
+    app.config.setdefault('LOAD_SHED_RETRY_AFTER', 1)
+    store = store or MemoryBucketStore()
+    app.extensions['rate_limit'] = store
+    in_flight = _InFlight()
+
+    @app.before_request
+    def limit_api_request():
+        if request.blueprint != 'api':
+            return None
+        g._in_flight = True
+        queued = in_flight.add(1)
+        depth = app.config['LOAD_SHED_QUEUE_DEPTH']
+        if depth:
+            capacity = _pool_capacity(db.engine.pool)
+            if capacity is not None and capacity[1] >= capacity[0] and queued - capacity[0] > depth:
+                current_app.logger.warning(f'Shedding {request.method} {request.path}: '
+                                           f'{queued} requests in flight for {capacity[0]} connections')
+                return _retry_response('Server busy, try again shortly', 503,
+                                       app.config['LOAD_SHED_RETRY_AFTER'])
+
+        view = app.view_functions.get(request.endpoint)
+        rate = app.config['RATE_LIMIT_PER_SECOND']
+        burst = app.config['RATE_LIMIT_BURST']
+        cost = min(getattr(view, 'rate_limit_cost', 1), burst)
+        allowed, retry_after = store.take(_client_key(), cost, rate, burst)
+        if not allowed:
+            return _retry_response('Too many requests', 429, retry_after)
+        return None
+
+    @app.teardown_request
+    def release_api_request(exc):
+        if g.pop('_in_flight', False):
+            in_flight.add(-1)
+
+    return store
@@ -0,0 +1,118 @@
+"""
+Item-item collaborative filtering over favorites and visits.
+
+`flask build-recommendations` reads every favorite and visit into a sparse
+user x POI matrix R (a favorite weighs FAVORITE_WEIGHT, a visit 1) and scores
+POI pairs with the cosine of their columns, R^T R normalised by the column
+norms. The product is computed for blocks of POIs at a time so memory stays
+bounded, and only the top K neighbours of each POI are kept in
+poi_cooccurrence.
+
+Recommendations for a user are the neighbours of the POIs they favorited or
+visited, summed by POI, without the ones they already know: a single grouped
+query over an indexed table.
+"""
+import time
+import numpy as np
+from scipy import sparse
+from sqlalchemy import delete, func, select, union
+from api.models import db, Favorite, Poi, PoiCooccurrence, Visited
+
+FAVORITE_WEIGHT = 2.0
+WRITE_BATCH = 10000
+
+
+def _interactions(favorite_weight):
+    """Return (user index, POI ids, sparse user x POI matrix)."""
+    users, pois = {}, {}
+    rows, cols, values = [], [], []
+    for model, weight in ((Favorite, favorite_weight), (Visited, 1.0)):
+        for user_id, poi_id in db.session.execute(
+                select(model.user_id, model.poi_id).execution_options(yield_per=WRITE_BATCH)):
+            rows.append(users.setdefault(user_id, len(users)))
+            cols.append(pois.setdefault(poi_id, len(pois)))
+            values.append(weight)
+    matrix = sparse.csr_matrix((np.asarray(values, dtype=np.float32), (rows, cols)),
+                               shape=(len(users), len(pois)))
+    return users, list(pois), matrix
+
+
+def _top_neighbours(block, offset, top_k):
+    """Yield (row, column, score) of the top_k largest entries of each row of a CSR block."""
+    for i in range(block.shape[0]):
+        start, stop = block.indptr[i], block.indptr[i + 1]
+        columns = block.indices[start:stop]
+        scores = block.data[start:stop]
+        keep = columns != offset + i
+        columns, scores = columns[keep], scores[keep]
+        if len(scores) > top_k:
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            columns, scores = columns[best], scores[best]
+        for column, score in zip(columns, scores):
+            if score > 0:
+                yield offset + i, column, float(score)
+
+
+def build_recommendations(top_k=20, favorite_weight=FAVORITE_WEIGHT, block_size=2000, progress=None):
+    """
+    Rebuild the item-item neighbours table from all favorites and visits.
+    Args:
+        top_k (int): Neighbours kept per POI.
+        favorite_weight (float): Weight of a favorite relative to a visit.
+        block_size (int): POIs whose co-occurrences are computed at a time.
+        progress (callable, optional): Called with (POIs done, total POIs).
+    Returns:
+        dict: POIs and neighbour rows written, and elapsed seconds.
+    """
+    started = time.perf_counter()
+    _, poi_ids, matrix = _interactions(favorite_weight)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    inverse = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    normalized = (matrix @ sparse.diags(inverse)).tocsc()
+    transposed = normalized.T.tocsr()
+
+    # readers keep seeing the previous neighbours until the commit
+    db.session.execute(delete(PoiCooccurrence))
+    written = 0
+    batch = []
+    for offset in range(0, len(poi_ids), block_size):
+        block = (transposed[offset:offset + block_size] @ normalized).tocsr()
+        for row, column, score in _top_neighbours(block, offset, top_k):
+            batch.append({'poi_id': poi_ids[row], 'related_poi_id': poi_ids[column], 'score': score})
+            if len(batch) >= WRITE_BATCH:
+                db.session.execute(PoiCooccurrence.__table__.insert(), batch)
+                written += len(batch)
+                batch = []
+        if progress:
+            progress(min(offset + block_size, len(poi_ids)), len(poi_ids))
+    if batch:
+        db.session.execute(PoiCooccurrence.__table__.insert(), batch)
+        written += len(batch)
+    db.session.commit()
+    return {'pois': len(poi_ids), 'rows': written, 'elapsed': time.perf_counter() - started}
+
+
+def recommend_for_user(user_id, limit):
+    """
+    Recommend POIs to a user from the neighbours of the POIs they interacted with.
+    Args:
+        user_id (str): User ID.
+        limit (int): Maximum number of POIs.
+    Returns:
+        list: (score, Poi) pairs, best first, without the user's favorites and visited POIs.
+    """
+    known = union(select(Favorite.poi_id).where(Favorite.user_id == user_id),
+                  select(Visited.poi_id).where(Visited.user_id == user_id)).subquery()
+    score = func.sum(PoiCooccurrence.score).label('score')
+    ranked = db.session.execute(
+        select(PoiCooccurrence.related_poi_id, score)
+        .where(PoiCooccurrence.poi_id.in_(select(known.c.poi_id)),
+               PoiCooccurrence.related_poi_id.not_in(select(known.c.poi_id)))
+        .group_by(PoiCooccurrence.related_poi_id)
+        .order_by(score.desc(), PoiCooccurrence.related_poi_id).limit(limit)).all()
+    if not ranked:
+        return []
+    pois = {poi.id: poi for poi in db.session.scalars(
+        select(Poi).where(Poi.id.in_([poi_id for poi_id, _ in ranked]))
+        .options(*Poi.serialize_options()))}
+    return [(float(score), pois[poi_id]) for poi_id, score in ranked if poi_id in pois]
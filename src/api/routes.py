@@ -1,12 +1,29 @@
-from flask import Flask, request, jsonify, url_for, Blueprint, current_app
+from flask import Flask, request, jsonify, url_for, Blueprint, current_app, Response, send_file, stream_with_context
 import uuid
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import defer
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required
+from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required, verify_jwt_in_request
 from flask_cors import CORS
 from api.utils import generate_sitemap, APIException
-from api.models import db, User, Poi, Country, City, Favorite, Visited, PoiImage, Tag, PoiTag
+from api.models import db, User, Poi, Country, City, Favorite, Visited, PoiImage, Tag, PoiTag, BulkJob
+from api.catalog_export import iter_export_chunks
+from api.change_feed import MAX_LIMIT, changes_since, current_seq
+from api.country_tree import MAX_DEPTH, POI_FIELDS, build_country_tree
+from api.place_stats import get_place_stats
+from api.facets import FACETS, facet_counts
+from api.similarity import get_similar_pois
+from api.recommendations import recommend_for_user
+from api.trip import plan_trip
+from api.clusters import get_clusters
+from api.tiles import MAX_TILE_ZOOM, MIN_TILE_ZOOM, get_tile
+from api.rate_limit import rate_cost
+from api.poi_cache import serialize_pois, sync_poi_cache
+from api.single_flight import coalesce
+from api.jobs import MAX_JOB_ITEMS, create_job
+from api.idempotency import idempotent
+from api.autocomplete import MAX_SUGGESTIONS, TYPES as AUTOCOMPLETE_TYPES, get_autocomplete_index
 
 
 
@@ -19,6 +36,9 @@ COUNTRY_ALLOWED_FIELDS = {'name', 'img'}
 CITY_ALLOWED_FIELDS = {'name', 'img', 'season', 'country_id'}
 POI_ALLOWED_FIELDS = {'name', 'description',
                       'latitude', 'longitude', 'city_id'}
+MAX_IDS_PER_REQUEST = 100
+MAX_TRIP_STOPS = 500
+PLACE_INCLUDES = {'stats'}
 
 
 def handle_unexpected_error(context: str):
@@ -143,7 +163,146 @@ def normalize_body_to_list(body):
     return body
 
 
+def parse_ids_param(value, max_ids=MAX_IDS_PER_REQUEST):
+    """
+    Parse a comma separated "ids" query parameter.
+    Args:
+        value (str): Raw parameter value.
+        max_ids (int): Maximum number of ids accepted.
+    Raises:
+        APIException: If no id is given or more than max_ids are requested.
+    Returns:
+        list: Unique ids in the order they were given.
+    """
+    ids = list(dict.fromkeys(part.strip() for part in value.split(',') if part.strip()))
+    if not ids:
+        raise APIException('ids must be a comma separated list of ids', status_code=400)
+    if len(ids) > max_ids:
+        raise APIException(
+            f'At most {max_ids} ids can be requested at once', status_code=400)
+    return ids
+
+
+def wants_async():
+    """
+    Whether the client asked for a bulk write to run in the background (?async=true).
+    Returns:
+        bool: True when the async query parameter is true.
+    """
+    return request.args.get('async', '').strip().lower() in ('1', 'true', 'yes')
+
+
+def validate_bulk_items(kind, items):
+    """
+    Check the shape of the items of a bulk write before it is queued.
+    What needs the database (existing countries, cities, tags, POIs and names)
+    is checked by the job, item by item.
+    Args:
+        kind (str): 'pois', 'cities' or 'poiimages'.
+        items (list): Items of the request body.
+    Raises:
+        APIException: If there are too many items or one of them is invalid.
+    """
+    if len(items) > MAX_JOB_ITEMS:
+        raise APIException(
+            f'At most {MAX_JOB_ITEMS} items can be submitted at once', status_code=400)
+    seen_keys = set()
+    for item in items:
+        if kind == 'pois':
+            name = item.get('name')
+            require_body_fields(
+                item, ['name', 'description', 'latitude', 'longitude', 'country_name', 'city_name'],
+                item_name=name, optional_fields=['tags', 'poiimages'])
+            try:
+                float(item.get('latitude'))
+                float(item.get('longitude'))
+            except (TypeError, ValueError):
+                raise APIException('latitude/longitude must be numeric', 400)
+            for field, label in (('tags', 'tag'), ('poiimages', 'poiimage')):
+                values = item.get(field, [])
+                if not isinstance(values, list):
+                    raise APIException(f'{field} must be a list', 400)
+                if not all(isinstance(value, str) and value for value in values):
+                    raise APIException(f'each {label} must be a non-empty string', 400)
+            key = f"{name}:{item.get('city_name')}:{item.get('country_name')}"
+        elif kind == 'cities':
+            name = item.get('name')
+            require_body_fields(item, ['name', 'season', 'country_name'], item_name=name)
+            key = f"{name}:{item.get('country_name')}"
+        else:
+            require_body_fields(item, ['url', 'poi_id'], item_name=item.get('url'))
+            key = (item.get('url'), item.get('poi_id'))
+        if key in seen_keys:
+            raise APIException(f"Duplicate entry: {key[0] if isinstance(key, tuple) else key}",
+                               status_code=400)
+        seen_keys.add(key)
+
+
+def accept_bulk_job(kind, items):
+    """
+    Validate and queue a bulk write.
+    Args:
+        kind (str): 'pois', 'cities' or 'poiimages'.
+        items (list): Items of the request body.
+    Raises:
+        APIException: If the items are invalid.
+    Returns:
+        Response: 202 with the job, and its status URL in the Location header.
+    """
+    validate_bulk_items(kind, items)
+    try:
+        job = create_job(kind, items)
+    except Exception:
+        db.session.rollback()
+        handle_unexpected_error(f'queueing {kind}')
+    response = jsonify({'message': 'Job accepted', 'job': job.serialize()})
+    response.status_code = 202
+    response.headers['Location'] = url_for('api.get_job', job_id=job.id)
+    return response
+
+
+def get_objects_by_ids(model, ids):
+    """
+    Retrieve several objects by id with one query plus batched relationship loads.
+    Args:
+        model: The SQLAlchemy model class.
+        ids (list): Ids to retrieve.
+    Returns:
+        tuple: (objects found, in the order of ids; ids that do not exist).
+    """
+    objects = {obj.id: obj for obj in model.query.filter(
+        model.id.in_(ids)).options(*model.serialize_options())}
+    found = [objects[obj_id] for obj_id in ids if obj_id in objects]
+    not_found = [obj_id for obj_id in ids if obj_id not in objects]
+    return found, not_found
+
+
+def serialize_places(places, scope):
+    """
+    Serialize cities or countries, adding what the "include" query parameter asks for.
+    Args:
+        places (list): City or Country objects.
+        scope (str): 'city' or 'country'.
+    Raises:
+        APIException: If include names something that cannot be included.
+    Returns:
+        list: Serialized places, with a "stats" object each when include=stats.
+    """
+    include = {part.strip() for part in request.args.get('include', '').split(',') if part.strip()}
+    unknown = include - PLACE_INCLUDES
+    if unknown:
+        raise APIException(f"Unknown include: {', '.join(sorted(unknown))}", status_code=400)
+    data = [place.serialize() for place in places]
+    if 'stats' in include:
+        stats = get_place_stats(scope, [place.id for place in places])
+        for item in data:
+            item['stats'] = stats[item['id']]
+    return data
+
+
 @api.route('/register', methods=['POST'])
+@rate_cost(10)
+@idempotent
 def register():
     """
     Register a new user.
@@ -157,6 +316,9 @@ def register():
         - birth_date (str): The birth date of the user in mm/dd/yyyy format.
         - location (str, optional): The location of the user.
         - role (str, optional): The role of the user.
+    Headers:
+        - Idempotency-Key (str, optional): Unique key of the request; a retry with the same key
+          and body gets the first response back (Idempotent-Replayed header) instead of running again.
     Raises:
         APIException: If required fields are missing, the email/username already exists, or the birth_date format is invalid.
     Returns:
@@ -209,6 +371,7 @@ def register():
 
 
 @api.route('/login', methods=['POST'])
+@rate_cost(10)
 def login():
     """
     Log in a user.
@@ -261,6 +424,7 @@ def my_profile():
 
 
 @api.route('/myProfile', methods=['PUT'])
+@rate_cost(10)
 @jwt_required()
 def update_profile():
     """
@@ -335,6 +499,7 @@ def list_users():
 
 
 @api.route('/users', methods=['POST'])
+@rate_cost(10)
 def add_user():
     """
     Add a new user.
@@ -461,11 +626,15 @@ def favorites():
 
 @api.route('/favorites', methods=['POST'])
 @jwt_required()
+@idempotent
 def add_favorite():
     """
     Add a POI to the authenticated user's favorites.
     Args:
         None (expects a JSON body with poi_id).
+    Headers:
+        - Idempotency-Key (str, optional): Unique key of the request; a retry with the same key
+          and body gets the first response back (Idempotent-Replayed header) instead of running again.
     Raises:
         APIException: If authentication fails, required fields are missing, POI not found, or already in favorites.
     Returns:
@@ -490,7 +659,7 @@ def add_favorite():
             'Point of interest is already in favorites', status_code=400)
 
     try:
-        favorite = Favorite(user=user, poi=poi)
+        favorite = Favorite(user_id=user.id, poi_id=poi.id)
         db.session.add(favorite)
         db.session.commit()
         return jsonify({'message': 'Favorite added successfully', 'favorite': favorite.serialize()}), 201
@@ -532,6 +701,8 @@ def remove_favorite(poi_id):
 
 
 @api.route('/pois', methods=['GET'])
+@rate_cost(5)
+@coalesce
 def get_pois():
     """
     Retrieve POIs with optional filters via query string.
@@ -542,12 +713,36 @@ def get_pois():
         - tag_name (str, optional): Exact match on tag name.
         - country_name (str, optional): Exact match on country name.
         - city_name (str, optional): Exact match on city name.
+        - ids (str, optional): Comma separated POI IDs to fetch at once. The other filters are ignored.
+        - facets (str, optional): Comma separated facets to count for the filtered POIs:
+          tag, country, city and/or season.
+        - rows (bool, optional): 'false' to only return the facets, without loading the POIs.
     Raises:
-        APIException: If an unexpected error occurs.
+        APIException: If an unexpected error occurs, too many ids are requested, a facet is unknown
+            or rows is false without facets.
     Returns:
         Response: JSON list of POIs. Returns an empty list if none are found.
-    """
+            With ids, also a not_found list of the ids that do not exist.
+            With facets, also the POI counts per value of each facet, and no list with rows=false.
+    """
+    facets = request.args.get('facets')
+    if facets is not None:
+        facets = list(dict.fromkeys(part.strip() for part in facets.split(',') if part.strip()))
+        unknown = [facet for facet in facets if facet not in FACETS]
+        if unknown or not facets:
+            raise APIException(
+                f"facets must be a comma separated list of: {', '.join(FACETS)}", status_code=400)
+    rows = request.args.get('rows', '').lower() != 'false'
+    if not rows and not facets:
+        raise APIException('rows=false needs facets', status_code=400)
     try:
+        ids = request.args.get('ids')
+        if ids is not None:
+            pois, not_found = get_objects_by_ids(Poi, parse_ids_param(ids))
+            return jsonify({'message': 'POIs retrieved successfully',
+                            'pois': [poi.serialize() for poi in pois],
+                            'not_found': not_found}), 200
+
         q = Poi.query
 
         name = request.args.get('name')
@@ -570,15 +765,139 @@ def get_pois():
             q = q.join(Tag, Tag.id == PoiTag.tag_id).filter(
                 Tag.name == tag_name)
 
-        pois = q.all()
-        return jsonify({'message': 'POIs retrieved successfully', 'pois': [poi.serialize() for poi in pois]}), 200
+        response = {'message': 'POIs retrieved successfully'}
+        if rows:
+            seq = sync_poi_cache()
+            response['pois'] = serialize_pois(q.all(), seq)
+        if facets:
+            filtered = bool(name or country_name or city_name or tag_name)
+            response['facets'] = facet_counts(q, facets, filtered)
+        return jsonify(response), 200
     except APIException:
         raise
     except Exception:
         handle_unexpected_error('retrieving POIs')
 
 
+@api.route('/pois/clusters', methods=['GET'])
+@coalesce
+def get_poi_clusters():
+    """
+    Retrieve the POIs of a map viewport grouped in clusters.
+    Args:
+        None.
+    Query Parameters:
+        - zoom (int): Map zoom level, 0 to 22.
+        - bbox (str): Viewport as "west,south,east,north" in degrees. west > east crosses the antimeridian.
+    Raises:
+        APIException: If zoom or bbox are invalid, the viewport is too large for the zoom,
+            or an unexpected error occurs.
+    Returns:
+        Response: JSON with the clusters (centroid and count) and the individual POIs
+            of the areas with only a few of them.
+    """
+    try:
+        zoom = int(request.args.get('zoom', ''))
+    except ValueError:
+        raise APIException('zoom must be an integer', status_code=400)
+    if not 0 <= zoom <= 22:
+        raise APIException('zoom must be between 0 and 22', status_code=400)
+    try:
+        west, south, east, north = (float(part) for part in request.args.get('bbox', '').split(','))
+    except ValueError:
+        raise APIException('bbox must be "west,south,east,north" in degrees', status_code=400)
+    if not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south <= north <= 90):
+        raise APIException('bbox is out of range', status_code=400)
+    try:
+        result = get_clusters(zoom, west, south, east, north)
+    except ValueError as e:
+        raise APIException(str(e), status_code=400)
+    except Exception:
+        handle_unexpected_error('clustering POIs')
+    return jsonify({'message': 'Clusters retrieved successfully', **result}), 200
+
+
+@api.route('/tiles/<int:z>/<int:x>/<int:y>', methods=['GET'])
+@rate_cost(2)
+def get_map_tile(z, x, y):
+    """
+    Retrieve the POIs of an XYZ map tile as GeoJSON.
+    Args:
+        z (int): Zoom level, MIN_TILE_ZOOM to MAX_TILE_ZOOM (use /pois/clusters below it).
+        x, y (int): Tile column and row.
+    Query Parameters:
+        - tags (str, optional): Comma separated tag names, POIs with any of them.
+    Raises:
+        APIException: If the tile does not exist or an unexpected error occurs.
+    Returns:
+        Response: GeoJSON FeatureCollection, cacheable by browsers and CDNs (ETag, Cache-Control).
+    """
+    if not MIN_TILE_ZOOM <= z <= MAX_TILE_ZOOM:
+        raise APIException(f'z must be between {MIN_TILE_ZOOM} and {MAX_TILE_ZOOM}, '
+                           'use /api/pois/clusters for lower zooms', status_code=400)
+    if x >= 1 << z or y >= 1 << z:
+        raise APIException('Tile not found', status_code=404)
+    tags = sorted({part.strip() for part in request.args.get('tags', '').split(',') if part.strip()})
+    try:
+        path, data = get_tile(current_app.config['TILE_CACHE_DIR'], z, x, y, tags,
+                              current_app.config['TILE_CACHE_MAX_BYTES'])
+        max_age = current_app.config['TILE_MAX_AGE']
+        if path:
+            response = send_file(path, mimetype='application/geo+json', conditional=True, max_age=max_age)
+        else:
+            response = Response(data, mimetype='application/geo+json')
+            response.cache_control.max_age = max_age
+            response.add_etag()
+            response.make_conditional(request)
+        response.cache_control.public = True
+        return response
+    except APIException:
+        raise
+    except Exception:
+        handle_unexpected_error('retrieving map tile')
+
+
+@api.route('/autocomplete', methods=['GET'])
+def autocomplete():
+    """
+    Suggest country, city, POI and tag names for search-as-you-type.
+    Args:
+        None.
+    Query Parameters:
+        - q (str): Text typed so far. Accents and case are ignored.
+        - types (str, optional): Comma separated kinds to suggest: country, city, poi and/or tag. Defaults to all.
+        - limit (int, optional): Maximum number of suggestions, 1 to MAX_SUGGESTIONS (20). Defaults to 10.
+    Raises:
+        APIException: If q, types or limit are invalid, or an unexpected error occurs.
+    Returns:
+        Response: JSON list of suggestions (type, id, name and context), best first.
+    """
+    q = request.args.get('q', '')
+    if not q.strip():
+        raise APIException('q is required', status_code=400)
+    types = AUTOCOMPLETE_TYPES
+    if request.args.get('types') is not None:
+        types = [part.strip() for part in request.args.get('types').split(',') if part.strip()]
+        if not types or any(kind not in AUTOCOMPLETE_TYPES for kind in types):
+            raise APIException(
+                f"types must be a comma separated list of: {', '.join(AUTOCOMPLETE_TYPES)}", status_code=400)
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        raise APIException('limit must be an integer', status_code=400)
+    if not 1 <= limit <= MAX_SUGGESTIONS:
+        raise APIException(f'limit must be between 1 and {MAX_SUGGESTIONS}', status_code=400)
+    try:
+        suggestions = get_autocomplete_index().search(q, types=types, limit=limit)
+        return jsonify({'message': 'Suggestions retrieved successfully', 'suggestions': suggestions}), 200
+    except APIException:
+        raise
+    except Exception:
+        handle_unexpected_error('retrieving suggestions')
+
+
 @api.route('/pois/<string:poi_id>', methods=['GET'])
+@coalesce
 def get_poi(poi_id):
     """
     Retrieve details of a POI by its ID.
@@ -604,7 +923,42 @@ def get_poi(poi_id):
         handle_unexpected_error('retrieving POI')
 
 
+@api.route('/pois/<string:poi_id>/similar', methods=['GET'])
+@coalesce
+def get_similar(poi_id):
+    """
+    Retrieve the POIs most similar to a POI from the precomputed similarity index.
+    Args:
+        poi_id (str): POI ID.
+    Query Parameters:
+        - limit (int, optional): Maximum number of similar POIs, 1 to 50. Defaults to 10.
+    Raises:
+        APIException: If the POI is not found, limit is invalid or an unexpected error occurs.
+    Returns:
+        Response: JSON list of similar POIs with their score, best first.
+            Empty until `flask build-similarity` has indexed the POI.
+    """
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        raise APIException('limit must be an integer', status_code=400)
+    if not 1 <= limit <= 50:
+        raise APIException('limit must be between 1 and 50', status_code=400)
+    try:
+        get_object_or_404(Poi, unique_field_value=poi_id,
+                          not_found_message='Point of interest not found')
+        similar = get_similar_pois(poi_id, limit)
+        return jsonify({'message': 'Similar POIs retrieved successfully',
+                        'similar': [{'score': round(score, 4), 'poi': poi.serialize()}
+                                    for score, poi in similar]}), 200
+    except APIException:
+        raise
+    except Exception:
+        handle_unexpected_error('retrieving similar POIs')
+
+
 @api.route('/countries', methods=['GET'])
+@coalesce
 def get_countries():
     """
     Retrieve countries with optional filters via query string.
@@ -612,19 +966,29 @@ def get_countries():
         None.
     Query Parameters:
         - name (str, optional): Partial match on country name.
+        - ids (str, optional): Comma separated country IDs to fetch at once. The other filters are ignored.
+        - include (str, optional): 'stats' to add precomputed POI, favorite, visit and tag totals.
     Raises:
-        APIException: If an unexpected error occurs.
+        APIException: If an unexpected error occurs or too many ids are requested.
     Returns:
         Response: JSON list of countries. Returns an empty list if none are found.
+            With ids, also a not_found list of the ids that do not exist.
     """
     try:
+        ids = request.args.get('ids')
+        if ids is not None:
+            countries, not_found = get_objects_by_ids(Country, parse_ids_param(ids))
+            return jsonify({'message': 'Countries retrieved successfully',
+                            'countries': serialize_places(countries, 'country'),
+                            'not_found': not_found}), 200
+
         q = Country.query
 
         name = request.args.get('name')
         if name:
             q = q.filter(Country.name.ilike(f'%{name}%'))
         countries = q.all()
-        return jsonify({'message': 'Countries retrieved successfully', 'countries': [country.serialize() for country in countries]}), 200
+        return jsonify({'message': 'Countries retrieved successfully', 'countries': serialize_places(countries, 'country')}), 200
     except APIException:
         raise
     except Exception:
@@ -685,7 +1049,48 @@ def get_country(country_name):
         handle_unexpected_error('retrieving country')
 
 
+@api.route('/countries/<string:country_name>/tree', methods=['GET'])
+@coalesce
+def get_country_tree(country_name):
+    """
+    Retrieve a country with its cities and their POIs in a single response.
+    Args:
+        country_name (str): Country name.
+    Query Parameters:
+        - depth (int, optional): 0 for the country only, 1 to add its cities, 2 (default) to add their POIs.
+        - fields (str, optional): Comma separated POI fields besides the id
+          (name, description, latitude, longitude, images, tags). Defaults to all.
+    Raises:
+        APIException: If the country is not found, depth or fields are invalid, or an unexpected error occurs.
+    Returns:
+        Response: JSON with the country and its nested cities and POIs.
+    """
+    try:
+        depth = int(request.args.get('depth', MAX_DEPTH))
+    except ValueError:
+        raise APIException('depth must be an integer', status_code=400)
+    if not 0 <= depth <= MAX_DEPTH:
+        raise APIException(f'depth must be between 0 and {MAX_DEPTH}', status_code=400)
+    fields = request.args.get('fields')
+    poi_fields = POI_FIELDS
+    if fields is not None:
+        poi_fields = [field.strip() for field in fields.split(',') if field.strip()]
+        invalid = [field for field in poi_fields if field not in POI_FIELDS]
+        if invalid:
+            raise APIException(f"Unknown fields: {', '.join(invalid)}", status_code=400)
+    try:
+        country = build_country_tree(country_name, depth=depth, poi_fields=poi_fields)
+        if country is None:
+            raise APIException('Country not found', status_code=404)
+        return jsonify({'message': 'Country retrieved successfully', 'country': country}), 200
+    except APIException:
+        raise
+    except Exception:
+        handle_unexpected_error('retrieving country tree')
+
+
 @api.route('/cities', methods=['GET'])
+@coalesce
 def get_cities():
     """
     Retrieve cities with optional filters via query string.
@@ -695,12 +1100,22 @@ def get_cities():
         - season (str, optional): Exact match on preferred season.
         - country_name (str, optional): Exact match on country name.
         - name (str, optional): Partial match on city name.
+        - ids (str, optional): Comma separated city IDs to fetch at once. The other filters are ignored.
+        - include (str, optional): 'stats' to add precomputed POI, favorite, visit and tag totals.
     Raises:
-        APIException: If an unexpected error occurs.
+        APIException: If an unexpected error occurs or too many ids are requested.
     Returns:
         Response: JSON list of cities. Returns an empty list if none are found.
+            With ids, also a not_found list of the ids that do not exist.
     """
     try:
+        ids = request.args.get('ids')
+        if ids is not None:
+            cities, not_found = get_objects_by_ids(City, parse_ids_param(ids))
+            return jsonify({'message': 'Cities retrieved successfully',
+                            'cities': serialize_places(cities, 'city'),
+                            'not_found': not_found}), 200
+
         q = City.query
 
         season = request.args.get('season')
@@ -717,7 +1132,7 @@ def get_cities():
             q = q.filter(City.name.ilike(f'%{name}%'))
 
         cities = q.all()
-        return jsonify({'message': 'Cities retrieved successfully', 'cities': [city.serialize() for city in cities]}), 200
+        return jsonify({'message': 'Cities retrieved successfully', 'cities': serialize_places(cities, 'city')}), 200
     except APIException:
         raise
     except Exception:
@@ -751,6 +1166,7 @@ def get_city(city_id):
 
 
 @api.route('/popular-pois', methods=['GET'])
+@coalesce
 def get_popular_pois():
     """
     Retrieve a random list of up to 8 POIs.
@@ -772,6 +1188,104 @@ def get_popular_pois():
         handle_unexpected_error('retrieving popular POIs')
 
 
+@api.route('/recommendations', methods=['GET'])
+@jwt_required()
+def get_recommendations():
+    """
+    Recommend POIs to the authenticated user from what similar users favorited and visited.
+    Args:
+        None.
+    Query Parameters:
+        - limit (int, optional): Maximum number of POIs, 1 to 50. Defaults to 10.
+    Raises:
+        APIException: If limit is invalid or an unexpected error occurs.
+    Returns:
+        Response: JSON list of recommended POIs with their score, best first. Excludes the
+            user's favorites and visited POIs, and is empty for users without any.
+    """
+    user = get_authenticated_user()
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        raise APIException('limit must be an integer', status_code=400)
+    if not 1 <= limit <= 50:
+        raise APIException('limit must be between 1 and 50', status_code=400)
+    try:
+        recommended = recommend_for_user(user.id, limit)
+        return jsonify({'message': 'Recommendations retrieved successfully',
+                        'recommendations': [{'score': round(score, 4), 'poi': poi.serialize()}
+                                            for score, poi in recommended]}), 200
+    except APIException:
+        raise
+    except Exception:
+        handle_unexpected_error('retrieving recommendations')
+
+
+@api.route('/trips/plan', methods=['GET'])
+@rate_cost(5)
+def get_trip_plan():
+    """
+    Compute a short order to visit a set of POIs and the distances between them.
+    Args:
+        None.
+    Query Parameters:
+        - ids (str, optional): Comma separated POI IDs, up to 500.
+        - favorites (bool, optional): 'true' to plan the authenticated user's favorites instead (JWT required).
+        - city_id (str, optional): With favorites, only the favorites in this city.
+        - start (str, optional): ID of the POI to start from.
+        - round_trip (bool, optional): 'true' to come back to the start. Defaults to false.
+        - matrix (bool, optional): 'true' to include the distance matrix (km) in the order of "stops".
+    Raises:
+        APIException: If neither ids nor favorites are given, there are more than 500 stops,
+            start is not a stop, or an unexpected error occurs.
+    Returns:
+        Response: JSON with the stops in visiting order, the km of each leg, total_km and not_found ids.
+    """
+    if request.args.get('favorites', '').lower() == 'true':
+        verify_jwt_in_request()
+        user = get_authenticated_user()
+        q = Poi.query.join(Favorite, Favorite.poi_id == Poi.id).filter(Favorite.user_id == user.id)
+        if request.args.get('city_id'):
+            q = q.filter(Poi.city_id == request.args.get('city_id'))
+        pois, not_found = q.order_by(Poi.id).limit(MAX_TRIP_STOPS + 1).all(), []
+        if len(pois) > MAX_TRIP_STOPS:
+            raise APIException(f'At most {MAX_TRIP_STOPS} favorites can be planned at once, '
+                               'narrow them down with city_id', status_code=400)
+    elif request.args.get('ids') is not None:
+        ids = parse_ids_param(request.args.get('ids'), max_ids=MAX_TRIP_STOPS)
+        found = {poi.id: poi for poi in Poi.query.filter(Poi.id.in_(ids))}
+        pois = [found[poi_id] for poi_id in ids if poi_id in found]
+        not_found = [poi_id for poi_id in ids if poi_id not in found]
+    else:
+        raise APIException('ids or favorites=true is required', status_code=400)
+
+    start = request.args.get('start')
+    positions = {poi.id: i for i, poi in enumerate(pois)}
+    if start is not None and start not in positions:
+        raise APIException('start must be one of the stops', status_code=400)
+    try:
+        plan = plan_trip([poi.latitude for poi in pois], [poi.longitude for poi in pois],
+                         start=positions.get(start),
+                         round_trip=request.args.get('round_trip', '').lower() == 'true')
+        stops = [{'id': poi.id, 'name': poi.name, 'latitude': poi.latitude,
+                  'longitude': poi.longitude, 'city_id': poi.city_id} for poi in pois]
+        response = {
+            'message': 'Trip planned successfully',
+            'order': [stops[i] for i in plan['order']],
+            'legs_km': [round(leg, 3) for leg in plan['legs']],
+            'total_km': round(plan['total_km'], 3),
+            'not_found': not_found,
+        }
+        if request.args.get('matrix', '').lower() == 'true':
+            response['stops'] = [stop['id'] for stop in stops]
+            response['matrix'] = plan['matrix'].round(3).tolist()
+        return jsonify(response), 200
+    except APIException:
+        raise
+    except Exception:
+        handle_unexpected_error('planning trip')
+
+
 @api.route('/visited', methods=['GET'])
 @jwt_required()
 def get_visited_pois():
@@ -922,6 +1436,7 @@ def create_tag():
 
 
 @api.route('/tags', methods=['GET'])
+@coalesce
 def list_tags():
     """
     List all tags.
@@ -1135,6 +1650,7 @@ def get_images_of_poi(poi_id):
 
 
 @api.route('/poiimages', methods=['POST'])
+@rate_cost(10)
 def create_poi_image():
     """
     Create one or more POI images.
@@ -1143,13 +1659,18 @@ def create_poi_image():
     Body:
         - url (str): Image URL.
         - poi_id (str): Associated POI ID.
+    Query Parameters:
+        - async (bool, optional): 'true' to validate the items and write them in the background.
     Raises:
         APIException: If the POI does not exist or a database error occurs.
     Returns:
         Response: JSON with the created POI images and a success message.
+            With async, 202 and the queued job, to poll at the Location URL (/api/jobs/<id>).
     """
     body = request.get_json()
     items = normalize_body_to_list(body)
+    if wants_async():
+        return accept_bulk_job('poiimages', items)
 
     created = []
     seen_pairs = set()
@@ -1205,6 +1726,8 @@ def get_poi_image(image_id):
 
 
 @api.route('/pois', methods=['POST'])
+@rate_cost(10)
+@idempotent
 def create_poi():
     """
     Create one or more points of interest (POIs).
@@ -1219,13 +1742,21 @@ def create_poi():
         - city_name (str): City name.
         - tags (list): Optional. List of tags associated with the POI.
         - poiimages (list): Optional. List of POI images.  
+    Query Parameters:
+        - async (bool, optional): 'true' to validate the items and write them in the background.
+    Headers:
+        - Idempotency-Key (str, optional): Unique key of the request; a retry with the same key
+          and body gets the first response back (Idempotent-Replayed header) instead of running again.
     Raises:
         APIException: If the city does not exist, a duplicate name exists in the same city, or a database error occurs.
     Returns:
         Response: JSON with the created POIs and a success message.
+            With async, 202 and the queued job, to poll at the Location URL (/api/jobs/<id>).
     """
     body = request.get_json()
     items = normalize_body_to_list(body)
+    if wants_async():
+        return accept_bulk_job('pois', items)
 
     created = []
     poi_tag_relations = []
@@ -1408,6 +1939,7 @@ def delete_poi(poi_id):
 
 
 @api.route('/countries', methods=['POST'])
+@rate_cost(10)
 def create_country():
     """
     Create one or more countries.
@@ -1520,6 +2052,7 @@ def delete_country(country_name):
 
 
 @api.route('/cities', methods=['POST'])
+@rate_cost(10)
 def create_city():
     """
     Create one or more cities.
@@ -1529,13 +2062,18 @@ def create_city():
         - name (str): City name.
         - season (str): Preferred season.
         - country_name (str): Country name.
+    Query Parameters:
+        - async (bool, optional): 'true' to validate the items and write them in the background.
     Raises:
         APIException: If the provided country does not exist, a duplicate name exists in the same country, or a database error occurs.
     Returns:
         Response: JSON with the created cities and a success message.
+            With async, 202 and the queued job, to poll at the Location URL (/api/jobs/<id>).
     """
     body = request.get_json()
     items = normalize_body_to_list(body)
+    if wants_async():
+        return accept_bulk_job('cities', items)
 
     created = []
     seen_keys = set()
@@ -1718,6 +2256,7 @@ def delete_poi_image(image_id):
 
 
 @api.route('/<string:country_name>/cities', methods=['GET'])
+@coalesce
 def get_cities_by_country(country_name):
     """
     Retrieve all cities within a given country.
@@ -1738,8 +2277,94 @@ def get_cities_by_country(country_name):
             field_name='name'
         )
         cities = City.query.filter_by(country_id=country.id).all()
-        return jsonify({'message': 'Cities retrieved successfully', 'cities': [city.serialize() for city in cities]}), 200
+        return jsonify({'message': 'Cities retrieved successfully', 'cities': serialize_places(cities, 'city')}), 200
     except APIException:
         raise
     except Exception:
         handle_unexpected_error('retrieving cities by country')
+
+
+@api.route('/export', methods=['GET'])
+@rate_cost(50)
+def export_catalog():
+    """
+    Stream the whole catalog as NDJSON from a single consistent snapshot.
+    Args:
+        None.
+    Query Parameters:
+        - format (str, optional): 'ndjson' (default) or 'ndjson.gz' for a gzipped stream.
+    Raises:
+        APIException: If the format is not supported.
+    Returns:
+        Response: Streamed NDJSON with countries, cities, tags and one denormalized line per POI.
+            The X-Change-Seq header is the change feed cursor to sync from afterwards.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'ndjson.gz'):
+        raise APIException(
+            "format must be 'ndjson' or 'ndjson.gz'", status_code=400)
+    compress = export_format == 'ndjson.gz'
+    # read before the export snapshot starts, replaying a few changes is harmless
+    change_seq = current_seq()
+    response = Response(
+        stream_with_context(iter_export_chunks(compress=compress)),
+        mimetype='application/gzip' if compress else 'application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename=catalog.{export_format}'
+    response.headers['X-Change-Seq'] = str(change_seq)
+    return response
+
+
+@api.route('/changes', methods=['GET'])
+def get_changes():
+    """
+    Retrieve the catalog changes recorded after a cursor, for incremental sync.
+    Clients start from the X-Change-Seq header of /export (or since=0) and
+    call again with next_since until has_more is false.
+    Args:
+        None.
+    Query Parameters:
+        - since (int, optional): Sequence number of the last change already applied. Defaults to 0.
+        - limit (int, optional): Change log entries to read, 1 to 1000. Defaults to 500.
+    Raises:
+        APIException: If since or limit are not valid integers or an unexpected error occurs.
+    Returns:
+        Response: JSON with the changes (type, id, op, seq and data for upserts), next_since and has_more.
+    """
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', 500))
+    except ValueError:
+        raise APIException('since and limit must be integers', status_code=400)
+    if since < 0 or not 1 <= limit <= MAX_LIMIT:
+        raise APIException(
+            f'since must be >= 0 and limit between 1 and {MAX_LIMIT}', status_code=400)
+    try:
+        result = changes_since(since, limit)
+        return jsonify({'message': 'Changes retrieved successfully', **result}), 200
+    except APIException:
+        raise
+    except Exception:
+        handle_unexpected_error('retrieving changes')
+
+
+@api.route('/jobs/<string:job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Retrieve the progress of a bulk write queued with ?async=true.
+    Args:
+        job_id (str): Job ID.
+    Raises:
+        APIException: If the job is not found (finished jobs are kept JOB_RETENTION_HOURS).
+    Returns:
+        Response: JSON with the job: status (queued, running, done or failed), total, processed,
+            succeeded and failed item counts and the errors (index of the item and message).
+    """
+    try:
+        job = BulkJob.query.options(defer(BulkJob.items)).filter_by(id=job_id).first()
+        if not job:
+            raise APIException('Job not found', status_code=404)
+        return jsonify({'message': 'Job retrieved successfully', 'job': job.serialize()}), 200
+    except APIException:
+        raise
+    except Exception:
+        handle_unexpected_error('retrieving job')
@@ -0,0 +1,262 @@
+"""
+Deterministic synthetic catalog (countries -> cities -> POIs with tags and
+images, plus users with favorites and visits). The same seed always produces
+the same rows and ids, so runs against different commits are comparable.
+
+Rows are generated as a stream and written in large batches (COPY on
+Postgres, executemany elsewhere), so catalogs with millions of POIs are built
+in constant memory.
+"""
+import csv
+import io
+import random
+import time
+import uuid
+from datetime import datetime
+from itertools import accumulate
+from math import exp, gcd
+from werkzeug.security import generate_password_hash
+from api.models import db, User, Country, City, Poi, PoiImage, Tag, PoiTag, Favorite, Visited
+
+SEASONS = ['Spring', 'Summer', 'Autumn', 'Winter']
+TAG_NAMES = ['Museum', 'Beach', 'Park', 'Castle', 'Cathedral', 'Market', 'Viewpoint',
+             'Nightlife', 'Restaurant', 'Hiking', 'Lake', 'Bridge', 'Palace', 'Zoo',
+             'Gallery', 'Monument', 'Garden', 'Temple', 'Harbor', 'Old Town']
+SEED_PASSWORD = '123456'
+SAMPLE_SIZE = 100
+
+# parents first, so every flush satisfies the foreign keys
+WRITE_ORDER = (Country, City, Tag, Poi, PoiTag, PoiImage, User, Favorite, Visited)
+
+
+class CatalogSpec:
+    """
+    Sizes and distributions of the synthetic catalog.
+    tags_per_poi and images_per_poi are Poisson means, tag_skew is the Zipf
+    exponent of tag popularity and popularity_skew the power-law exponent used
+    to pick favorited/visited POIs (0 means uniform).
+    """
+
+    def __init__(self, countries=5, cities_per_country=10, pois_per_city=20, tags=20,
+                 tags_per_poi=3, images_per_poi=2, users=50, favorites_per_user=10,
+                 visited_per_user=10, tag_skew=1.0, popularity_skew=1.2, seed=42):
+        self.countries = countries
+        self.cities_per_country = cities_per_country
+        self.pois_per_city = pois_per_city
+        self.tags = tags
+        self.tags_per_poi = tags_per_poi
+        self.images_per_poi = images_per_poi
+        self.users = users
+        self.favorites_per_user = favorites_per_user
+        self.visited_per_user = visited_per_user
+        self.tag_skew = tag_skew
+        self.popularity_skew = popularity_skew
+        self.seed = seed
+
+    @property
+    def total_pois(self):
+        return self.countries * self.cities_per_country * self.pois_per_city
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def seeded_uuid(seed, kind, index):
+    """Return a stable UUID string for the index-th entity of a kind."""
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, f'odyssey:{seed}:{kind}:{index}'))
+
+
+def poisson(rng, mean):
+    """Draw from a Poisson distribution (Knuth's method, fine for small means)."""
+    if mean <= 0:
+        return 0
+    limit, k, p = exp(-mean), 0, 1.0
+    while True:
+        p *= rng.random()
+        if p <= limit:
+            return k
+        k += 1
+
+
+class RowWriter:
+    """
+    Buffers rows per table and writes them in batches inside the current
+    session transaction. Uses COPY when the database is Postgres.
+    """
+
+    def __init__(self, batch_size=10000, use_copy=None):
+        self.batch_size = batch_size
+        if use_copy is None:
+            use_copy = db.engine.dialect.name == 'postgresql'
+        self.use_copy = use_copy
+        self.buffers = {model: [] for model in WRITE_ORDER}
+        self.counts = {model.__tablename__: 0 for model in WRITE_ORDER}
+        self.started = time.perf_counter()
+
+    def add(self, model, row):
+        buffer = self.buffers[model]
+        buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for model in WRITE_ORDER:
+            rows = self.buffers[model]
+            if not rows:
+                continue
+            if self.use_copy:
+                self._copy(model, rows)
+            else:
+                db.session.execute(model.__table__.insert(), rows)
+            self.counts[model.__tablename__] += len(rows)
+            self.buffers[model] = []
+        db.session.commit()
+
+    def _copy(self, model, rows):
+        table = model.__table__
+        columns = [column.name for column in table.columns]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(['' if row.get(c) is None else row[c] for c in columns])
+        buffer.seek(0)
+        quote = db.engine.dialect.identifier_preparer.quote
+        sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            quote(table.name), ', '.join(quote(c) for c in columns))
+        cursor = db.session.connection().connection.driver_connection.cursor()
+        try:
+            cursor.copy_expert(sql, buffer)
+        finally:
+            cursor.close()
+
+    @property
+    def total_rows(self):
+        return sum(self.counts.values())
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def _power_law_index(rng, n, skew):
+    """Pick an index in [0, n) where low indices are far more likely for skew > 0."""
+    if skew <= 0:
+        return rng.randrange(n)
+    return min(n - 1, int(n * rng.random() ** (1.0 + skew)))
+
+
+def _coprime_stride(n, rng):
+    """Return a multiplier coprime with n, so (i * stride) % n permutes range(n)."""
+    if n <= 1:
+        return 1
+    stride = rng.randrange(n // 2, n) | 1
+    while gcd(stride, n) != 1:
+        stride += 1
+    return stride
+
+
+def seed_catalog(spec, batch_size=10000, use_copy=None, progress=None):
+    """
+    Stream a synthetic catalog into the database of the current app context.
+    Args:
+        spec (CatalogSpec): Sizes, distributions and random seed of the catalog.
+        batch_size (int): Rows buffered per table before writing.
+        use_copy (bool, optional): Force COPY on/off (default: on for Postgres).
+        progress (callable, optional): Called with the RowWriter after each POI city batch.
+    Returns:
+        dict: Row counts per table ('rows'), total 'elapsed' seconds and samples
+        of the generated names and ids ('country_names', 'city_names', 'pois',
+        'tags', 'users', 'user_names') to build requests against the catalog.
+    """
+    rng = random.Random(spec.seed)
+    writer = RowWriter(batch_size=batch_size, use_copy=use_copy)
+    seed = spec.seed
+    sample = {'country_names': [], 'city_names': [], 'pois': [], 'tags': [],
+              'users': [], 'user_names': []}
+
+    tag_names = (TAG_NAMES + [f'Tag {i}' for i in range(len(TAG_NAMES), spec.tags)])[:spec.tags]
+    tag_ids = [seeded_uuid(seed, 'tag', i) for i in range(len(tag_names))]
+    for tag_id, name in zip(tag_ids, tag_names):
+        writer.add(Tag, {'id': tag_id, 'name': name})
+    sample['tags'] = tag_names
+    tag_weights = list(accumulate(1.0 / (rank + 1) ** spec.tag_skew
+                                  for rank in range(len(tag_ids))))
+
+    poi_index = 0
+    for c in range(spec.countries):
+        country_id = seeded_uuid(seed, 'country', c)
+        country_name = f'Country {c}'
+        writer.add(Country, {'id': country_id, 'name': country_name,
+                             'img': f'https://picsum.photos/seed/country{c}/800/600'})
+        if len(sample['country_names']) < SAMPLE_SIZE:
+            sample['country_names'].append(country_name)
+        base_lat, base_lng = rng.uniform(-60, 60), rng.uniform(-170, 170)
+        for ci in range(spec.cities_per_country):
+            city_id = seeded_uuid(seed, 'city', c * spec.cities_per_country + ci)
+            city_name = f'City {c}-{ci}'
+            writer.add(City, {'id': city_id, 'name': city_name,
+                              'season': rng.choice(SEASONS), 'country_id': country_id})
+            if len(sample['city_names']) < SAMPLE_SIZE:
+                sample['city_names'].append(city_name)
+            city_lat = base_lat + rng.uniform(-5, 5)
+            city_lng = base_lng + rng.uniform(-5, 5)
+            for p in range(spec.pois_per_city):
+                poi_id = seeded_uuid(seed, 'poi', poi_index)
+                poi_index += 1
+                writer.add(Poi, {
+                    'id': poi_id,
+                    'name': f'POI {c}-{ci}-{p}',
+                    'description': f'Synthetic point of interest {p} in {city_name}',
+                    'latitude': city_lat + rng.uniform(-0.1, 0.1),
+                    'longitude': city_lng + rng.uniform(-0.1, 0.1),
+                    'city_id': city_id,
+                })
+                if len(sample['pois']) < SAMPLE_SIZE:
+                    sample['pois'].append(poi_id)
+                tag_count = min(poisson(rng, spec.tags_per_poi), len(tag_ids))
+                if tag_count:
+                    for tag_id in dict.fromkeys(rng.choices(tag_ids, cum_weights=tag_weights, k=tag_count)):
+                        writer.add(PoiTag, {'poi_id': poi_id, 'tag_id': tag_id})
+                for i in range(poisson(rng, spec.images_per_poi)):
+                    writer.add(PoiImage, {'id': seeded_uuid(seed, f'image:{poi_id}', i),
+                                          'poi_id': poi_id,
+                                          'url': f'https://picsum.photos/seed/{poi_id}-{i}/800/600'})
+            if progress:
+                progress(writer)
+
+    # popularity ranks are scattered over the catalog with a multiplicative
+    # permutation, so the most popular POIs are not all in the first city
+    total_pois = poi_index
+    stride = _coprime_stride(total_pois, rng)
+    password = generate_password_hash(SEED_PASSWORD)
+    for u in range(spec.users):
+        user_id = seeded_uuid(seed, 'user', u)
+        user_name = f'test_user{u}'
+        writer.add(User, {
+            'id': user_id, 'name': f'Test User {u}', 'user_name': user_name,
+            'email': f'{user_name}@test.com', 'password': password,
+            'birth_date': datetime(1970 + u % 40, 1 + u % 12, 1 + u % 28),
+            'location': None, 'role': 'user', 'img': None,
+        })
+        if len(sample['users']) < SAMPLE_SIZE:
+            sample['users'].append(user_id)
+            sample['user_names'].append(user_name)
+        if not total_pois:
+            continue
+        for model, mean in ((Favorite, spec.favorites_per_user), (Visited, spec.visited_per_user)):
+            # user activity is heavy tailed as well (Pareto with the requested mean)
+            count = min(total_pois, int(mean * rng.paretovariate(2.0) / 2.0))
+            picked = set()
+            for _ in range(count * 2):
+                if len(picked) >= count:
+                    break
+                rank = _power_law_index(rng, total_pois, spec.popularity_skew)
+                picked.add((rank * stride) % total_pois)
+            for index in picked:
+                writer.add(model, {'user_id': user_id, 'poi_id': seeded_uuid(seed, 'poi', index)})
+
+    writer.flush()
+    sample['rows'] = dict(writer.counts)
+    sample['elapsed'] = writer.elapsed
+    return sample
+
@@ -0,0 +1,187 @@
+"""
+"Similar places" index built offline from the POI tags.
+
+`flask build-similarity` turns the tags of the POIs of each city (or country,
+see SIMILARITY_SCOPE) into a sparse POI x tag matrix and scores every pair
+with cosine or Jaccard similarity (SIMILARITY_METRIC), optionally multiplied
+by exp(-distance / SIMILARITY_DISTANCE_KM) so nearby places rank higher. The
+SIMILARITY_TOP_K best neighbours of each POI are stored in poi_similarity and
+served with a primary key range scan.
+
+Tag writes made through the session mark the city of the POI as stale and
+`flask build-similarity --stale` rebuilds only those groups.
+"""
+import time
+import numpy as np
+from scipy import sparse
+from sqlalchemy import delete, event, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+from api.models import db, City, Poi, PoiSimilarity, PoiTag, SimilarityStaleCity, Tag
+from api.geo import haversine_km
+
+SCOPES = ('city', 'country')
+METRICS = ('cosine', 'jaccard')
+BLOCK_ROWS = 512
+WRITE_BATCH = 10000
+
+
+def _mark_stale(session, flush_context, instances):
+    poi_ids, city_ids = set(), set()
+    removed_tags = []
+    for obj in session.new:
+        if isinstance(obj, PoiTag):
+            poi_ids.add(obj.poi_id)
+        elif isinstance(obj, Poi):
+            city_ids.add(obj.city_id)
+    for obj in session.deleted:
+        if isinstance(obj, PoiTag):
+            poi_ids.add(obj.poi_id)
+        elif isinstance(obj, Tag):
+            removed_tags.append(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Poi):
+            history = inspect(obj).attrs.city_id.history
+            if history.has_changes():
+                city_ids.update(history.deleted)
+                city_ids.add(obj.city_id)
+    if not (poi_ids or city_ids or removed_tags):
+        return
+    connection = session.connection()
+    new_pois = {obj.id: obj.city_id for obj in session.new if isinstance(obj, Poi)}
+    city_ids.update(new_pois[poi_id] for poi_id in poi_ids if poi_id in new_pois)
+    stored = poi_ids - new_pois.keys()
+    if stored:
+        city_ids.update(connection.execute(
+            select(Poi.city_id).where(Poi.id.in_(stored))).scalars())
+    if removed_tags:
+        city_ids.update(connection.execute(
+            select(Poi.city_id).join(PoiTag, PoiTag.poi_id == Poi.id)
+            .where(PoiTag.tag_id.in_(removed_tags)).distinct()).scalars())
+    city_ids.discard(None)
+    if city_ids:
+        insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+        connection.execute(insert(SimilarityStaleCity).on_conflict_do_nothing(),
+                           [{'city_id': city_id} for city_id in city_ids])
+
+
+_listeners_installed = False
+
+
+def setup_similarity(app):
+    """
+    Configure the similarity index and track the tag changes that make it stale.
+    Args:
+        app (Flask): The application.
+    """
+    global _listeners_installed
+    app.config.setdefault('SIMILARITY_SCOPE', 'city')
+    app.config.setdefault('SIMILARITY_METRIC', 'cosine')
+    app.config.setdefault('SIMILARITY_TOP_K', 10)
+    app.config.setdefault('SIMILARITY_DISTANCE_KM', 0.0)
+    if not _listeners_installed:
+        event.listen(db.session, 'before_flush', _mark_stale)
+        _listeners_installed = True
+
+
+def get_similar_pois(poi_id, limit):
+    """
+    Read the precomputed neighbours of a POI.
+    Args:
+        poi_id (str): POI ID.
+        limit (int): Maximum number of neighbours.
+    Returns:
+        list: (score, Poi) pairs, best first.
+    """
+    rows = db.session.execute(
+        select(PoiSimilarity.score, Poi).join(Poi, PoiSimilarity.similar_poi_id == Poi.id)
+        .where(PoiSimilarity.poi_id == poi_id)
+        .order_by(PoiSimilarity.score.desc(), Poi.id).limit(limit)
+        .options(*Poi.serialize_options()))
+    return [(score, poi) for score, poi in rows]
+
+
+def _score_group(pois, tag_pairs, tag_index, config):
+    """Yield (poi_id, similar_poi_id, score) for the top neighbours within one group."""
+    n = len(pois)
+    if n < 2:
+        return
+    position = {poi_id: i for i, (poi_id, _, _) in enumerate(pois)}
+    rows = [position[poi_id] for poi_id, _ in tag_pairs]
+    cols = [tag_index[tag_id] for _, tag_id in tag_pairs]
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                               shape=(n, len(tag_index)))
+    matrix.data[:] = 1.0  # duplicate pairs count once
+    sizes = np.asarray(matrix.getnnz(axis=1), dtype=np.float32)
+    lat = np.array([p[1] for p in pois])
+    lon = np.array([p[2] for p in pois])
+    ids = [p[0] for p in pois]
+    top_k = min(config['SIMILARITY_TOP_K'], n - 1)
+    distance_km = config['SIMILARITY_DISTANCE_KM']
+    transposed = matrix.T.tocsc()
+
+    for start in range(0, n, BLOCK_ROWS):
+        stop = min(start + BLOCK_ROWS, n)
+        shared = (matrix[start:stop] @ transposed).toarray()
+        if config['SIMILARITY_METRIC'] == 'jaccard':
+            denominator = sizes[start:stop, None] + sizes[None, :] - shared
+        else:
+            denominator = np.sqrt(sizes[start:stop, None] * sizes[None, :])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = np.where(denominator > 0, shared / denominator, 0.0)
+        if distance_km:
+            score = score * np.exp(-haversine_km(lat[start:stop], lon[start:stop], lat, lon) / distance_km)
+        score[np.arange(stop - start), np.arange(start, stop)] = 0.0
+        best = np.argpartition(-score, top_k - 1, axis=1)[:, :top_k]
+        for i, neighbours in enumerate(best):
+            for j in neighbours:
+                if score[i, j] > 0:
+                    yield ids[start + i], ids[j], float(score[i, j])
+
+
+def build_similarity_index(config, stale_only=False, progress=None):
+    """
+    Rebuild the similar places index, for every group or only the stale ones.
+    Args:
+        config (dict): Application config with the SIMILARITY_* settings.
+        stale_only (bool): Only rebuild the groups of cities marked stale.
+        progress (callable, optional): Called with (groups done, total groups).
+    Returns:
+        dict: groups and rows written, and elapsed seconds.
+    """
+    started = time.perf_counter()
+    by_country = config['SIMILARITY_SCOPE'] == 'country'
+    group_column = City.country_id if by_country else City.id
+    stale = list(db.session.scalars(select(SimilarityStaleCity.city_id)))
+    if stale_only:
+        groups = set(db.session.scalars(select(group_column).where(City.id.in_(stale))))
+    else:
+        groups = set(db.session.scalars(select(group_column)))
+    tag_index = {tag_id: i for i, tag_id in enumerate(db.session.scalars(select(Tag.id)))}
+
+    written = 0
+    for done, group in enumerate(sorted(groups), start=1):
+        # cleared in the transaction that reads the group, so a city marked after this
+        # point keeps its marker for the next run
+        db.session.execute(delete(SimilarityStaleCity).where(SimilarityStaleCity.city_id.in_(
+            select(City.id).where(group_column == group))))
+        in_group = select(Poi.id).join(City, Poi.city_id == City.id).where(group_column == group)
+        pois = db.session.execute(select(Poi.id, Poi.latitude, Poi.longitude)
+                                  .where(Poi.id.in_(in_group)).order_by(Poi.id)).all()
+        tag_pairs = db.session.execute(select(PoiTag.poi_id, PoiTag.tag_id)
+                                       .where(PoiTag.poi_id.in_(in_group))).all()
+        db.session.execute(delete(PoiSimilarity).where(PoiSimilarity.poi_id.in_(in_group)))
+        batch = []
+        for poi_id, similar_poi_id, score in _score_group(pois, tag_pairs, tag_index, config):
+            batch.append({'poi_id': poi_id, 'similar_poi_id': similar_poi_id, 'score': score})
+            if len(batch) >= WRITE_BATCH:
+                db.session.execute(PoiSimilarity.__table__.insert(), batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            db.session.execute(PoiSimilarity.__table__.insert(), batch)
+            written += len(batch)
+        db.session.commit()
+        if progress:
+            progress(done, len(groups))
+
+    return {'groups': len(groups), 'rows': written, 'elapsed': time.perf_counter() - started}
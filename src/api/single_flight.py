@@ -0,0 +1,152 @@
+"""
+Coalescing of identical concurrent GET requests (single-flight).
+
+Views decorated with @coalesce run once per set of identical requests in
+flight in a worker: the first request (the leader) runs the view and the ones
+that arrive while it is running wait for it and get a copy of its encoded
+response (body bytes, status and headers) instead of repeating the same
+queries and serialization. Requests are identical when they have the same path,
+query string and Authorization header, so a view that depends on the user is
+only shared between requests of that user.
+
+A flight is never joined across a commit of this worker: every commit that
+wrote something starts a new generation of flights, so a client reading after
+its own write never gets a response computed before it. Errors raised as
+APIException are shared too; on any other error, or when the leader takes more
+than SINGLE_FLIGHT_WAIT_SECONDS, the waiting requests run the view themselves.
+
+Coalescing needs concurrent requests in the same worker, i.e. threaded
+(gthread) or gevent gunicorn workers.
+"""
+import threading
+from functools import wraps
+from flask import Response, current_app, has_app_context, request
+from sqlalchemy import event
+from werkzeug.datastructures import Headers
+from api.models import db
+from api.utils import APIException
+
+
+class _Flight:
+    """Request being computed and the requests waiting for it."""
+    __slots__ = ('done', 'response', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class SingleFlight:
+    """Identical requests in flight in this worker."""
+
+    def __init__(self, wait_seconds=30.0):
+        self.wait_seconds = wait_seconds
+        self.generation = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def new_generation(self):
+        """Stop sharing the flights started so far with new requests."""
+        with self._lock:
+            self.generation += 1
+
+    def run(self, key, compute):
+        """
+        Compute a response, or wait for the identical one in flight.
+        Args:
+            key (tuple): What identifies identical requests.
+            compute (callable): Returns the Response of the request.
+        Returns:
+            Response: The response computed by this request or a copy of the leader's.
+        """
+        with self._lock:
+            key = (self.generation,) + key
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            if flight.done.wait(self.wait_seconds):
+                if flight.error is not None:
+                    error = flight.error
+                    raise APIException(error.message, status_code=error.status_code,
+                                       payload=error.payload)
+                if flight.response is not None:
+                    body, status, headers = flight.response
+                    return Response(body, status=status, headers=Headers(headers))
+            return compute()
+
+        try:
+            response = compute()
+            if not response.is_streamed and not response.direct_passthrough:
+                flight.response = (response.get_data(), response.status,
+                                   list(response.headers.items()))
+            return response
+        except APIException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+def coalesce(view):
+    """
+    Share the response of a GET view between identical concurrent requests.
+    Place it right above the view function, under @api.route and @rate_cost.
+    Args:
+        view (callable): The view function.
+    Returns:
+        callable: The wrapped view.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        flights = current_app.extensions.get('single_flight')
+        if flights is None or request.method != 'GET':
+            return view(*args, **kwargs)
+        key = (request.path, request.query_string, request.headers.get('Authorization'))
+        return flights.run(key, lambda: current_app.make_response(view(*args, **kwargs)))
+    return wrapper
+
+
+def _note_writes(session, flush_context, instances):
+    if session.new or session.dirty or session.deleted:
+        session.info['single_flight_writes'] = True
+
+
+def _new_generation(session):
+    if session.info.pop('single_flight_writes', False) and has_app_context():
+        flights = current_app.extensions.get('single_flight')
+        if flights is not None:
+            flights.new_generation()
+
+
+def _discard_writes(session, previous_transaction):
+    if not session.in_transaction():
+        session.info.pop('single_flight_writes', None)
+
+
+_listeners_installed = False
+
+
+def setup_single_flight(app):
+    """
+    Coalesce the identical concurrent requests of the @coalesce views of the app.
+    Args:
+        app (Flask): The application.
+    Returns:
+        SingleFlight: The flights of this worker.
+    """
+    global _listeners_installed
+    app.config.setdefault('SINGLE_FLIGHT_WAIT_SECONDS', 30.0)
+    flights = SingleFlight(app.config['SINGLE_FLIGHT_WAIT_SECONDS'])
+    app.extensions['single_flight'] = flights
+    if not _listeners_installed:
+        event.listen(db.session, 'before_flush', _note_writes)
+        event.listen(db.session, 'after_commit', _new_generation)
+        event.listen(db.session, 'after_soft_rollback', _discard_writes)
+        _listeners_installed = True
+    return flights
@@ -0,0 +1,125 @@
+"""
+Serving of the built front end (dist/) with a manifest built at startup.
+Fingerprinted bundles (everything Vite emits under assets/, always content
+hashed, unlike the files copied from public/ to the root of the build) are
+cached forever by browsers and CDNs, precompressed .br/.gz siblings are sent
+when the client accepts them and only index.html is revalidated on every visit.
+"""
+import mimetypes
+import os
+from flask import request, send_file
+
+INDEX_FILE = 'index.html'
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+DEFAULT_MAX_AGE = 24 * 3600
+
+# build.assetsDir of vite.config.js, where every file name has a content hash (assets/index-B-x3aZ1q.js)
+FINGERPRINTED_DIR = 'assets/'
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+
+class StaticAsset:
+    """File of the static build that can be served to clients."""
+    __slots__ = ('path', 'mimetype', 'fingerprinted', 'encodings')
+
+    def __init__(self, path, mimetype, fingerprinted, encodings):
+        self.path = path
+        self.mimetype = mimetype
+        self.fingerprinted = fingerprinted
+        self.encodings = encodings
+
+
+class StaticManifest:
+    """
+    In-memory index of the files in the static build directory.
+    Lookups never touch the filesystem, so unknown paths (client side routes)
+    fall back to index.html without an os.path.isfile() call per request.
+    """
+
+    def __init__(self, static_dir, auto_reload=False):
+        self.static_dir = os.path.realpath(static_dir)
+        self.auto_reload = auto_reload
+        self._mtime = None
+        self.assets = {}
+        self.reload()
+
+    def _dir_mtime(self):
+        try:
+            return os.stat(self.static_dir).st_mtime
+        except OSError:
+            return None
+
+    def reload(self):
+        """Rebuild the manifest by walking the static directory once."""
+        files = set()
+        for root, _, names in os.walk(self.static_dir):
+            for name in names:
+                rel = os.path.relpath(os.path.join(root, name), self.static_dir)
+                files.add(rel.replace(os.sep, '/'))
+
+        assets = {}
+        for rel in files:
+            if any(rel.endswith(suffix) and rel[:-len(suffix)] in files
+                   for _, suffix in PRECOMPRESSED):
+                continue
+            mimetype = mimetypes.guess_type(rel)[0] or 'application/octet-stream'
+            encodings = {
+                encoding: os.path.join(self.static_dir, rel + suffix)
+                for encoding, suffix in PRECOMPRESSED if rel + suffix in files
+            }
+            fingerprinted = rel.startswith(FINGERPRINTED_DIR)
+            assets[rel] = StaticAsset(os.path.join(self.static_dir, rel),
+                                      mimetype, fingerprinted, encodings)
+        self.assets = assets
+        self._mtime = self._dir_mtime()
+
+    def resolve(self, path):
+        """
+        Find the asset for a request path.
+        Args:
+            path (str): Path relative to the static directory.
+        Returns:
+            StaticAsset | None: The asset, index.html for unknown paths or None if there is no build.
+        """
+        if self.auto_reload and self._dir_mtime() != self._mtime:
+            self.reload()
+        return self.assets.get(path) or self.assets.get(INDEX_FILE)
+
+
+def serve_static_asset(manifest, path):
+    """
+    Build the response for a file of the static build.
+    Args:
+        manifest (StaticManifest): Manifest of the static directory.
+        path (str): Requested path relative to the static directory.
+    Returns:
+        Response: The file (or index.html) with its caching headers, or a 404 response.
+    """
+    asset = manifest.resolve(path)
+    if asset is None:
+        return 'Front end build not found', 404
+
+    file_path = asset.path
+    content_encoding = None
+    for encoding, _ in PRECOMPRESSED:
+        if encoding in asset.encodings and request.accept_encodings[encoding]:
+            file_path = asset.encodings[encoding]
+            content_encoding = encoding
+            break
+
+    if asset.fingerprinted:
+        max_age = IMMUTABLE_MAX_AGE
+    elif asset.path.endswith(INDEX_FILE):
+        max_age = None  # send_file marks it no-cache so it is always revalidated
+    else:
+        max_age = DEFAULT_MAX_AGE
+
+    response = send_file(file_path, mimetype=asset.mimetype, conditional=True,
+                         download_name=os.path.basename(asset.path), max_age=max_age)
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    if asset.encodings:
+        response.vary.add('Accept-Encoding')
+    if asset.fingerprinted:
+        response.cache_control.immutable = True
+    return response
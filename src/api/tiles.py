@@ -0,0 +1,333 @@
+"""
+POIs of XYZ map tiles as GeoJSON, cached on disk.
+
+A tile is rendered once per tag filter and written under
+TILE_CACHE_DIR/<z>/<x>/<y>/, then served with send_file() (ETag, 304s and a
+public Cache-Control so browsers and CDNs keep it too). The files are shared
+by every worker of the host (several hosts need a shared TILE_CACHE_DIR).
+
+Only tiles with POIs are stored, and tag filters are reduced to the tags that
+exist, so requests for empty areas or made up tags do not fill the disk. Once
+a worker has written TILE_CACHE_MAX_BYTES / 10 bytes it adds up the size of the
+cache and deletes the oldest tiles while it is above TILE_CACHE_MAX_BYTES.
+
+Invalidation is precise: before every flush the tiles of the POIs whose
+coordinates, name or tags change (including the POIs removed with a tag, a
+city or a country) are collected on the session, and their directories are
+emptied once the transaction commits. Every tile has a stamp, one of the
+STAMP_BUCKETS files of TILE_CACHE_DIR/.stamps (whether the tile was cached or
+not), rewritten on invalidation; a tile rendered while its stamp changed is
+dropped instead of being kept with stale data.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import zlib
+from flask import current_app
+from sqlalchemy import event, inspect, or_, select
+from api.models import db, City, Country, Poi, PoiTag, Tag
+from api.geo import tile_bounds, tile_xy
+
+MIN_TILE_ZOOM = 8
+MAX_TILE_ZOOM = 22
+STAMP_DIR = '.stamps'
+STAMP_BUCKETS = 4096
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'odyssey-tiles')
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+PENDING_KEY = 'tiles_to_invalidate'
+
+# bytes written by this worker since it last measured each cache directory
+_written = {}
+_written_lock = threading.Lock()
+
+
+def _tile_dir(cache_dir, z, x, y):
+    return os.path.join(cache_dir, str(z), str(x), str(y))
+
+
+def _variant(tags):
+    if not tags:
+        return 'all.geojson'
+    digest = hashlib.sha1('\n'.join(sorted(tags)).encode('utf-8')).hexdigest()[:16]
+    return f'tags-{digest}.geojson'
+
+
+def _stamp_path(cache_dir, z, x, y):
+    # tiles sharing a bucket only drop each other's renders more often
+    bucket = zlib.crc32(f'{z}/{x}/{y}'.encode('ascii')) % STAMP_BUCKETS
+    return os.path.join(cache_dir, STAMP_DIR, str(bucket))
+
+
+def _read_stamp(path):
+    try:
+        with open(path, encoding='utf-8') as stamp:
+            return stamp.read()
+    except FileNotFoundError:
+        return ''
+
+
+def _write_atomic(path, data):
+    temporary = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temporary, 'wb') as output:
+        output.write(data)
+    os.replace(temporary, path)
+
+
+def _prune(cache_dir, max_bytes):
+    """Delete the oldest tiles until the cache holds at most max_bytes."""
+    files, total = [], 0
+    for root, dirs, names in os.walk(cache_dir):
+        if root == cache_dir:
+            dirs[:] = [name for name in dirs if name.isdigit()]
+        for name in names:
+            if name.endswith('.geojson'):
+                path = os.path.join(root, name)
+                try:
+                    info = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((info.st_mtime, info.st_size, path))
+                total += info.st_size
+    if total <= max_bytes:
+        return
+    files.sort()
+    for _, size, path in files:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        if total <= max_bytes:
+            break
+
+
+def _note_written(cache_dir, max_bytes, size):
+    if not max_bytes:
+        return
+    with _written_lock:
+        written = _written.get(cache_dir, 0) + size
+        measure = written >= max_bytes // 10
+        _written[cache_dir] = 0 if measure else written
+    if measure:
+        _prune(cache_dir, max_bytes)
+
+
+def _features(z, x, y, tags):
+    south, west, north, east = tile_bounds(z, x, y)
+    pad = 1e-9
+    in_tile = [Poi.latitude.between(south - pad, north + pad),
+               Poi.longitude.between(west - pad, east + pad)]
+    if tags:
+        in_tile.append(Poi.id.in_(select(PoiTag.poi_id).join(Tag, Tag.id == PoiTag.tag_id)
+                                  .where(Tag.name.in_(list(tags)))))
+    rows = db.session.execute(select(Poi.id, Poi.name, Poi.latitude, Poi.longitude)
+                              .where(*in_tile).order_by(Poi.id)).all()
+    if rows:
+        # points on a shared edge belong to a single tile
+        xs, ys = tile_xy([row.latitude for row in rows], [row.longitude for row in rows], z)
+        rows = [row for row, row_x, row_y in zip(rows, xs.tolist(), ys.tolist())
+                if row_x == x and row_y == y]
+    poi_tags = {row.id: [] for row in rows}
+    if rows:
+        for poi_id, name in db.session.execute(
+                select(PoiTag.poi_id, Tag.name).join(Tag, Tag.id == PoiTag.tag_id)
+                .join(Poi, Poi.id == PoiTag.poi_id).where(*in_tile[:2]).order_by(Tag.name)):
+            if poi_id in poi_tags:
+                poi_tags[poi_id].append(name)
+    return [{
+        'type': 'Feature',
+        'id': row.id,
+        'geometry': {'type': 'Point',
+                     'coordinates': [round(row.longitude, 6), round(row.latitude, 6)]},
+        'properties': {'name': row.name, 'tags': poi_tags[row.id]},
+    } for row in rows]
+
+
+def _dumps(features):
+    return current_app.json.dumps_bytes({'type': 'FeatureCollection', 'features': features})
+
+
+def render_tile(z, x, y, tags=()):
+    """
+    Build the GeoJSON of the POIs in a tile.
+    Args:
+        z, x, y (int): Tile coordinates.
+        tags (iterable): Only keep POIs with at least one of these tag names.
+    Returns:
+        bytes: FeatureCollection with one Point per POI and its name and tags as properties.
+    """
+    return _dumps(_features(z, x, y, tags))
+
+
+def get_tile(cache_dir, z, x, y, tags=(), max_bytes=0):
+    """
+    Read a tile from the cache, rendering and storing it on a miss.
+    Args:
+        cache_dir (str): Cache directory, or an empty value to render every time.
+        z, x, y (int): Tile coordinates.
+        tags (iterable): Tag names filter.
+        max_bytes (int): Size the cache is brought back to after growing, 0 for no limit.
+    Returns:
+        tuple: (path, data), path of the cached file or None when the tile is not cached,
+            with the rendered data in that case.
+    """
+    if not cache_dir:
+        return None, render_tile(z, x, y, tags)
+    if tags:
+        # unknown tags match nothing, they do not get a cached variant of their own
+        tags = sorted(db.session.scalars(select(Tag.name).where(Tag.name.in_(list(tags)))))
+        if not tags:
+            return None, _dumps([])
+    directory = _tile_dir(cache_dir, z, x, y)
+    path = os.path.join(directory, _variant(tags))
+    if os.path.isfile(path):
+        return path, None
+
+    stamp_path = _stamp_path(cache_dir, z, x, y)
+    stamp = _read_stamp(stamp_path)
+    features = _features(z, x, y, tags)
+    data = _dumps(features)
+    if not features:
+        return None, data
+    os.makedirs(directory, exist_ok=True)
+    _write_atomic(path, data)
+    if _read_stamp(stamp_path) != stamp:
+        # invalidated while rendering: serve this response but do not keep it
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return None, data
+    _note_written(cache_dir, max_bytes, len(data))
+    return path, None
+
+
+def invalidate_tiles(cache_dir, tiles):
+    """
+    Drop the cached files of tiles, for every tag filter.
+    Args:
+        cache_dir (str): Cache directory.
+        tiles (iterable): (z, x, y) of the tiles.
+    """
+    os.makedirs(os.path.join(cache_dir, STAMP_DIR), exist_ok=True)
+    for z, x, y in tiles:
+        # before the files go, so a render in flight sees it even for a tile not cached yet
+        _write_atomic(_stamp_path(cache_dir, z, x, y), uuid.uuid4().hex.encode('ascii'))
+        directory = _tile_dir(cache_dir, z, x, y)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            continue
+        for name in names:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+def clear_tile_cache(cache_dir):
+    """
+    Drop every cached tile, e.g. after a bulk load.
+    Args:
+        cache_dir (str): Cache directory.
+    """
+    if cache_dir and os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.isdigit():
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+
+def _tiles_of(points):
+    """(z, x, y) of every cached zoom level holding the points."""
+    tiles = set()
+    if points:
+        latitudes = [lat for lat, _ in points]
+        longitudes = [lon for _, lon in points]
+        for z in range(MIN_TILE_ZOOM, MAX_TILE_ZOOM + 1):
+            xs, ys = tile_xy(latitudes, longitudes, z)
+            tiles.update((z, x, y) for x, y in zip(xs.tolist(), ys.tolist()))
+    return tiles
+
+
+def _collect_tiles(session, flush_context, instances):
+    stored, points = set(), []
+    removed_places = {Country: set(), City: set()}
+    tag_ids = set()
+    for obj in session.deleted:
+        if isinstance(obj, Poi):
+            stored.add(obj.id)
+        elif isinstance(obj, PoiTag):
+            stored.add(obj.poi_id)
+        elif isinstance(obj, Tag):
+            tag_ids.add(obj.id)
+        elif isinstance(obj, (Country, City)):
+            removed_places[type(obj)].add(obj.id)
+    new_pois = {obj.id: obj for obj in session.new if isinstance(obj, Poi)}
+    for obj in new_pois.values():
+        points.append((obj.latitude, obj.longitude))
+    for obj in session.new:
+        if isinstance(obj, PoiTag) and obj.poi_id not in new_pois:
+            stored.add(obj.poi_id)
+    for obj in session.dirty:
+        if obj in session.deleted:
+            continue
+        if isinstance(obj, Poi):
+            attrs = inspect(obj).attrs
+            if any(attrs[attr].history.has_changes() for attr in ('latitude', 'longitude', 'name')):
+                stored.add(obj.id)
+                points.append((obj.latitude, obj.longitude))
+        elif isinstance(obj, Tag) and inspect(obj).attrs.name.history.has_changes():
+            tag_ids.add(obj.id)
+    if not (stored or points or tag_ids or removed_places[Country] or removed_places[City]):
+        return
+
+    # coordinates as stored, the tiles that currently show the POIs
+    conditions = []
+    if stored:
+        conditions.append(Poi.id.in_(stored))
+    if tag_ids:
+        conditions.append(Poi.id.in_(select(PoiTag.poi_id).where(PoiTag.tag_id.in_(tag_ids))))
+    if removed_places[City]:
+        conditions.append(Poi.city_id.in_(removed_places[City]))
+    if removed_places[Country]:
+        conditions.append(Poi.city_id.in_(
+            select(City.id).where(City.country_id.in_(removed_places[Country]))))
+    if conditions:
+        points.extend(session.connection().execute(
+            select(Poi.latitude, Poi.longitude).where(or_(*conditions))).all())
+    session.info.setdefault(PENDING_KEY, set()).update(_tiles_of(points))
+
+
+def _invalidate_committed(session):
+    tiles = session.info.pop(PENDING_KEY, None)
+    cache_dir = current_app.config.get('TILE_CACHE_DIR')
+    if tiles and cache_dir:
+        invalidate_tiles(cache_dir, tiles)
+
+
+def _discard_pending(session, previous_transaction):
+    if not session.in_transaction():
+        session.info.pop(PENDING_KEY, None)
+
+
+_listeners_installed = False
+
+
+def setup_tiles(app):
+    """
+    Configure the tile cache and invalidate it on writes made through the session.
+    Args:
+        app (Flask): The application.
+    """
+    global _listeners_installed
+    app.config.setdefault('TILE_CACHE_DIR', DEFAULT_CACHE_DIR)
+    app.config.setdefault('TILE_MAX_AGE', 60)
+    app.config.setdefault('TILE_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES)
+    if not _listeners_installed:
+        event.listen(db.session, 'before_flush', _collect_tiles)
+        event.listen(db.session, 'after_commit', _invalidate_committed)
+        event.listen(db.session, 'after_soft_rollback', _discard_pending)
+        _listeners_installed = True
@@ -0,0 +1,91 @@
+"""
+Visiting order for a set of POIs.
+
+The distance matrix is computed with one vectorized haversine pass, then a
+tour is built with nearest neighbour and improved with 2-opt, where each step
+evaluates all the moves of one edge as a NumPy expression. Open paths (the
+default) are solved as a closed tour through a dummy stop that is 0 km from
+every POI, and fixed to the start POI when one is given.
+"""
+import time
+import numpy as np
+from api.geo import haversine_km
+
+MAX_PASSES = 100
+TIME_BUDGET = 0.5
+LOCKED = -1e9
+
+
+def _nearest_neighbour(matrix, start):
+    m = len(matrix)
+    tour = [start]
+    visited = np.zeros(m, dtype=bool)
+    visited[start] = True
+    current = start
+    for _ in range(m - 1):
+        distances = np.where(visited, np.inf, matrix[current])
+        current = int(np.argmin(distances))
+        visited[current] = True
+        tour.append(current)
+    return np.array(tour)
+
+
+def _two_opt(matrix, tour, deadline):
+    """Improve a closed tour in place until no 2-opt move helps (or time runs out)."""
+    m = len(tour)
+    for _ in range(MAX_PASSES):
+        improved = False
+        for i in range(m - 2):
+            a, b = tour[i], tour[i + 1]
+            # j + 1 wraps around to the start; with i == 0 that edge is (a, b)'s neighbour
+            j = np.arange(i + 2, m if i > 0 else m - 1)
+            if not len(j):
+                continue
+            c, d = tour[j], tour[(j + 1) % m]
+            delta = matrix[a, c] + matrix[b, d] - matrix[a, b] - matrix[c, d]
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                tour[i + 1:j[best] + 1] = tour[i + 1:j[best] + 1][::-1].copy()
+                improved = True
+        if not improved or time.perf_counter() > deadline:
+            break
+    return tour
+
+
+def plan_trip(latitudes, longitudes, start=None, round_trip=False):
+    """
+    Compute the distance matrix of the stops and a short order to visit them.
+    Args:
+        latitudes, longitudes (list): Coordinates of the stops in degrees.
+        start (int, optional): Index of the stop to start from.
+        round_trip (bool): Come back to the start at the end.
+    Returns:
+        dict: matrix (numpy array, km), order (stop indexes), legs (km) and total_km.
+    """
+    n = len(latitudes)
+    distances = haversine_km(latitudes, longitudes, latitudes, longitudes)
+    if n < 2:
+        return {'matrix': distances, 'order': list(range(n)), 'legs': [], 'total_km': 0.0}
+
+    deadline = time.perf_counter() + TIME_BUDGET
+    if round_trip:
+        matrix = distances
+        first = start or 0
+    else:
+        matrix = np.zeros((n + 1, n + 1))
+        matrix[:n, :n] = distances
+        first = n
+        if start is not None:
+            matrix[n, start] = matrix[start, n] = LOCKED
+    tour = _two_opt(matrix, _nearest_neighbour(matrix, first), deadline)
+
+    tour = np.roll(tour, -int(np.where(tour == first)[0][0]))
+    if round_trip:
+        order = list(tour) + [first]
+    else:
+        order = list(tour[1:])
+        if start is not None and order[0] != start:
+            order.reverse()
+    legs = [float(distances[a, b]) for a, b in zip(order, order[1:])]
+    return {'matrix': distances, 'order': [int(i) for i in order], 'legs': legs,
+            'total_km': float(sum(legs))}
@@ -2,14 +2,28 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for, send_from_directory
+from flask import Flask, jsonify
 from flask_migrate import Migrate
-from flask_swagger import swagger
+from werkzeug.middleware.proxy_fix import ProxyFix
 from api.utils import APIException, generate_sitemap
+from api.json_provider import FastJSONProvider
+from api.static_assets import StaticManifest, serve_static_asset
 from api.models import db
 from api.routes import api
-from api.admin import setup_admin
 from api.commands import setup_commands
+from api.metrics import setup_metrics
+from api.query_profiler import setup_query_profiler
+from api.change_feed import setup_change_feed
+from api.place_stats import setup_place_stats
+from api.similarity import setup_similarity
+from api.clusters import setup_clusters
+from api.tiles import DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_BYTES, setup_tiles
+from api.autocomplete import setup_autocomplete
+from api.poi_cache import setup_poi_cache
+from api.rate_limit import setup_rate_limit
+from api.single_flight import setup_single_flight
+from api.jobs import setup_jobs
+from api.idempotency import setup_idempotency
 from flask_jwt_extended import JWTManager
 
 
@@ -17,58 +31,195 @@ from flask_jwt_extended import JWTManager
 ENV = "development" if os.getenv("FLASK_DEBUG") == "1" else "production"
 static_file_dir = os.path.join(os.path.dirname(
     os.path.realpath(__file__)), '../dist/')
-app = Flask(__name__)
-app.url_map.strict_slashes = False
 
-# database configuration
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace(
-        "postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-MIGRATE = Migrate(app, db, compare_type=True)
-db.init_app(app)
-
-#JWT configuration
-app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY")
-jwt = JWTManager(app)
-
-# add the admin
-setup_admin(app)
-
-# add the admin
-setup_commands(app)
-
-# Add all endpoints form the API with a "api" prefix
-app.register_blueprint(api, url_prefix='/api')
-
-# Handle/serialize errors like a JSON object
-
-
-@app.errorhandler(APIException)
-def handle_invalid_usage(error):
-    return jsonify(error.to_dict()), error.status_code
-
-# generate sitemap with all your endpoints
-
-
-@app.route('/')
-def sitemap():
-    if ENV == "development":
-        return generate_sitemap(app)
-    return send_from_directory(static_file_dir, 'index.html')
-
-# any other endpoint will try to serve it like a static file
-@app.route('/<path:path>', methods=['GET'])
-def serve_any_other_file(path):
-    if not os.path.isfile(os.path.join(static_file_dir, path)):
-        path = 'index.html'
-    response = send_from_directory(static_file_dir, path)
-    response.cache_control.max_age = 0  # avoid cache memory
-    return response
+def env_flag(name, default):
+    """
+    Read a boolean flag from the environment.
+    Args:
+        name (str): Environment variable name.
+        default (bool): Value used when the variable is not set.
+    Returns:
+        bool: True for "1", "true", "yes" or "on" (case insensitive).
+    """
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def create_app(config=None):
+    """
+    Build and configure the Flask application.
+    Development only tooling (admin panel and endpoint sitemap) is only set up
+    when enabled, so production workers boot without importing it.
+    Args:
+        config (dict, optional): Settings applied on top of the environment based configuration.
+    Returns:
+        Flask: The configured application.
+    """
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+
+    # encode every jsonify() response with orjson when available
+    app.json = FastJSONProvider(app)
+
+    # database configuration
+    db_url = os.getenv("DATABASE_URL")
+    if db_url is not None:
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace(
+            "postgres://", "postgresql://")
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    #JWT configuration
+    app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY")
+
+    # dev tooling, on by default only in development
+    app.config['ENABLE_ADMIN'] = env_flag('ENABLE_ADMIN', ENV == "development")
+    app.config['ENABLE_SITEMAP'] = env_flag(
+        'ENABLE_SITEMAP', ENV == "development")
+
+    # request metrics at /metrics, bearer token required by the endpoint when set
+    app.config['ENABLE_METRICS'] = env_flag('ENABLE_METRICS', ENV == "development")
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+
+    # N+1 and slow query logging, every request in development, opt-in sampling elsewhere
+    app.config['QUERY_PROFILER_SAMPLE_RATE'] = float(os.getenv(
+        'QUERY_PROFILER_SAMPLE_RATE', 1.0 if ENV == "development" else 0.0))
+    app.config['N_PLUS_ONE_THRESHOLD'] = int(os.getenv('N_PLUS_ONE_THRESHOLD', 5))
+    app.config['SLOW_QUERY_MS'] = float(os.getenv('SLOW_QUERY_MS', 200))
+    app.config['EXPLAIN_ANALYZE'] = env_flag('EXPLAIN_ANALYZE', False)
+    # bound values can be emails or password hashes, only logged on request
+    app.config['LOG_QUERY_PARAMETERS'] = env_flag('LOG_QUERY_PARAMETERS', False)
+
+    # similar places index, rebuilt with `flask build-similarity`
+    app.config['SIMILARITY_SCOPE'] = os.getenv('SIMILARITY_SCOPE', 'city')
+    app.config['SIMILARITY_METRIC'] = os.getenv('SIMILARITY_METRIC', 'cosine')
+    app.config['SIMILARITY_TOP_K'] = int(os.getenv('SIMILARITY_TOP_K', 10))
+    app.config['SIMILARITY_DISTANCE_KM'] = float(os.getenv('SIMILARITY_DISTANCE_KM', 0))
+
+    # POI map tiles, cached on disk (empty to disable, oldest dropped above TILE_CACHE_MAX_BYTES)
+    # and by clients for TILE_MAX_AGE seconds
+    app.config['TILE_CACHE_DIR'] = os.getenv('TILE_CACHE_DIR', DEFAULT_CACHE_DIR)
+    app.config['TILE_CACHE_MAX_BYTES'] = int(os.getenv('TILE_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES))
+    app.config['TILE_MAX_AGE'] = int(os.getenv('TILE_MAX_AGE', 60))
+
+    # in-memory typeahead index, how often it looks for writes made by other processes
+    app.config['AUTOCOMPLETE_REFRESH_SECONDS'] = float(os.getenv('AUTOCOMPLETE_REFRESH_SECONDS', 5))
+
+    # encoded JSON of this many POIs kept per process for the listings, following the change feed
+    app.config['POI_CACHE_SIZE'] = int(os.getenv('POI_CACHE_SIZE', 50000))
+
+    # reverse proxies in front of the app whose X-Forwarded-For is trusted for the client address
+    app.config['PROXY_FIX_X_FOR'] = int(os.getenv('PROXY_FIX_X_FOR', 0))
+
+    # per client token buckets and 503s when the database pool is saturated (queue depth 0 disables,
+    # needs gthread or gevent workers), off until PROXY_FIX_X_FOR gives the client addresses
+    app.config['RATE_LIMIT_ENABLED'] = env_flag('RATE_LIMIT_ENABLED', False)
+    app.config['RATE_LIMIT_PER_SECOND'] = float(os.getenv('RATE_LIMIT_PER_SECOND', 20))
+    app.config['RATE_LIMIT_BURST'] = float(os.getenv('RATE_LIMIT_BURST', 100))
+    app.config['LOAD_SHED_QUEUE_DEPTH'] = int(os.getenv('LOAD_SHED_QUEUE_DEPTH', 20))
+    app.config['LOAD_SHED_RETRY_AFTER'] = int(os.getenv('LOAD_SHED_RETRY_AFTER', 1))
+
+    # identical concurrent GETs of a worker share one response, waiting at most this long for it
+    app.config['SINGLE_FLIGHT_ENABLED'] = env_flag('SINGLE_FLIGHT_ENABLED', True)
+    app.config['SINGLE_FLIGHT_WAIT_SECONDS'] = float(os.getenv('SINGLE_FLIGHT_WAIT_SECONDS', 30))
+
+    # background bulk writes (?async=true): worker threads per web process (0 to leave them
+    # to `flask run-jobs`), items per transaction and how long finished jobs can be polled
+    app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', 2))
+    app.config['JOB_BATCH_SIZE'] = int(os.getenv('JOB_BATCH_SIZE', 500))
+    app.config['JOB_POLL_SECONDS'] = float(os.getenv('JOB_POLL_SECONDS', 2))
+    app.config['JOB_STALE_SECONDS'] = float(os.getenv('JOB_STALE_SECONDS', 300))
+    app.config['JOB_RETENTION_HOURS'] = float(os.getenv('JOB_RETENTION_HOURS', 168))
+
+    # responses kept for Idempotency-Key retries, claims of dead requests released after
+    # IDEMPOTENCY_LOCK_SECONDS and concurrent retries waiting up to IDEMPOTENCY_WAIT_SECONDS
+    app.config['IDEMPOTENCY_TTL_HOURS'] = float(os.getenv('IDEMPOTENCY_TTL_HOURS', 24))
+    app.config['IDEMPOTENCY_LOCK_SECONDS'] = float(os.getenv('IDEMPOTENCY_LOCK_SECONDS', 60))
+    app.config['IDEMPOTENCY_WAIT_SECONDS'] = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', 10))
+
+    if config:
+        app.config.update(config)
+
+    # client address from the X-Forwarded-For entries added by the trusted proxies
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+    Migrate(app, db, compare_type=True)
+    db.init_app(app)
+    JWTManager(app)
+
+    # add the admin
+    if app.config['ENABLE_ADMIN']:
+        from api.admin import setup_admin
+        setup_admin(app)
+
+    # add the commands
+    setup_commands(app)
+
+    # log catalog writes for the /api/changes sync feed
+    setup_change_feed(app)
+    # keep the per city/country totals in step with the writes
+    setup_place_stats(app)
+    # mark the similar places of cities whose tags change for a rebuild
+    setup_similarity(app)
+    # keep the map clustering grid in step with POI writes
+    setup_clusters(app)
+    # drop the cached map tiles of the POIs a transaction changes
+    setup_tiles(app)
+    # typeahead index of the catalog names, following the change feed
+    setup_autocomplete(app)
+    # encoded POIs embedded in the listings, dropped as the change feed reports their changes
+    setup_poi_cache(app)
+    # share the responses of identical concurrent reads, never across a commit
+    if app.config['SINGLE_FLIGHT_ENABLED']:
+        setup_single_flight(app)
+    # bulk writes queued in the bulk_job table and run by worker threads
+    setup_jobs(app)
+    # replay the stored responses of POSTs retried with the same Idempotency-Key
+    setup_idempotency(app)
+
+    # per endpoint latency, SQL and payload metrics at /metrics
+    if app.config['ENABLE_METRICS']:
+        setup_metrics(app)
+    if app.config['QUERY_PROFILER_SAMPLE_RATE'] > 0:
+        setup_query_profiler(app)
+    # after the metrics so rejected requests are counted too
+    if app.config['RATE_LIMIT_ENABLED']:
+        setup_rate_limit(app)
+
+    # Add all endpoints form the API with a "api" prefix
+    app.register_blueprint(api, url_prefix='/api')
+
+    # index of the front end build, rescanned on change only while developing
+    static_manifest = StaticManifest(
+        static_file_dir, auto_reload=ENV == "development")
+
+    # Handle/serialize errors like a JSON object
+    @app.errorhandler(APIException)
+    def handle_invalid_usage(error):
+        return jsonify(error.to_dict()), error.status_code
+
+    # generate sitemap with all your endpoints
+    @app.route('/')
+    def sitemap():
+        if app.config['ENABLE_SITEMAP']:
+            return generate_sitemap(app)
+        return serve_static_asset(static_manifest, 'index.html')
+
+    # any other endpoint will try to serve it like a static file
+    @app.route('/<path:path>', methods=['GET'])
+    def serve_any_other_file(path):
+        return serve_static_asset(static_manifest, path)
+
+    return app
+
+
+app = create_app()
 
 
 # this only runs if `$ python src/main.py` is executed
@@ -9,6 +9,8 @@ export default defineConfig({
         port: 3002
     },
     build: {
-        outDir: 'dist'
+        outDir: 'dist',
+        // content hashed output, cached as immutable by src/api/static_assets.py
+        assetsDir: 'assets'
     }
 })
\ No newline at end of file